@@ -1,3 +1,6 @@
+import os
+
+
 __version__ = "0.1.0"
 
 
@@ -15,4 +18,19 @@ DEFAULTS = AttrDict(
     config_dir="/etc/aletheia",
     error_template="error_templates/hugo.md.j2",
     error_result_filename="_index.md",
+    jobs=1,
+    cache=True,
+    cache_dir=os.path.join("~", ".local", "cache", "aletheia"),
+    cache_size_limit=2 * 1024 ** 3,
+    git_mirror_dir=None,
+    virtualenv_cache_dir=None,
+    http_max_per_host=8,
+    http_retries=5,
+    http_backoff=0.5,
+    report=None,
+    prometheus_textfile=None,
+    trace=None,
+    profile=False,
+    profile_dir=None,
+    profile_top=20,
 )
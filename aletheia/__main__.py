@@ -6,7 +6,7 @@ import sys
 
 import toml
 
-from . import DEFAULTS, command
+from . import DEFAULTS, command, metrics, profiling
 
 
 logger = logging.getLogger(__name__)
@@ -25,12 +25,33 @@ def main(args=None):
 
     subparsers = parser.add_subparsers(dest="command")
 
-    assemble_parser = subparsers.add_parser("assemble")
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument(
+        "--jobs", "-j", dest="jobs", type=int, help="Number of aletheia.yml pipelines to run concurrently (default 1)"
+    )
+    common_parser.add_argument(
+        "--no-cache", dest="cache", action="store_false", default=None, help="Run every pipeline stage from scratch"
+    )
+    common_parser.add_argument("--report", help="Write a JSON report of each pipeline and stage's timings here")
+    common_parser.add_argument(
+        "--prometheus-textfile", help="Write the report's metrics here, for node_exporter's textfile collector"
+    )
+    common_parser.add_argument(
+        "--trace", help="Write a Chrome trace of the build here, for chrome://tracing or Perfetto"
+    )
+    common_parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=None,
+        help="Profile every pipeline stage, writing the profiles next to the report (or to profile_dir)",
+    )
+
+    assemble_parser = subparsers.add_parser("assemble", parents=[common_parser])
     assemble_parser.add_argument(
         "path", help="Path of the core documentation tree documentation tree", default=".", nargs="?"
     )
 
-    build_parser = subparsers.add_parser("build")
+    build_parser = subparsers.add_parser("build", parents=[common_parser])
     build_parser.add_argument(
         "--src", "-s", dest="src", help="Path to documentation source (default is current working directory)"
     )
@@ -53,6 +74,13 @@ def main(args=None):
     except (TypeError, toml.TomlDecodeError):
         raise
     config["config_dir"] = params.config_dir
+    if getattr(params, "jobs", None):
+        config["jobs"] = params.jobs
+    if getattr(params, "cache", None) is False:
+        config["cache"] = False
+    for key in ("report", "prometheus_textfile", "trace", "profile"):
+        if getattr(params, key, None):
+            config[key] = getattr(params, key)
 
     logging_config = {
         "version": 1,
@@ -70,14 +98,23 @@ def main(args=None):
     }
     logging.config.dictConfig(logging_config)
 
-    if params.command == "build":
-        command.build(params.target, path=params.src, config=config)
-    elif params.command == "assemble":
-        command.assemble(params.path, config=config)
-    elif params.command == "init":
-        command.init(params.path, config=config)
-    elif params.command == "export":
-        command.export(params.src, params.target, config=config)
+    recorder = None
+    if params.command in ("build", "assemble") and (config.report or config.prometheus_textfile or config.trace):
+        recorder = metrics.start_recording()
+    try:
+        if params.command == "build":
+            command.build(params.target, path=params.src, config=config)
+        elif params.command == "assemble":
+            command.assemble(params.path, config=config)
+        elif params.command == "init":
+            command.init(params.path, config=config)
+        elif params.command == "export":
+            command.export(params.src, params.target, config=config)
+    finally:
+        if recorder:
+            metrics.stop_recording()
+            recorder.save(config)
+        profiling.log_summary(config.profile_top)
 
 
 if __name__ == "__main__":
@@ -1,21 +1,31 @@
+import concurrent.futures
 import logging
 import os
+import re
 import shutil
 import subprocess
 import tempfile
 
-from .. import DEFAULTS, exceptions
+from .. import DEFAULTS, exceptions, metrics
 from ..utils import ensure_dependencies, copytree, devel_dir
 
-ensure_dependencies(("plantuml", None))
 logger = logging.getLogger(__name__)
 
 
 class Plugin:
-    def __init__(self, working_dir, config=DEFAULTS, cmdline_args=[], keep_puml=False, **kwargs):
+    # External tools whose version the stage cache keys on
+    TOOLS = ("plantuml",)
+    # PlantUML reports syntax errors as e.g. "Error line 3 in file: docs/foo.puml"
+    ERROR_FILE_REGEX = re.compile(r"in file:\s*(.+?)\s*$", re.MULTILINE)
+
+    def __init__(
+        self, working_dir, config=DEFAULTS, cmdline_args=[], keep_puml=False, processes=1, threads="auto", **kwargs
+    ):
         self.working_dir = working_dir
         self.cmdline_args = cmdline_args
         self.keep_puml = keep_puml
+        self.processes = max(int(processes), 1)
+        self.threads = threads
         self.config = config
         self._tempdir = None
 
@@ -35,20 +45,46 @@ class Plugin:
                 self._tempdir = tempfile.mkdtemp()
         return self._tempdir
 
+    def render(self, file_paths):
+        # Without -o, PlantUML writes each diagram next to its source
+        result = metrics.run(
+            ["plantuml"] + self.cmdline_args + ["-nbthread", str(self.threads)] + file_paths, stderr=subprocess.PIPE
+        )
+        stderr = result.stderr.decode("utf8", "replace").strip()
+        if result.returncode == 0:
+            if stderr:
+                logger.info(stderr)
+            return
+        logger.error(stderr)
+        failed = self.ERROR_FILE_REGEX.findall(stderr)
+        if not failed and len(file_paths) > 1:
+            # Couldn't tell from the output which diagram is broken, so find it the slow way
+            for file_path in file_paths:
+                self.render([file_path])
+        raise exceptions.AletheiaException(
+            f"Builder returned non-zero exit code converting PlantUML diagram {', '.join(failed or file_paths)}."
+        )
+
     def run(self):
+        ensure_dependencies(("plantuml", None))
         copytree(self.working_dir, self.output_dir)
         logger.info("Searching for PlantUML files to compile.")
+        file_paths = []
         for root, dirs, files in os.walk(self.output_dir):
             for filename in files:
                 if filename.endswith((".plantuml", ".puml")):
                     file_path = os.path.join(root, filename)
-                    logger.info(f"Converting PlantUML diagram at {file_path}")
-                    result = subprocess.run(
-                        ["plantuml"] + self.cmdline_args + ["-o", os.path.abspath(root), file_path]
-                    )
-                    if result.returncode != 0:
-                        raise exceptions.AletheiaException("Builder returned non-zero exit code.")
-                    if not self.keep_puml:
-                        os.remove(file_path)
+                    logger.debug(f"Found PlantUML diagram at {file_path}")
+                    file_paths.append(file_path)
+        if file_paths:
+            logger.info(f"Converting {len(file_paths)} PlantUML diagrams.")
+            processes = min(self.processes, len(file_paths))
+            batches = [file_paths[i::processes] for i in range(processes)]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=processes) as executor:
+                for future in [metrics.submit(executor, self.render, batch) for batch in batches]:
+                    future.result()
+            if not self.keep_puml:
+                for file_path in file_paths:
+                    os.remove(file_path)
         logger.info("PlantUML scan complete.")
         return self.output_dir
@@ -1,52 +1,252 @@
+import contextlib
+import json
 import logging
 import os
+import platform
 import re
+import shlex
 import shutil
 import subprocess
+import sys
 from urllib import parse as urlparse
 
-from bs4 import BeautifulSoup
+import lxml.html
 
-from .. import DEFAULTS
-from ..exceptions import AletheiaException
-from ..utils import ensure_dependencies
+from .. import DEFAULTS, metrics
+from ..cache import Cache, get_cache, make_key
+from ..exceptions import AletheiaException, ConfigError
+from ..utils import copy_file, copytree, ensure_dependencies, file_digest, get_version, locked, map_in_batches
 
 
 logger = logging.getLogger(__name__)
-ensure_dependencies(("sphinx-build", None), ("pipenv", None), ("poetry", None))
+# Records the digest of each file in a cached build's copy of the project
+BUILD_MANIFEST = ".aletheia-manifest.json"
+BUILD_MANIFEST_VERSION = 1
+RUNNERS = ("auto", "make", "sphinx")
+HEADERLINK_XPATH = '//*[contains(concat(" ", normalize-space(@class), " "), " headerlink ")]'
+# sphinx-quickstart's Makefile hands every target straight to sphinx-build's make mode
+STOCK_MAKEFILE_REGEX = re.compile(r"^%\s*:.*\n\t@?\$\(SPHINXBUILD\) -M \$@ ", re.MULTILINE)
+
+
+def clean_html_file(full_path, in_subdir, mod_time):
+    doc = lxml.html.parse(full_path)
+
+    # Get rid of permalink anchors
+    for element in doc.xpath(HEADERLINK_XPATH):
+        element.drop_tree()
+
+    for element in doc.xpath("//a[@href]"):
+        href = urlparse.urlparse(element.get("href"))
+        if href.netloc:
+            continue
+        path = href.path
+        # Munge internal links to remove .html suffix
+        if path.endswith(".html"):
+            path = path[:-5] + "/"
+        # Because Hugo turns files into paths, if this is not an index
+        # file, we have modify link paths to point into the parent dir
+        if in_subdir and path and not path.startswith("/"):
+            path = f"../{path}"
+        if path != href.path:
+            element.set(
+                "href", urlparse.urlunparse((href.scheme, href.netloc, path, href.params, href.query, href.fragment))
+            )
+
+    with open(full_path, "w") as ofs:
+        ofs.write(lxml.html.tostring(doc, encoding=str))
+
+    # Set mod_time based on source's original mod_time
+    os.utime(full_path, (mod_time, mod_time))
+
+
+def is_within(path, directory):
+    directory = os.path.abspath(directory)
+    return os.path.commonpath([os.path.abspath(path), directory]) == directory
+
+
+def clean_html_files(pages):
+    return [clean_html_file(*page) for page in pages]
+
+
+def clean_html_dir(html_dir, mod_time, concurrency=None):
+    """Strip permalinks from Sphinx's HTML output and lay it out as Hugo expects, giving every page mod_time."""
+    # Work out where every page ends up before touching any, so that the pages can be rewritten in parallel
+    pages, moved_to = [], set()
+    for root, dirs, files in os.walk(html_dir):
+        for filename in files:
+            if filename.endswith(".html"):
+                full_path = os.path.join(root, filename)
+                if full_path in moved_to:
+                    # Overwritten by a page that was moved here
+                    continue
+                # if there's a .html file with the same name as a directory,
+                # move that file to index.html of the directory
+                #
+                # This fits with Hugo's content organization scheme.
+                base, ext = os.path.splitext(filename)
+                if base in dirs:
+                    filename = "index.html"
+                    new_path = os.path.join(root, base, filename)
+                    os.rename(full_path, new_path)
+                    full_path = new_path
+                    moved_to.add(full_path)
+                pages.append((full_path, filename != "index.html", mod_time))
+    map_in_batches(clean_html_files, pages, concurrency or os.cpu_count() or 1)
 
 
 class Plugin:
-    def __init__(self, working_dir, config=DEFAULTS, dir="docs", install_deps=False, title=None, **kwargs):
+    # External tools whose version the stage cache keys on
+    TOOLS = ("sphinx-build",)
+
+    def __init__(
+        self,
+        working_dir,
+        config=DEFAULTS,
+        dir="docs",
+        install_deps=False,
+        title=None,
+        cache_key=None,
+        runner="auto",
+        concurrency=None,
+        parallel=None,
+        **kwargs,
+    ):
         self.working_dir = working_dir
         self.dir = dir
+        self.cache_key = cache_key
+        if runner not in RUNNERS:
+            raise ConfigError(f"Unsupported Sphinx runner: {runner}")
+        self.runner = runner
+        self.concurrency = concurrency or os.cpu_count() or 1
+        # Passed to sphinx-build's -j; not every extension is safe to run in parallel, so it's up to the project
+        self.parallel = parallel
+        self._use_make = True
+        self._sourcedir = self._builddir = None
+        self._sphinx_options = []
         self.use_pipenv = install_deps and os.path.exists(os.path.join(working_dir, "Pipfile"))
         self.use_poetry = install_deps and os.path.exists(os.path.join(working_dir, "poetry.lock"))
         self.title = title
         self.config = config
+        self._virtualenv = None
 
     def cleanup(self):
+        if self._virtualenv:
+            # Cached virtualenvs outlive the build; the cache evicts them
+            return
         if self.use_pipenv:
             env = dict(os.environ)
             env.update(dict(PIPENV_PIPFILE=os.path.join(self.working_dir, "Pipfile"), PIPENV_IGNORE_VIRTUALENVS="1"))
-            subprocess.run(["pipenv", "--rm"], cwd=self.working_dir, env=env)
+            metrics.run(["pipenv", "--rm"], cwd=self.working_dir, env=env)
         elif self.use_poetry:
-            result = subprocess.run(["poetry", "env", "info", "--path"], cwd=self.working_dir, stdout=subprocess.PIPE)
+            result = metrics.run(["poetry", "env", "info", "--path"], cwd=self.working_dir, stdout=subprocess.PIPE)
             if result.returncode == 0:
                 try:
                     shutil.rmtree(result.stdout)
                 except:  # noqa: E722
                     logger.error("Error cleaning up Sphinx plugin.")
 
-    def __modify_sphinx_theme_settings(self):
-        # Modify the theme to be fully minimal
+    @property
+    def virtualenv_cache(self):
+        if self.config.virtualenv_cache_dir:
+            return Cache(os.path.expanduser(self.config.virtualenv_cache_dir), self.config.cache_size_limit)
+        return get_cache(self.config, "virtualenvs")
+
+    def __install_deps(self, environ):
+        if self.use_pipenv:
+            result = metrics.run(["pipenv", "sync", "--dev"], cwd=self.working_dir, env=environ)
+        else:
+            result = metrics.run(["poetry", "install"], cwd=self.working_dir, env=environ)
+        if result.returncode != 0:
+            raise AletheiaException("Builder pre-build returned non-zero exit code.")
+
+    def __activate(self, environ, venv_dir):
+        # Both pipenv and poetry install into the active virtualenv when one is set
+        path = os.pathsep.join([os.path.join(venv_dir, "bin"), os.environ.get("PATH", os.defpath)])
+        environ.update(VIRTUAL_ENV=venv_dir, PATH=path)
+
+    def __reinstall_local_packages(self, lock_path, environ):
+        # Packages installed from the checkout point into the build that created the virtualenv, not this one
+        if self.use_poetry:
+            commands = [["poetry", "install", "--only-root"]]
+        else:
+            with open(lock_path) as ifs:
+                lock = json.load(ifs)
+            pip_install = ["python", "-m", "pip", "install", "--no-deps"]
+            commands = [
+                pip_install + (["-e"] if spec.get("editable") else []) + [spec["path"]]
+                for section in ("default", "develop")
+                for spec in lock.get(section, {}).values()
+                if "path" in spec
+            ]
+        for command in commands:
+            result = metrics.run(command, cwd=self.working_dir, env=environ)
+            if result.returncode != 0:
+                raise AletheiaException("Could not install the project into the cached virtualenv.")
+
+    def __cached_virtualenv(self, cache, lock_path, environ, held_locks):
+        """Return a virtualenv with the locked dependencies installed, reusing one from a previous build if we can.
+
+        The virtualenv stays locked until held_locks is closed, so that it isn't evicted or changed while it's in use.
+        """
+        tool = "pipenv" if self.use_pipenv else "poetry"
+        key = make_key("sphinx-virtualenv", tool, file_digest(lock_path), platform.python_version(), sys.executable)
+        venv_dir = cache.entry_path(key)
+        # Virtualenvs can't be moved, so each is built in place in the cache under a lock
+        held_locks.enter_context(locked(cache.lock_path(key)))
+        if cache.get(key):
+            logger.info("Reusing cached virtualenv with unchanged dependencies.")
+            self.__activate(environ, venv_dir)
+            self.__reinstall_local_packages(lock_path, environ)
+            return venv_dir
+        logger.info("Creating virtualenv to install dependencies.")
+        cache.reserve(key)
+        self.__activate(environ, venv_dir)
         try:
-            sourcedir = re.search(
-                r"SOURCEDIR\s*=\s*([^\s]+)", open(os.path.join(self.working_dir, self.dir, "Makefile")).read()
-            ).group(1)
+            result = metrics.run([sys.executable, "-m", "venv", venv_dir])
+            if result.returncode != 0:
+                raise AletheiaException("Could not create virtualenv.")
+            self.__install_deps(environ)
+        except:  # noqa: E722
+            cache.discard(key)
+            raise
+        cache.commit(key)
+        return venv_dir
+
+    def __configure_runner(self):
+        """Decide how to run Sphinx, and find the source and build directories relative to the docs dir."""
+        makefile_path = os.path.join(self.working_dir, self.dir, "Makefile")
+        makefile = open(makefile_path).read() if os.path.exists(makefile_path) else None
+        if self.runner == "auto":
+            # Makefiles that do anything beyond what sphinx-quickstart's does have to be run
+            self._use_make = bool(
+                makefile
+                and (not STOCK_MAKEFILE_REGEX.search(makefile) or re.search(r"^html\s*:", makefile, re.MULTILINE))
+            )
+        else:
+            self._use_make = self.runner == "make"
+        if makefile is None:
+            if self._use_make:
+                raise AletheiaException(f"Could not find Makefile in {self.dir}.")
+            # Without a Makefile, fall back to sphinx-quickstart's layouts
+            if os.path.exists(os.path.join(self.working_dir, self.dir, "source", "conf.py")):
+                self._sourcedir, self._builddir = "source", "build"
+            else:
+                self._sourcedir, self._builddir = ".", "_build"
+            return
+        try:
+            self._sourcedir = re.search(r"SOURCEDIR\s*=\s*([^\s]+)", makefile).group(1)
         except AttributeError:
             raise AletheiaException("Could not extract SOURCEDIR from Makefile.")
-        sourcedir = os.path.normpath(os.path.join(self.working_dir, self.dir, sourcedir))
+        try:
+            self._builddir = re.search(r"BUILDDIR\s*=\s*([^\s]+)", makefile).group(1)
+        except AttributeError:
+            raise AletheiaException("Could not extract BUILDDIR from Makefile.")
+        options = re.search(r"^SPHINXOPTS\s*\??=[ \t]*(.*)$", makefile, re.MULTILINE)
+        self._sphinx_options = shlex.split(options.group(1)) if options else []
+
+    def __modify_sphinx_theme_settings(self):
+        # Modify the theme to be fully minimal
+        sourcedir = os.path.normpath(os.path.join(self.working_dir, self.dir, self._sourcedir))
         conf_py = os.path.join(sourcedir, "conf.py")
         if not os.path.exists(conf_py):
             raise AletheiaException(f"Could not find conf.py in {sourcedir}.")
@@ -62,61 +262,190 @@ class Plugin:
             flags=re.MULTILINE,
         )
         open(conf_py, "w").write(conf_py_src)
+        return sourcedir
+
+    def __source_files(self, build_path):
+        files = {}
+        for root, dirs, filenames in os.walk(self.working_dir):
+            dirs[:] = [
+                dirname
+                for dirname in dirs
+                if not dirname.startswith(".") and os.path.normpath(os.path.join(root, dirname)) != build_path
+            ]
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                files[os.path.relpath(path, self.working_dir)] = file_digest(path)
+        return files
+
+    def __source_identity(self):
+        """Return the remote and branch of a git checkout, or None for anything else."""
+        if not os.path.exists(os.path.join(self.working_dir, ".git")) or not shutil.which("git"):
+            return None
+        identity = []
+        for args in (["config", "--get", "remote.origin.url"], ["rev-parse", "--abbrev-ref", "HEAD"]):
+            result = metrics.run(
+                ["git"] + args, cwd=self.working_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            )
+            identity.append(result.stdout.decode("utf8").strip() if result.returncode == 0 else None)
+        return identity
+
+    def __link_git_dir(self, workspace):
+        # .git isn't synced, but conf.py may ask git about the checkout (setuptools_scm, git describe, last updated
+        # dates), so the workspace gets a gitfile pointing at the checkout's repository
+        git_path = os.path.join(self.working_dir, ".git")
+        workspace_git_path = os.path.join(workspace, ".git")
+        if os.path.isdir(workspace_git_path):
+            shutil.rmtree(workspace_git_path)
+        elif os.path.lexists(workspace_git_path):
+            os.remove(workspace_git_path)
+        if os.path.isdir(git_path):
+            git_dir = git_path
+        elif os.path.isfile(git_path):
+            # Worktrees and submodules have a gitfile of their own
+            with open(git_path) as ifs:
+                git_dir = os.path.join(self.working_dir, ifs.read().partition(":")[2].strip())
+        else:
+            return
+        with open(workspace_git_path, "w") as ofs:
+            ofs.write(f"gitdir: {os.path.normpath(git_dir)}\n")
+
+    def __sync_workspace(self, workspace, manifest, build_path):
+        """Bring the workspace's copy of the checkout up to date, returning its new manifest and removed files.
+
+        Files that haven't changed are left alone, so Sphinx sees that they're older than its last read of them.
+        """
+        files = self.__source_files(build_path)
+        for rel_path, digest in files.items():
+            if manifest.get(rel_path) != digest:
+                dest = os.path.join(workspace, rel_path)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                copy_file(os.path.join(self.working_dir, rel_path), dest)
+                os.utime(dest)
+        removed = set(manifest) - set(files)
+        for rel_path in removed:
+            try:
+                os.remove(os.path.join(workspace, rel_path))
+            except FileNotFoundError:
+                pass
+        self.__link_git_dir(workspace)
+        return files, removed
+
+    def __in_process_sphinx(self):
+        """Return Sphinx's command line entry point if it's the same Sphinx as the sphinx-build on the PATH."""
+        try:
+            import sphinx
+            from sphinx.cmd.build import main as sphinx_main
+        except ImportError:
+            return None
+        try:
+            version = get_version("sphinx-build", self.config)
+        except ConfigError:
+            return None
+        if version != sphinx.__version__:
+            logger.debug(f"sphinx-build is version {version} but Sphinx {sphinx.__version__} is importable.")
+            return None
+        return sphinx_main
+
+    def __build_in_process(self, sphinx_main, docs_dir, args):
+        logger.info("Running Sphinx build in-process.")
+        # conf.py is free to change the working directory and sys.path, so put them back afterwards
+        cwd, sys_path, modules = os.getcwd(), list(sys.path), set(sys.modules)
+        project_dir = os.path.normpath(
+            os.path.join(docs_dir, os.path.relpath(self.working_dir, os.path.join(self.working_dir, self.dir)))
+        )
+        os.chdir(docs_dir)
+        try:
+            return sphinx_main(args) == 0
+        finally:
+            # Forget the project's own modules, which conf.py or autodoc imported, so that the next project to be
+            # built imports its own rather than reusing these. Modules from the Python installation, such as Sphinx
+            # extensions, are left loaded, as not all of them can be imported twice.
+            project_paths = [project_dir] + [path for path in sys.path if path not in sys_path]
+            for name in set(sys.modules) - modules:
+                module_path = getattr(sys.modules[name], "__file__", None)
+                if module_path and any(is_within(module_path, path) for path in project_paths):
+                    del sys.modules[name]
+            os.chdir(cwd)
+            sys.path[:] = sys_path
+
+    def __build_html(self, docs_dir, wrapper, environ):
+        if self._use_make:
+            logger.info("Running Sphinx build.")
+            return metrics.run(wrapper + ["make", "html"], cwd=docs_dir, env=environ).returncode == 0
+        args = ["-M", "html", self._sourcedir, self._builddir]
+        user_parallel = any(option.startswith("-j") or option.startswith("--jobs") for option in self._sphinx_options)
+        if self.parallel and not user_parallel:
+            args += ["-j", str(self.parallel)]
+        args += self._sphinx_options
+        # Sphinx changes process-wide state while it builds, so it only runs in-process when nothing else is
+        # running and it doesn't need the project's dependencies
+        sphinx_main = None
+        if not (self.use_pipenv or self.use_poetry) and self.config.jobs == 1:
+            sphinx_main = self.__in_process_sphinx()
+        if sphinx_main:
+            command = " ".join(["sphinx-build"] + args)
+            with metrics.span("sphinx-build", "subprocess", command=command, in_process=True):
+                return self.__build_in_process(sphinx_main, docs_dir, args)
+        logger.info("Running Sphinx build.")
+        return metrics.run(wrapper + ["sphinx-build"] + args, cwd=docs_dir, env=environ).returncode == 0
+
+    def __cached_build(self, cache, sourcedir, build_path, wrapper, environ):
+        """Build in a persistent copy of the project, so Sphinx's environment and doctrees carry over between builds
+        and only changed documents are reread. The HTML is then copied to the build directory.
+
+        Sphinx refuses to reuse an environment from a different source directory, so the copy stays where it is.
+        """
+        # Projects are told apart by their conf.py and where they were checked out from, unless given a cache_key
+        project_key = self.cache_key or [
+            file_digest(os.path.join(sourcedir, "conf.py")),
+            self.dir,
+            self.__source_identity(),
+        ]
+        key = make_key("sphinx-build", project_key)
+        workspace = cache.entry_path(key)
+        manifest_path = os.path.join(workspace, BUILD_MANIFEST)
+        workspace_build_path = os.path.join(workspace, os.path.relpath(build_path, self.working_dir))
+        # Held until the output has been copied out, so the cache doesn't evict the workspace while it's in use
+        with locked(cache.lock_path(key)):
+            manifest = None
+            if cache.get(key):
+                try:
+                    with open(manifest_path) as ifs:
+                        manifest = json.load(ifs)
+                    if manifest["version"] != BUILD_MANIFEST_VERSION:
+                        raise ValueError(f"Unsupported manifest version {manifest['version']}")
+                    logger.info("Reusing previous Sphinx build.")
+                    # Until it's rewritten, a missing manifest marks the workspace as half updated
+                    os.remove(manifest_path)
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning(f"Discarding unusable previous Sphinx build - {e}")
+                    manifest = None
+            if not manifest:
+                cache.reserve(key)
+            files, removed = self.__sync_workspace(workspace, (manifest or {}).get("files", {}), build_path)
+            source_prefix = os.path.join(sourcedir, "")
+            if any(os.path.join(self.working_dir, rel_path).startswith(source_prefix) for rel_path in removed):
+                # Sphinx never removes the output of deleted documents
+                logger.info("Documents were removed since the previous Sphinx build, building from scratch.")
+                shutil.rmtree(workspace_build_path, ignore_errors=True)
+            cwd = os.path.join(workspace, self.dir)
+            succeeded = self.__build_html(cwd, wrapper, environ)
+            if not succeeded and manifest:
+                logger.warning("Sphinx build failed starting from the previous build, retrying from scratch.")
+                shutil.rmtree(workspace_build_path, ignore_errors=True)
+                succeeded = self.__build_html(cwd, wrapper, environ)
+            if not succeeded:
+                cache.discard(key)
+                raise AletheiaException("Builder returned non-zero exit code.")
+            with open(manifest_path, "w") as ofs:
+                json.dump(dict(version=BUILD_MANIFEST_VERSION, files=files), ofs)
+            cache.commit(key)
+            # Post-processing rewrites the output in ways Sphinx can't build on, so it works on a copy
+            copytree(os.path.join(workspace_build_path, "html"), os.path.join(build_path, "html"), nonempty_ok=True)
 
     def __clean_html_markup(self, html_dir, mod_time):
         logger.info("Cleaning up HTML markup from Sphinx output.")
-        seen = []
-        for root, dirs, files in os.walk(html_dir):
-            for filename in files:
-                if filename.endswith(".html"):
-                    full_path = os.path.join(root, filename)
-                    rel_path = os.path.relpath(full_path, html_dir)
-                    if rel_path in seen:
-                        continue
-                    doc = BeautifulSoup(open(full_path).read(), "html.parser")
-
-                    # Get rid of permalink anchors
-                    for element in doc.find_all("a", class_="headerlink"):
-                        element.extract()
-
-                    # Munge internal links to remove .html suffix
-                    for element in doc.find_all("a", href=True):
-                        href = urlparse.urlparse(element["href"])
-                        if not href.netloc:
-                            if href.path.endswith(".html"):
-                                new_path = href.path[:-5] + "/"
-                                element["href"] = urlparse.urlunparse(
-                                    (href.scheme, href.netloc, new_path, href.params, href.query, href.fragment)
-                                )
-
-                    # if there's a .html file with the same name as a directory,
-                    # move that file to index.html of the directory
-                    #
-                    # This fits with Hugo's content organization scheme.
-                    base, ext = os.path.splitext(filename)
-                    if base in dirs:
-                        filename = "index.html"
-                        os.rename(full_path, os.path.join(root, base, filename))
-                        full_path = os.path.join(root, base, filename)
-                        rel_path = os.path.relpath(full_path, html_dir)
-
-                    # Because Hugo turns files into paths, if this is not an index
-                    # file, we have modify link paths to point into the parent dir
-                    if filename != "index.html":
-                        for element in doc.find_all("a", href=True):
-                            href = urlparse.urlparse(element["href"])
-                            if not href.netloc and href.path and not href.path.startswith("/"):
-                                new_path = f"../{href.path}"
-                                element["href"] = urlparse.urlunparse(
-                                    (href.scheme, href.netloc, new_path, href.params, href.query, href.fragment)
-                                )
-                    # Given that we're renaming files and os.walk is weird, track
-                    # what files we've seen before
-                    seen.append(rel_path)
-                    open(full_path, "w").write(doc.prettify())
-
-                    # Set mod_time based on source's original mod_time
-                    os.utime(full_path, (mod_time, mod_time))
+        clean_html_dir(html_dir, mod_time, self.concurrency)
 
     def __find_latest_modtime(self):
         mod_time = 0
@@ -133,45 +462,58 @@ class Plugin:
         return mod_time
 
     def run(self):
+        with contextlib.ExitStack() as held_locks:
+            return self.__build(held_locks)
+
+    def __build(self, held_locks):
+        if self.use_pipenv:
+            ensure_dependencies(("pipenv", None))
+        elif self.use_poetry:
+            ensure_dependencies(("poetry", None))
+        else:
+            # Projects with dependencies may bring their own Sphinx
+            ensure_dependencies(("sphinx-build", None))
         environ = dict(os.environ)
 
         if self.use_pipenv or self.use_poetry:
-            logger.info("Creating virtualenv to install dependencies.")
+            lock_path = os.path.join(self.working_dir, "Pipfile.lock" if self.use_pipenv else "poetry.lock")
+            cache = self.virtualenv_cache
             if self.use_pipenv:
-                environ.update(
-                    dict(PIPENV_PIPFILE=os.path.join(self.working_dir, "Pipfile"), PIPENV_IGNORE_VIRTUALENVS="1")
-                )
-                result = subprocess.run(["pipenv", "sync", "--dev"], cwd=self.working_dir, env=environ)
+                environ["PIPENV_PIPFILE"] = os.path.join(self.working_dir, "Pipfile")
+            if cache and os.path.exists(lock_path):
+                self._virtualenv = self.__cached_virtualenv(cache, lock_path, environ, held_locks)
+                self.__activate(environ, self._virtualenv)
             else:
-                result = subprocess.run(["poetry", "install"], cwd=self.working_dir, env=environ)
-            if result.returncode != 0:
-                raise AletheiaException("Builder pre-build returned non-zero exit code.")
+                logger.info("Creating virtualenv to install dependencies.")
+                if self.use_pipenv:
+                    environ["PIPENV_IGNORE_VIRTUALENVS"] = "1"
+                self.__install_deps(environ)
 
         mod_time = self.__find_latest_modtime()
 
-        self.__modify_sphinx_theme_settings()
+        self.__configure_runner()
+        sourcedir = self.__modify_sphinx_theme_settings()
 
-        try:
-            builddir = re.search(
-                r"BUILDDIR\s*=\s*([^\s]+)", open(os.path.join(self.working_dir, self.dir, "Makefile")).read()
-            ).group(1)
-        except AttributeError:
-            raise AletheiaException("Could not extract BUILDDIR from Makefile.")
+        build_path = os.path.normpath(os.path.join(self.working_dir, self.dir, self._builddir))
+        if self.config.devel and os.path.exists(build_path):
+            shutil.rmtree(build_path)
 
-        if self.config.devel and os.path.exists(os.path.join(self.working_dir, self.dir, builddir)):
-            shutil.rmtree(os.path.join(self.working_dir, self.dir, builddir))
-
-        if self.use_pipenv:
+        if self._virtualenv:
+            # The virtualenv's already first on the PATH
+            wrapper = []
+        elif self.use_pipenv:
             wrapper = ["pipenv", "run"]
         elif self.use_poetry:
             wrapper = ["poetry", "run"]
         else:
             wrapper = []
-        logger.info("Running Sphinx build.")
-        result = subprocess.run(wrapper + ["make", "html"], cwd=os.path.join(self.working_dir, self.dir), env=environ)
-        if result.returncode != 0:
+
+        cache = get_cache(self.config, "sphinx")
+        if cache:
+            self.__cached_build(cache, sourcedir, build_path, wrapper, environ)
+        elif not self.__build_html(os.path.join(self.working_dir, self.dir), wrapper, environ):
             raise AletheiaException("Builder returned non-zero exit code.")
-        html_dir = os.path.normpath(os.path.join(self.working_dir, self.dir, builddir, "html"))
+        html_dir = os.path.join(build_path, "html")
         self.__clean_html_markup(html_dir, mod_time)
 
         return html_dir
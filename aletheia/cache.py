@@ -0,0 +1,174 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from . import __version__, metrics
+from .utils import copy_file, copytree, tree_size, try_locked
+
+
+logger = logging.getLogger(__name__)
+
+# Running total size of each cache directory, so committing an entry doesn't have to read every sidecar
+_totals = {}
+_totals_lock = threading.Lock()
+
+
+def make_key(*parts):
+    # Keys are versioned so a new release never reuses output produced by an older plugin implementation
+    payload = json.dumps([__version__, parts], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf8")).hexdigest()
+
+
+def get_cache(config, name):
+    if not config.cache:
+        return None
+    return Cache(os.path.join(os.path.expanduser(config.cache_dir), name), config.cache_size_limit)
+
+
+class Cache:
+    """Persistent store of directory trees keyed by content hash, evicted least-recently-used first.
+
+    Each entry is a directory named after its key plus a sidecar ``<key>.json`` holding its size. An entry only
+    counts as present once its sidecar exists, and the sidecar's mtime records when the entry was last used.
+
+    The sidecars are only all read the first time a process commits to a cache, and again whenever the running
+    total goes over the size limit, so entries other processes commit are counted by the next eviction.
+
+    Entries that are used in place rather than copied out, such as virtualenvs, should be used while holding their
+    ``lock_path()``. Eviction passes over locked entries, and over the entry being committed, even if that leaves the
+    cache over its size limit for a while.
+    """
+
+    def __init__(self, path, size_limit):
+        self.path = path
+        self.size_limit = size_limit
+        os.makedirs(self.path, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def lock_path(self, key):
+        return os.path.join(self.path, f"{key}.lock")
+
+    def _meta_path(self, key):
+        return os.path.join(self.path, f"{key}.json")
+
+    def get(self, key):
+        meta_path = self._meta_path(key)
+        try:
+            os.utime(meta_path)
+        except FileNotFoundError:
+            metrics.count("cache_lookups", cache=os.path.basename(self.path), result="miss")
+            return None
+        metrics.count("cache_lookups", cache=os.path.basename(self.path), result="hit")
+        return self.entry_path(key)
+
+    def put(self, key, src, filename=None):
+        """Store the tree at src under key, or just the file at src as ``filename`` if one is given."""
+        entry_path = self.entry_path(key)
+        staging_dir = tempfile.mkdtemp(prefix=".staging-", dir=self.path)
+        try:
+            if filename:
+                copy_file(src, os.path.join(staging_dir, filename))
+            else:
+                copytree(src, staging_dir, nonempty_ok=True)
+            size = tree_size(staging_dir)
+            try:
+                os.rename(staging_dir, entry_path)
+            except OSError:
+                if self.get(key):
+                    # Another build stored the same output while we were copying
+                    shutil.rmtree(staging_dir)
+                    return entry_path
+                # Left behind by an interrupted build
+                shutil.rmtree(entry_path, ignore_errors=True)
+                os.rename(staging_dir, entry_path)
+        except:  # noqa: E722
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        self.commit(key, size)
+        return entry_path
+
+    def reserve(self, key):
+        """Return an empty directory for key's entry, to be filled in place and then committed.
+
+        For output that can't be moved once it's been created, such as a virtualenv.
+        """
+        self.discard(key)
+        os.makedirs(self.entry_path(key))
+        return self.entry_path(key)
+
+    def commit(self, key, size=None):
+        if size is None:
+            size = tree_size(self.entry_path(key))
+        previous_size = self._entry_size(key) or 0
+        with open(self._meta_path(key), "w") as ofs:
+            json.dump(dict(size=size), ofs)
+        with _totals_lock:
+            if self.path in _totals:
+                _totals[self.path] += size - previous_size
+                over_limit = _totals[self.path] > self.size_limit
+            else:
+                over_limit = True
+        if over_limit:
+            self.evict(keep=key)
+
+    def discard(self, key):
+        size = self._entry_size(key)
+        try:
+            os.remove(self._meta_path(key))
+        except FileNotFoundError:
+            pass
+        else:
+            with _totals_lock:
+                if self.path in _totals and size:
+                    _totals[self.path] -= size
+        shutil.rmtree(self.entry_path(key), ignore_errors=True)
+
+    def _entry_size(self, key):
+        try:
+            with open(self._meta_path(key)) as ifs:
+                return json.load(ifs)["size"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def evict(self, keep=None):
+        entries = []
+        for filename in os.listdir(self.path):
+            key, ext = os.path.splitext(filename)
+            if ext != ".json":
+                continue
+            size = self._entry_size(key)
+            try:
+                mtime = os.stat(self._meta_path(key)).st_mtime
+            except OSError:
+                continue
+            if size is not None:
+                entries.append((mtime, key, size))
+        total = sum(size for _, _, size in entries)
+        for _, key, size in sorted(entries):
+            if total <= self.size_limit:
+                break
+            if key != keep and self._evict_entry(key):
+                total -= size
+        with _totals_lock:
+            _totals[self.path] = total
+
+    def _evict_entry(self, key):
+        lock_path = self.lock_path(key)
+        if os.path.exists(lock_path):
+            with try_locked(lock_path) as acquired:
+                if not acquired:
+                    logger.debug(f"Not evicting {key} from cache {self.path}, as it's in use.")
+                    return False
+                logger.debug(f"Evicting {key} from cache {self.path}.")
+                self.discard(key)
+                return True
+        # Entries that have never been locked are only ever copied out of the cache
+        logger.debug(f"Evicting {key} from cache {self.path}.")
+        self.discard(key)
+        return True
@@ -1,32 +1,81 @@
+import concurrent.futures
 import datetime
 import logging
 import os
 import shutil
-import subprocess
 import tempfile
 from urllib import parse as urlparse
 
-from . import DEFAULTS, exceptions, pipeline
+from . import DEFAULTS, exceptions, metrics, pipeline
 from .sources import git
 from .utils import copytree
 
 logger = logging.getLogger(__name__)
 
 
-def __process_pipeline(path, config, remove_artifacts=False):
+def __discover_dirs(path):
+    # Sort in place so that the walk, and therefore merge order, is deterministic
+    found = []
     for root, dirs, files in os.walk(path):
-        rel_path = os.path.relpath(root, path)
-        if "aletheia.yml" in files:
-            file_path = os.path.join(root, "aletheia.yml")
-            logger.info(f"Processing docs source in {rel_path}.")
-            pipeline_obj = pipeline.Pipeline(file_path, config=config)
-            pipeline_obj.load()
-            pipeline_obj.run()
-            if remove_artifacts:
-                os.remove(file_path)
-                if os.path.exists(os.path.join(root, ".gitignore")):
-                    os.remove(os.path.join(root, ".gitignore"))
-            logger.info(f"Finished processing docs source in {rel_path}.")
+        dirs.sort()
+        found.append(root)
+    return found
+
+
+def __is_nested(path, parent):
+    return path != parent and path.startswith(parent.rstrip(os.sep) + os.sep)
+
+
+def __run_pipeline(pipeline_obj, rel_path):
+    with metrics.span(rel_path, "pipeline"):
+        pipeline_obj.load()
+        return pipeline_obj.run(merge=False)
+
+
+def __process_pipeline(path, config, remove_artifacts=False):
+    # Pipelines are run in waves. A pipeline nested inside another pipeline's directory only runs once its
+    # ancestor has merged, as it would in a top-down walk of the tree. Everything within a wave runs in the
+    # worker pool, and results are merged in walk order so the assembled tree does not depend on timing.
+    candidates = __discover_dirs(path)
+    processed = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(config.jobs, 1)) as executor:
+        while True:
+            pending = [
+                root
+                for root in candidates
+                if root not in processed and os.path.exists(os.path.join(root, "aletheia.yml"))
+            ]
+            wave = [root for root in pending if not any(__is_nested(root, other) for other in pending)]
+            if not wave:
+                break
+
+            futures = []
+            for root in wave:
+                processed.add(root)
+                rel_path = os.path.relpath(root, path)
+                logger.info(f"Processing docs source in {rel_path}.")
+                pipeline_obj = pipeline.Pipeline(os.path.join(root, "aletheia.yml"), config=config, name=rel_path)
+                futures.append((root, pipeline_obj, executor.submit(__run_pipeline, pipeline_obj, rel_path)))
+
+            error = None
+            for root, pipeline_obj, future in futures:
+                rel_path = os.path.relpath(root, path)
+                try:
+                    output_dir = future.result()
+                except Exception as e:
+                    logger.error(f"Error processing docs source in {rel_path}.")
+                    error = error or e
+                    continue
+                if output_dir:
+                    with metrics.span(rel_path, "merge"):
+                        pipeline_obj.merge(output_dir)
+                if remove_artifacts:
+                    os.remove(pipeline_obj.pipeline_file)
+                    if os.path.exists(os.path.join(root, ".gitignore")):
+                        os.remove(os.path.join(root, ".gitignore"))
+                logger.info(f"Finished processing docs source in {rel_path}.")
+            if error:
+                raise error
 
 
 def __local_or_github(path, config):
@@ -62,11 +111,13 @@ def build(target, path=None, preserve=False, remove_artifacts=False, config=DEFA
 
     try:
         working_dir = os.path.join(temp_dir, "aletheia")
-        copytree(path, working_dir)
+        with metrics.span("copy source", "build"):
+            copytree(path, working_dir)
         __process_pipeline(working_dir, remove_artifacts=remove_artifacts, config=config)
         if not os.path.exists(target):
             os.mkdir(target)
-        copytree(working_dir, target, nonempty_ok=config.devel)
+        with metrics.span("copy to target", "build"):
+            copytree(working_dir, target, nonempty_ok=config.devel, link=True)
     except:  # noqa: E722
         if preserve:
             logger.exception(f"Error during build. Preserving build directory in {temp_dir}.")
@@ -102,24 +153,24 @@ def export(path, dest_repo, config=DEFAULTS):
         copytree(os.path.join(export_dir, ".git"), os.path.join(build_dir, ".git"))
 
         # Did anything change?
-        result = subprocess.run(["git", "diff", "--exit-code"], cwd=build_dir)
+        result = metrics.run(["git", "diff", "--exit-code"], cwd=build_dir)
         if result.returncode == 0:
             logger.info("No changes detected.")
             return
 
-        result = subprocess.run(
+        result = metrics.run(
             ["git", "add", "."],
             # env=dict(GIT_TERMINAL_PROMPT='0'),
             cwd=build_dir,
         )
         if result.returncode:
             raise exceptions.AletheiaException("Error updating destination git repo.")
-        result = subprocess.run(
+        result = metrics.run(
             ["git", "commit", "-m", f"Aletheia docs build {datetime.datetime.utcnow()}"], cwd=build_dir
         )
         if result.returncode:
             raise exceptions.AletheiaException("Error committing changes.")
-        result = subprocess.run(["git", "push"], cwd=build_dir)
+        result = metrics.run(["git", "push"], cwd=build_dir)
         if result.returncode:
             raise exceptions.AletheiaException("Error pushing changes.")
     finally:
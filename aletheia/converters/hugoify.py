@@ -9,9 +9,100 @@ from bs4 import BeautifulSoup
 import yaml
 
 from .. import DEFAULTS
-from ..utils import devel_dir
+from ..utils import copy_file, devel_dir, map_in_batches
+
+try:
+    from yaml import CDumper
+except ImportError:
+    CDumper = None
 
 logger = logging.getLogger(__name__)
+ATX_H1_REGEX = re.compile(r"^ {0,3}# +(.*)$")
+SETEXT_H1_REGEX = re.compile(r"^ {0,3}(=)+ *$")
+
+
+def __scan_title(ifs, title):
+    """Read lines up to the first H1, returning its title and the document's lines without the heading."""
+    head = []
+    # Reading line by line gives the same lines as splitting the whole document, as each read ends on a line break
+    for chunk in iter(ifs.readline, ""):
+        chunk_lines = chunk.splitlines()
+        for idx, line in enumerate(chunk_lines):
+            match_obj = ATX_H1_REGEX.match(line)
+            if match_obj:
+                title = match_obj.group(1).strip() or title
+                after = idx + 1
+                rest = chunk_lines[after:]
+                return title, head + chunk_lines[:idx] + rest + ifs.read().splitlines()
+            if SETEXT_H1_REGEX.match(line):
+                if not head and idx == 0:
+                    # An underline with nothing above it has always taken the document's last line as the title
+                    md_lines = chunk_lines + ifs.read().splitlines()
+                    title = md_lines[-1].strip() or title
+                    md_lines.pop(0)
+                    md_lines.pop(-1)
+                    return title, md_lines
+                head.extend(chunk_lines[:idx])
+                title = head.pop().strip() or title
+                after = idx + 1
+                rest = chunk_lines[after:]
+                return title, head + rest + ifs.read().splitlines()
+        head.extend(chunk_lines)
+    return title, head
+
+
+def __is_printable_ascii(value):
+    if isinstance(value, str):
+        return all(ord(char) < 128 for char in value) and value.isprintable()
+    if isinstance(value, dict):
+        return all(__is_printable_ascii(key) and __is_printable_ascii(item) for key, item in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return all(__is_printable_ascii(item) for item in value)
+    return True
+
+
+def dump_yaml(metadata):
+    # libyaml folds escaped strings at different points to the pure Python emitter, so only hand it plain text
+    if CDumper and __is_printable_ascii(metadata):
+        return yaml.dump(metadata, Dumper=CDumper)
+    return yaml.dump(metadata)
+
+
+def extract_title(base, ifs, filename_as_title=False):
+    # If we don't find a title, use the base as it
+    title = base
+
+    if filename_as_title and base != "_index":
+        content = ifs.read()
+    else:
+        # Scan the md_content line by line for an H1 to use as the title
+        title, md_lines = __scan_title(ifs, title)
+        content = "\n".join(md_lines)
+
+    # Only titles that could contain markup or entities need parsing
+    if "<" in title or "&" in title:
+        bs = BeautifulSoup(title, "html.parser")
+        title = " ".join([node.string for node in bs.find_all(text=True)])
+    return title, content
+
+
+def hugoify_file(input_path, output_path, base, filename_as_title, frontmatter, weight):
+    """Convert one Markdown file, returning its modification time."""
+    mtime = os.stat(input_path).st_mtime
+    with open(input_path) as ifs:
+        title, html_content = extract_title(base, ifs, filename_as_title)
+    metadata = dict(title=title, date=datetime.datetime.fromtimestamp(mtime))
+    metadata.update(frontmatter)
+    if base == "index":
+        metadata["weight"] = weight
+    with open(output_path, "w") as ofs:
+        ofs.writelines(["---\n", dump_yaml(metadata), "---\n", html_content])
+    os.utime(output_path, (mtime, mtime))
+    return mtime
+
+
+def hugoify_batch(args):
+    return [hugoify_file(*file_args) for file_args in args]
 
 
 class Plugin:
@@ -24,6 +115,7 @@ class Plugin:
         index_title=None,
         filename_as_title=False,
         frontmatter=None,
+        concurrency=None,
         **kwargs,
     ):
         self.working_dir = working_dir
@@ -32,6 +124,7 @@ class Plugin:
         self.add_index = add_index
         self.index_title = index_title
         self.frontmatter = frontmatter or {}
+        self.concurrency = concurrency or os.cpu_count() or 1
         self._tempdir = None
         self.config = config
 
@@ -51,67 +144,24 @@ class Plugin:
             except:  # noqa: E722
                 logger.exception("Error cleaning up Hugoify plugin.")
 
-    def get_mtime(self, input_path):
-        input_stat = os.stat(input_path)
-        return datetime.datetime.fromtimestamp(input_stat.st_mtime)
-
-    ATX_H1_REGEX = re.compile(r"^ {0,3}# +(.*)$")
-    SETEXT_H1_REGEX = re.compile(r"^ {0,3}(=)+ *$")
-
-    def extract_title(self, base, md_content):
-        # If we don't find a title, use the base as it
-        title = base
-
-        if self.filename_as_title and base != "_index":
-            content = md_content
-        else:
-            # Scan the md_content line by line for an H1 to use as the title
-            md_lines = md_content.splitlines()
-            for idx, line in enumerate(md_lines):
-                match_obj = self.ATX_H1_REGEX.match(line)
-                if match_obj:
-                    title = match_obj.group(1).strip() or title
-                    md_lines.pop(idx)
-                    break
-                else:
-                    if self.SETEXT_H1_REGEX.match(line):
-                        title = md_lines[idx - 1].strip() or title
-                        md_lines.pop(idx)
-                        md_lines.pop(idx - 1)
-                        break
-            content = "\n".join(md_lines)
-
-        bs = BeautifulSoup(title, "html.parser")
-        title = " ".join([node.string for node in bs.find_all(text=True)])
-        return title, content
-
     def run(self):
-        max_timestamp = 0.0
-        for root, dirs, files in os.walk(self.working_dir):
-            for filename in files:
+        files = []
+        for root, dirs, filenames in os.walk(self.working_dir):
+            for filename in filenames:
                 input_path = os.path.join(root, filename)
                 rel_path = os.path.relpath(root, self.working_dir)
                 os.makedirs(os.path.join(self.output_dir, rel_path), exist_ok=True)
                 base, ext = os.path.splitext(filename)
                 if ext == ".md":
-                    max_timestamp = max(max_timestamp, os.stat(input_path).st_mtime)
                     output_filename = "_index.md" if base == "index" else f"{base}.md"
                     output_path = os.path.join(self.output_dir, rel_path, output_filename)
-                    with open(input_path) as ifs:
-                        with open(output_path, "w") as ofs:
-                            md_content = ifs.read()
-                            mtime = self.get_mtime(input_path)
-                            title, html_content = self.extract_title(base, md_content)
-                            metadata = dict(title=title, date=mtime)
-                            metadata.update(self.frontmatter)
-                            if base == "index":
-                                metadata["weight"] = self.weight
-
-                            ofs.writelines(["---\n", yaml.dump(metadata), "---\n", html_content])
-                    os.utime(output_path, (os.stat(input_path).st_mtime, os.stat(input_path).st_mtime))
+                    files.append(
+                        (input_path, output_path, base, self.filename_as_title, self.frontmatter, self.weight)
+                    )
                 else:
                     output_path = os.path.join(self.output_dir, rel_path, filename)
-                    shutil.copy2(input_path, output_path)
+                    copy_file(input_path, output_path)
+        max_timestamp = max([0.0] + map_in_batches(hugoify_batch, files, self.concurrency))
         if self.add_index:
             index_path = os.path.join(self.output_dir, "_index.md")
             if os.path.exists(index_path):
@@ -121,6 +171,6 @@ class Plugin:
                     title=self.index_title, date=datetime.datetime.fromtimestamp(max_timestamp), weight=self.weight
                 )
                 with open(index_path, "w") as ofs:
-                    ofs.writelines(["---\n", yaml.dump(metadata), "---\n"])
+                    ofs.writelines(["---\n", dump_yaml(metadata), "---\n"])
                 os.utime(index_path, (max_timestamp, max_timestamp))
         return self.output_dir
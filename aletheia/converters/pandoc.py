@@ -1,29 +1,138 @@
+import base64
+import concurrent.futures
+import json
 import logging
 import os
 import shutil
+import socket
 import subprocess
 import tempfile
+import time
+from urllib import error as urlerror, request as urlrequest
 
-from .. import DEFAULTS
-from ..utils import ensure_dependencies, devel_dir
-from ..exceptions import AletheiaException
+from .. import DEFAULTS, metrics
+from ..cache import get_cache, make_key
+from ..utils import copy_file, devel_dir, ensure_dependencies, file_digest, get_version
+from ..exceptions import AletheiaException, ConfigError
 
 
 logger = logging.getLogger(__name__)
-ensure_dependencies(("pandoc", None))
 FILE_EXTENSION_MAP = {
     "html": [".html", ".htm"],
 }
+# Formats pandoc server expects to receive base64-encoded
+BINARY_FORMATS = {"docx", "epub", "odt", "pptx", "xlsx"}
+SERVER_MIN_MAJOR_VERSION = 3
+
+
+class ServerUnavailable(AletheiaException):
+    pass
+
+
+class PandocServer:
+    """A long-lived ``pandoc server`` process that documents are streamed through over HTTP.
+
+    Only one process is started; pandoc server handles concurrent requests itself.
+    """
+
+    def __init__(self, config=DEFAULTS, startup_timeout=10, request_timeout=120):
+        self.config = config
+        self.startup_timeout = startup_timeout
+        self.request_timeout = request_timeout
+        self.process = None
+        self.url = None
+        self.available = False
+
+    def start(self):
+        version = get_version("pandoc", self.config)
+        # pandoc versions aren't semver (e.g. 3.1.11.1), so just compare the major version
+        if not version or int(version.split(".")[0]) < SERVER_MIN_MAJOR_VERSION:
+            raise ServerUnavailable(f"pandoc server needs pandoc {SERVER_MIN_MAJOR_VERSION}+, found {version}.")
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        self.process = subprocess.Popen(
+            ["pandoc", "server", "--port", str(port), "--timeout", str(self.request_timeout)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        self.url = f"http://127.0.0.1:{port}/"
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise ServerUnavailable(f"pandoc server exited with {self.process.returncode}.")
+            try:
+                with urlrequest.urlopen(f"{self.url}version", timeout=1):
+                    self.available = True
+                    return
+            except OSError:
+                time.sleep(0.05)
+        self.stop()
+        raise ServerUnavailable("Timed out waiting for pandoc server to start.")
+
+    def stop(self):
+        self.available = False
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+
+    def convert(self, input_path, output_path, from_format):
+        with open(input_path, "rb") as ifs:
+            content = ifs.read()
+        text = base64.b64encode(content).decode("ascii") if from_format in BINARY_FORMATS else content.decode("utf8")
+        params = {"text": text, "from": from_format, "to": "commonmark", "standalone": True}
+        req = urlrequest.Request(
+            self.url,
+            data=json.dumps(params).encode("utf8"),
+            headers={"Content-Type": "application/json", "Accept": "application/json"},
+        )
+        try:
+            with metrics.span("pandoc", "subprocess", command=f"pandoc server: {input_path}"):
+                with urlrequest.urlopen(req, timeout=self.request_timeout) as response:
+                    result = json.load(response)
+        except urlerror.HTTPError as e:
+            raise AletheiaException(f"Error during pandoc conversion to Markdown: {e.read().decode('utf8')}")
+        except (OSError, ValueError) as e:
+            self.available = False
+            raise ServerUnavailable(f"Error communicating with pandoc server: {e}")
+        if "error" in result:
+            raise AletheiaException(f"Error during pandoc conversion to Markdown: {result['error']}")
+        output = base64.b64decode(result["output"]) if result.get("base64") else result["output"].encode("utf8")
+        with open(output_path, "wb") as ofs:
+            ofs.write(output)
 
 
 class Plugin:
-    def __init__(self, working_dir, config=DEFAULTS, format="docx", file_extensions=None, metadata=None, **kwargs):
+    # External tools whose version the stage cache keys on
+    TOOLS = ("pandoc",)
+
+    def __init__(
+        self,
+        working_dir,
+        config=DEFAULTS,
+        format="docx",
+        file_extensions=None,
+        metadata=None,
+        concurrency=None,
+        mode="process",
+        **kwargs,
+    ):
         self.working_dir = working_dir
         self.format = format
         self.file_extensions = file_extensions or FILE_EXTENSION_MAP.get(format, ["." + format])
         self._metadata = metadata or {}
+        self.concurrency = concurrency or os.cpu_count() or 1
+        if mode not in ("process", "server"):
+            raise ConfigError(f"Unsupported pandoc mode: {mode}")
+        self.mode = mode
+        self._server = None
         self._tempdir = None
         self.config = config
+        self.cache = get_cache(config, "pandoc")
 
     def cleanup(self):
         if self._tempdir:
@@ -41,8 +150,40 @@ class Plugin:
                 self._tempdir = tempfile.mkdtemp()
         return self._tempdir
 
+    def pandoc(self, input_path, output_path):
+        if self._server and self._server.available:
+            try:
+                return self._server.convert(input_path, output_path, self.format)
+            except ServerUnavailable as e:
+                logger.warning(f"{e} Converting {input_path} with a separate pandoc process.")
+        result = metrics.run(["pandoc", "-s", "-f", self.format, "-t", "commonmark", input_path, "-o", output_path])
+        if result.returncode != 0:
+            raise AletheiaException("Error during pandoc conversion to Markdown.")
+
+    def convert(self, input_path, output_path):
+        # Converted documents are kept in a manifest keyed on everything that determines pandoc's output
+        cache_key = self.cache and make_key(
+            "pandoc", file_digest(input_path), self.format, get_version("pandoc", self.config)
+        )
+        entry_path = cache_key and self.cache.get(cache_key)
+        if entry_path:
+            logger.debug("Reusing previous conversion of %s", input_path)
+            copy_file(os.path.join(entry_path, "output.md"), output_path)
+        else:
+            logger.debug("Converting %s", input_path)
+            self.pandoc(input_path, output_path)
+            if cache_key:
+                try:
+                    self.cache.put(cache_key, output_path, filename="output.md")
+                except OSError:
+                    logger.warning(f"Could not store conversion of {input_path} in cache.", exc_info=True)
+        modtime = os.stat(input_path).st_mtime
+        os.utime(output_path, (modtime, modtime))
+
     def run(self):
+        ensure_dependencies(("pandoc", None))
         logger.info(f"Converting files from {self.format} to Markdown using Pandoc.")
+        conversions = []
         for root, dirs, files in os.walk(self.working_dir):
             for filename in files:
                 logger.debug("Filename: %s", filename)
@@ -52,14 +193,23 @@ class Plugin:
                 base, ext = os.path.splitext(filename)
                 if ext in self.file_extensions:
                     output_path = os.path.join(self.output_dir, rel_path, f"{base}.md")
-                    result = subprocess.run(
-                        ["pandoc", "-s", "-f", self.format, "-t", "commonmark", input_path, "-o", output_path]
-                    )
-                    if result.returncode != 0:
-                        raise AletheiaException("Error during pandoc conversion to Markdown.")
-                    modtime = os.stat(input_path).st_mtime
-                    os.utime(output_path, (modtime, modtime))
+                    conversions.append((input_path, output_path))
                 else:
                     output_path = os.path.join(self.output_dir, rel_path, filename)
                     shutil.copy2(input_path, output_path)
+        if conversions and self.mode == "server":
+            self._server = PandocServer(self.config)
+            try:
+                self._server.start()
+            except ServerUnavailable as e:
+                logger.warning(f"{e} Falling back to a pandoc process per file.")
+                self._server = None
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                for future in [metrics.submit(executor, self.convert, *paths) for paths in conversions]:
+                    future.result()
+        finally:
+            if self._server:
+                self._server.stop()
+                self._server = None
         return self.output_dir
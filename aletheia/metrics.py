@@ -0,0 +1,361 @@
+"""Timings and counters for a build, written out as a JSON report, a Prometheus textfile or a Chrome trace.
+
+Code marks what it's doing with ``span()`` and ``count()``. Nothing is recorded unless recording has been started, so
+outside of a recorded build they cost next to nothing.
+"""
+import collections
+import contextlib
+import datetime
+import itertools
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+REPORT_VERSION = 1
+
+_recorder = None
+# The innermost open span of each thread
+_local = threading.local()
+
+
+def cpu_time():
+    # Includes child processes once they've exited, so that tools and worker pools are accounted for
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def tree_stats(path):
+    files = size = 0
+    for root, dirs, filenames in os.walk(path):
+        for filename in filenames:
+            files += 1
+            size += os.lstat(os.path.join(root, filename)).st_size
+    return files, size
+
+
+class Span:
+    def __init__(self, span_id, name, category, parent, args):
+        self.id = span_id
+        self.name = name
+        self.category = category
+        self.parent = parent and parent.id
+        self.args = dict(args)
+        self.counters = collections.Counter()
+        self.status = "ok"
+        self.thread = threading.get_ident()
+        self.thread_name = threading.current_thread().name
+        self.start = time.perf_counter()
+        self.end = None
+        self.cpu = cpu_time()
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def set_tree_stats(self, path, direction):
+        files, size = tree_stats(path)
+        self.set(**{f"files_{direction}": files, f"bytes_{direction}": size})
+
+    def finish(self):
+        self.end = time.perf_counter()
+        self.cpu = cpu_time() - self.cpu
+
+    @property
+    def wall(self):
+        return self.end - self.start
+
+
+class Recorder:
+    """Collects the spans and counters of one build.
+
+    CPU times are the whole process's, so those of spans that ran concurrently (with ``--jobs``) overlap.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.origin = time.perf_counter()
+        self.cpu = cpu_time()
+        self.end = None
+        self.spans = []
+        self.counters = collections.Counter()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        with self._lock:
+            span_id = next(self._ids)
+        parent = current_span()
+        span = Span(span_id, name, category, parent, args)
+        _local.span = span
+        try:
+            yield span
+        except BaseException:
+            span.status = "error"
+            raise
+        finally:
+            span.finish()
+            _local.span = parent
+            with self._lock:
+                self.spans.append(span)
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] += value
+        span = current_span()
+        if span:
+            span.counters[key] += value
+
+    def finish(self):
+        self.end = time.perf_counter()
+        self.cpu = cpu_time() - self.cpu
+
+    def __span_dict(self, span, descendants):
+        counters = collections.Counter(span.counters)
+        for descendant in descendants:
+            counters.update(descendant.counters)
+        return dict(
+            name=span.name,
+            status=span.status,
+            start=span.start - self.origin,
+            wall=span.wall,
+            cpu=span.cpu,
+            subprocesses=summarize_subprocesses(descendants),
+            counters=list_counters(counters),
+            **span.args,
+        )
+
+    def report(self):
+        """Return the report as JSON-serializable data.
+
+        Pipelines are listed slowest first, each with its stages in order. Stage cache lookups and subprocesses
+        are rolled up into the stage they were made from.
+        """
+        spans = sorted(self.spans, key=lambda span: span.start)
+        children = collections.defaultdict(list)
+        for span in spans:
+            children[span.parent].append(span)
+
+        def descendants(span):
+            for child in children[span.id]:
+                yield child
+                yield from descendants(child)
+
+        merges = {span.name: span for span in spans if span.category == "merge"}
+        pipelines = []
+        for span in spans:
+            if span.category != "pipeline":
+                continue
+            pipeline = self.__span_dict(span, list(descendants(span)))
+            pipeline["merge"] = merges[span.name].wall if span.name in merges else None
+            pipeline["stages"] = [
+                self.__span_dict(stage, list(descendants(stage)))
+                for stage in descendants(span)
+                if stage.category == "stage"
+            ]
+            # Pipeline.run catches a failing stage and carries on with an error page, so the pipeline span itself
+            # finishes fine
+            if any(stage["status"] != "ok" for stage in pipeline["stages"]):
+                pipeline["status"] = "error"
+            pipelines.append(pipeline)
+        # Stages run outside of a pipeline span, by calling Pipeline.run directly
+        orphans = [
+            self.__span_dict(span, list(descendants(span))) for span in children[None] if span.category == "stage"
+        ]
+        if orphans:
+            status = "error" if any(stage["status"] != "ok" for stage in orphans) else "ok"
+            pipelines.append(dict(name="", status=status, start=0.0, wall=None, cpu=None, merge=None, stages=orphans))
+
+        return dict(
+            version=REPORT_VERSION,
+            started=datetime.datetime.utcfromtimestamp(self.started_at).isoformat() + "Z",
+            wall=(self.end or time.perf_counter()) - self.origin,
+            cpu=self.cpu if self.end else cpu_time() - self.cpu,
+            pipelines=sorted(pipelines, key=lambda pipeline: -(pipeline["wall"] or 0.0)),
+            subprocesses=summarize_subprocesses(spans),
+            counters=list_counters(self.counters),
+        )
+
+    def prometheus(self):
+        """Return the report in the Prometheus text exposition format, for node_exporter's textfile collector."""
+        report = self.report()
+        metrics = collections.OrderedDict()
+
+        def add(name, help_text, value, **labels):
+            if value is None:
+                return
+            samples = metrics.setdefault(name, (help_text, []))[1]
+            label_text = ",".join(f'{key}="{escape_label(label)}"' for key, label in sorted(labels.items()))
+            samples.append(f"{name}{{{label_text}}} {float(value)!r}" if labels else f"{name} {float(value)!r}")
+
+        add("aletheia_build_start_time_seconds", "When the build started.", self.started_at)
+        add("aletheia_build_duration_seconds", "Wall time of the build.", report["wall"])
+        add("aletheia_build_cpu_seconds", "CPU time of the build, including child processes.", report["cpu"])
+        for pipeline in report["pipelines"]:
+            name = pipeline["name"]
+            add("aletheia_pipeline_duration_seconds", "Wall time of each pipeline.", pipeline["wall"], pipeline=name)
+            add("aletheia_pipeline_merge_seconds", "Time merging each pipeline.", pipeline["merge"], pipeline=name)
+            add(
+                "aletheia_pipeline_failed", "Whether each pipeline failed.", pipeline["status"] != "ok", pipeline=name
+            )
+            for stage in pipeline["stages"]:
+                labels = dict(pipeline=name, stage=str(stage["index"]), plugin=stage["name"])
+                add("aletheia_stage_duration_seconds", "Wall time of each pipeline stage.", stage["wall"], **labels)
+                add("aletheia_stage_cpu_seconds", "CPU time during each pipeline stage.", stage["cpu"], **labels)
+                for direction in ("in", "out"):
+                    add(
+                        "aletheia_stage_files",
+                        "Files each stage read and wrote.",
+                        stage.get(f"files_{direction}"),
+                        direction=direction,
+                        **labels,
+                    )
+                    add(
+                        "aletheia_stage_bytes",
+                        "Bytes each stage read and wrote.",
+                        stage.get(f"bytes_{direction}"),
+                        direction=direction,
+                        **labels,
+                    )
+                if stage.get("cache"):
+                    add(
+                        "aletheia_stage_cache_hit",
+                        "Whether each stage's output came from the stage cache.",
+                        stage["cache"] == "hit",
+                        **labels,
+                    )
+        for tool, stats in report["subprocesses"].items():
+            add("aletheia_subprocess_calls", "Calls to each external tool.", stats["calls"], tool=tool)
+            add("aletheia_subprocess_seconds", "Wall time spent in each external tool.", stats["wall"], tool=tool)
+        for counter in report["counters"]:
+            add(f"aletheia_{counter['name']}", f"Count of {counter['name']}.", counter["value"], **counter["labels"])
+
+        lines = []
+        for name, (help_text, samples) in metrics.items():
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} gauge"] + samples)
+        return "\n".join(lines) + "\n"
+
+    def trace(self):
+        """Return the spans as Chrome trace events, for chrome://tracing or Perfetto."""
+        pid = os.getpid()
+        events = [
+            dict(name="thread_name", ph="M", pid=pid, tid=thread, args=dict(name=thread_name))
+            for thread, thread_name in {span.thread: span.thread_name for span in self.spans}.items()
+        ]
+        for span in sorted(self.spans, key=lambda span: span.start):
+            args = dict(span.args, status=span.status, cpu=span.cpu)
+            events.append(
+                dict(
+                    name=span.name,
+                    cat=span.category,
+                    ph="X",
+                    ts=(span.start - self.origin) * 1e6,
+                    dur=span.wall * 1e6,
+                    pid=pid,
+                    tid=span.thread,
+                    args=args,
+                )
+            )
+        return dict(traceEvents=events, displayTimeUnit="ms")
+
+    def save(self, config):
+        """Write out each of the outputs the config asks for."""
+        outputs = [
+            (config.report, lambda: json.dumps(self.report(), indent=2, default=str)),
+            (config.prometheus_textfile, self.prometheus),
+            (config.trace, lambda: json.dumps(self.trace(), default=str)),
+        ]
+        for path, render in outputs:
+            if not path:
+                continue
+            path = os.path.expanduser(path)
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                # Written to the side and renamed into place, as the textfile collector may read it at any time
+                with open(f"{path}.tmp", "w") as ofs:
+                    ofs.write(render())
+                os.replace(f"{path}.tmp", path)
+                logger.info(f"Wrote build metrics to {path}.")
+            except OSError:
+                logger.warning(f"Could not write build metrics to {path}.", exc_info=True)
+
+
+def summarize_subprocesses(spans):
+    subprocesses = collections.defaultdict(lambda: dict(calls=0, wall=0.0))
+    for span in spans:
+        if span.category == "subprocess":
+            subprocesses[span.name]["calls"] += 1
+            subprocesses[span.name]["wall"] += span.wall
+    return dict(subprocesses)
+
+
+def list_counters(counters):
+    return [dict(name=name, labels=dict(labels), value=value) for (name, labels), value in counters.items()]
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def current_span():
+    return getattr(_local, "span", None)
+
+
+def start_recording():
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+
+def stop_recording():
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder:
+        recorder.finish()
+    return recorder
+
+
+def recording():
+    return _recorder is not None
+
+
+@contextlib.contextmanager
+def span(name, category, **args):
+    """Time the block as a span, yielding it so more can be set on it, or yielding None when not recording."""
+    recorder = _recorder
+    if recorder is None:
+        yield None
+        return
+    with recorder.span(name, category, **args) as current:
+        yield current
+
+
+def count(name, value=1, **labels):
+    recorder = _recorder
+    if recorder is not None:
+        recorder.count(name, value, **labels)
+
+
+def run(args, **kwargs):
+    """Call subprocess.run, timing it as a span named after the executable."""
+    with span(os.path.basename(str(args[0])), "subprocess", command=" ".join(str(arg) for arg in args)):
+        return subprocess.run(args, **kwargs)
+
+
+def __run_in_span(parent, fn, *args, **kwargs):
+    previous = current_span()
+    _local.span = parent
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _local.span = previous
+
+
+def submit(executor, fn, *args, **kwargs):
+    """Submit to a thread pool so that spans the task records count towards the span that submitted it."""
+    return executor.submit(__run_in_span, current_span(), fn, *args, **kwargs)
@@ -2,6 +2,7 @@ import atexit
 import io
 import logging
 import os
+import shutil
 import sys
 import tempfile
 import traceback
@@ -9,35 +10,50 @@ import traceback
 import jinja2
 import yaml
 
-from . import DEFAULTS
-from .builders import sphinx, plantuml
+from . import DEFAULTS, metrics, profiling
+from .cache import get_cache, make_key
 from .exceptions import ConfigError
-from .converters import pandoc, hugoify, subdir, noop
-from .sources import confluence, git, googledrive, local, empty
-from .utils import copytree
+from .registry import PluginRegistry
+from .utils import copytree, fingerprint_tree, get_version
 
 
 logger = logging.getLogger(__name__)
-PLUGINS = {
-    "confluence": confluence.Source,
-    "sphinx": sphinx.Plugin,
-    "pandoc": pandoc.Plugin,
-    "github": git.Source,
-    "git": git.Source,
-    "googledrive": googledrive.Source,
-    "hugoify": hugoify.Plugin,
-    "local": local.Source,
-    "subdir": subdir.Plugin,
-    "empty": empty.Source,
-    "noop": noop.Plugin,
-    "plantuml": plantuml.Plugin,
-}
+# Plugins are only imported once a pipeline uses them
+PLUGINS = PluginRegistry(
+    {
+        "confluence": "aletheia.sources.confluence:Source",
+        "sphinx": "aletheia.builders.sphinx:Plugin",
+        "pandoc": "aletheia.converters.pandoc:Plugin",
+        "github": "aletheia.sources.git:Source",
+        "git": "aletheia.sources.git:Source",
+        "googledrive": "aletheia.sources.googledrive:Source",
+        "hugoify": "aletheia.converters.hugoify:Plugin",
+        "local": "aletheia.sources.local:Source",
+        "subdir": "aletheia.converters.subdir:Plugin",
+        "empty": "aletheia.sources.empty:Source",
+        "noop": "aletheia.converters.noop:Plugin",
+        "plantuml": "aletheia.builders.plantuml:Plugin",
+    }
+)
+
+
+def tool_versions(plugin_cls, config):
+    """Return the version of each external tool a plugin declares it runs in its TOOLS."""
+    versions = {}
+    for tool in getattr(plugin_cls, "TOOLS", ()):
+        try:
+            versions[tool] = get_version(tool, config)
+        except ConfigError:
+            # The stage will say so itself when it runs
+            versions[tool] = None
+    return versions
 
 
 class Pipeline:
-    def __init__(self, pipeline_file, config=DEFAULTS):
+    def __init__(self, pipeline_file, config=DEFAULTS, name=None):
         self.pipeline_file = pipeline_file
         self.target_dir = os.path.dirname(self.pipeline_file)
+        self.name = name or os.path.basename(self.target_dir)
         self.pipeline = []
         self.config = config
 
@@ -53,33 +69,87 @@ class Pipeline:
                 plugin_name = next(key for key in stage if key in PLUGINS)
             except StopIteration:
                 raise ConfigError(f"Could not find valid plugin in pipeline stage {i}")
-            self.pipeline.append((plugin_name, PLUGINS[plugin_name], stage[plugin_name]))
+            self.pipeline.append((plugin_name, PLUGINS[plugin_name], stage[plugin_name], bool(stage.get("profile"))))
 
     def run(self, merge=True):
         args = ()
         output_dir = None
-        for plugin_name, plugin_cls, kwargs in self.pipeline:
-            plugin_instance = plugin_cls(*args, config=self.config, **kwargs)
-            if not self.config.devel:
-                atexit.register(plugin_instance.cleanup)
-            try:
-                output_dir = plugin_instance.run()
-            except Exception:
-                logger.exception("Pipeline plugin error.")
-                stacktrace = "\n".join(traceback.format_exception(*sys.exc_info()))
-                output_dir = self.capture_build_error(plugin_name, kwargs, stacktrace)
-                break
-            args = (output_dir,)
+        stage_cache = get_cache(self.config, "stages")
+        for index, (plugin_name, plugin_cls, kwargs, profile) in enumerate(self.pipeline):
+            profile = profile or self.config.profile
+            with metrics.span(plugin_name, "stage", index=index) as span:
+                if span and args:
+                    span.set_tree_stats(args[0], "in")
+                # Sources fetch from the outside world, so only stages that transform an input tree are cacheable
+                cache_key = None
+                if stage_cache and args:
+                    cache_key = make_key(
+                        plugin_name, kwargs, tool_versions(plugin_cls, self.config), fingerprint_tree(args[0])
+                    )
+                    # A stage being profiled has to actually run, though its output is still cached
+                    output_dir = None if profile else self.restore_stage(stage_cache, cache_key)
+                    if span:
+                        span.set(cache="hit" if output_dir else "miss")
+                    if output_dir:
+                        logger.info(f"Reusing cached output of {plugin_name} stage.")
+                        args = (output_dir,)
+                        if span:
+                            span.set_tree_stats(output_dir, "out")
+                        continue
+                plugin_instance = plugin_cls(*args, config=self.config, **kwargs)
+                if not self.config.devel:
+                    atexit.register(plugin_instance.cleanup)
+                try:
+                    if profile:
+                        with profiling.profiled(
+                            self.config, f"{plugin_name} stage of {self.name}", self.name, index, plugin_name
+                        ) as stage_profile:
+                            output_dir = plugin_instance.run()
+                        if span:
+                            span.set(peak_memory=stage_profile.peak)
+                    else:
+                        output_dir = plugin_instance.run()
+                except Exception:
+                    logger.exception("Pipeline plugin error.")
+                    if span:
+                        span.status = "error"
+                    stacktrace = "\n".join(traceback.format_exception(*sys.exc_info()))
+                    output_dir = self.capture_build_error(plugin_name, kwargs, stacktrace)
+                    break
+                if span:
+                    span.set_tree_stats(output_dir, "out")
+                if cache_key:
+                    try:
+                        stage_cache.put(cache_key, output_dir)
+                    except OSError:
+                        logger.warning(f"Could not store output of {plugin_name} stage in cache.", exc_info=True)
+                args = (output_dir,)
         if merge and output_dir:
             self.merge(output_dir)
             return self.target_dir
         else:
             return output_dir
 
+    def restore_stage(self, stage_cache, cache_key):
+        entry_path = stage_cache.get(cache_key)
+        if not entry_path:
+            return None
+        # Later stages may modify their input in place, so hand them a copy rather than the cache entry itself
+        tempdir = tempfile.mkdtemp()
+        try:
+            copytree(entry_path, tempdir, nonempty_ok=True)
+        except OSError:
+            logger.warning("Could not restore stage output from cache.", exc_info=True)
+            shutil.rmtree(tempdir, ignore_errors=True)
+            return None
+        if not self.config.devel:
+            atexit.register(shutil.rmtree, tempdir, ignore_errors=True)
+        return tempdir
+
     def capture_build_error(self, plugin_name, plugin_params, stacktrace):
         plugin_info = io.StringIO()
         source_info = io.StringIO()
-        source_name, _, source_params = self.pipeline[0]
+        source_name, _, source_params, _ = self.pipeline[0]
         yaml.safe_dump({plugin_name: plugin_params}, plugin_info)
         yaml.safe_dump({source_name: source_params}, source_info)
         context = dict(
@@ -100,4 +170,5 @@ class Pipeline:
         return tempdir
 
     def merge(self, output_dir):
-        copytree(output_dir, self.target_dir, nonempty_ok=True)
+        # Plugin output is throwaway, so it can be linked rather than copied into place
+        copytree(output_dir, self.target_dir, nonempty_ok=True, link=True)
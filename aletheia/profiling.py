@@ -0,0 +1,132 @@
+"""Profiles of pipeline stages, taken with cProfile and tracemalloc.
+
+Each profiled stage writes a ``.pstats`` file and a tracemalloc snapshot, and ``log_summary()`` logs the hottest
+functions across every stage profiled so far.
+"""
+import contextlib
+import cProfile
+import io
+import logging
+import os
+import pstats
+import re
+import threading
+import tracemalloc
+
+
+logger = logging.getLogger(__name__)
+
+_profiles = []
+_lock = threading.Lock()
+_tracing = 0
+_started_tracing = False
+
+
+class StageProfile:
+    def __init__(self, name, path):
+        self.name = name
+        # Without the extension; the profile and the memory snapshot are written next to each other
+        self.path = path
+        self.peak = None
+        self.profiled = False
+
+    @property
+    def stats_path(self):
+        return f"{self.path}.pstats"
+
+    @property
+    def snapshot_path(self):
+        return f"{self.path}.tracemalloc"
+
+
+def profile_dir(config):
+    if config.profile_dir:
+        return os.path.expanduser(config.profile_dir)
+    if config.report:
+        return os.path.join(os.path.dirname(os.path.abspath(os.path.expanduser(config.report))), "profiles")
+    return os.path.abspath("aletheia-profiles")
+
+
+def filename(*parts):
+    return "--".join(re.sub(r"[^\w.-]+", "_", str(part)).strip("._") or "root" for part in parts)
+
+
+def __start_tracing():
+    global _tracing, _started_tracing
+    with _lock:
+        if not _tracing and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        _tracing += 1
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+
+def __stop_tracing():
+    global _tracing, _started_tracing
+    with _lock:
+        _tracing -= 1
+        # Leave tracing alone if something else had already started it
+        if not _tracing and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+@contextlib.contextmanager
+def profiled(config, name, *parts):
+    """Profile the block, yielding a StageProfile whose peak memory is filled in once the block exits.
+
+    cProfile only sees the thread that runs the block, so work a plugin hands to its own threads or processes shows
+    up as time spent waiting on them. Memory is traced across the whole process, so stages that run concurrently
+    (with ``--jobs``) share a peak.
+    """
+    directory = profile_dir(config)
+    os.makedirs(directory, exist_ok=True)
+    profile = StageProfile(name, os.path.join(directory, filename(*parts)))
+    __start_tracing()
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Only one profiler can be active at a time from Python 3.12, so concurrent stages can't all be profiled
+        logger.warning(f"Could not profile {name} while another stage is being profiled.")
+        profiler = None
+    try:
+        yield profile
+    finally:
+        if profiler:
+            profiler.disable()
+        profile.peak = tracemalloc.get_traced_memory()[1]
+        snapshot = tracemalloc.take_snapshot()
+        __stop_tracing()
+        try:
+            snapshot.dump(profile.snapshot_path)
+            if profiler:
+                profiler.dump_stats(profile.stats_path)
+                profile.profiled = True
+            logger.info(f"Profiled {name}, peak traced memory {profile.peak / 2 ** 20:.1f} MiB, in {profile.path}.*")
+        except OSError:
+            logger.warning(f"Could not write profile of {name} to {directory}.", exc_info=True)
+        with _lock:
+            _profiles.append(profile)
+
+
+def log_summary(top=20):
+    """Log the hottest functions and peak memory of every stage profiled since the last summary."""
+    with _lock:
+        profiles = list(_profiles)
+        _profiles.clear()
+    if not profiles:
+        return
+
+    peaks = sorted(profiles, key=lambda profile: -(profile.peak or 0))
+    lines = [f"Peak traced memory of {len(profiles)} profiled stages:"]
+    lines.extend(f"  {profile.peak / 2 ** 20:10.1f} MiB  {profile.name}" for profile in peaks)
+    stats_paths = [profile.stats_path for profile in profiles if profile.profiled]
+    if stats_paths:
+        stream = io.StringIO()
+        stats = pstats.Stats(*stats_paths, stream=stream)
+        stats.strip_dirs().sort_stats("tottime").print_stats(top)
+        lines.append(f"Hottest functions across {len(stats_paths)} profiled stages:")
+        lines.append(stream.getvalue().strip("\n"))
+    logger.info("\n".join(lines))
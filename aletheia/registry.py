@@ -0,0 +1,97 @@
+import collections.abc
+import importlib
+import logging
+import threading
+
+from .exceptions import ConfigError
+
+try:
+    from importlib import metadata as importlib_metadata
+except ImportError:
+    # Python < 3.8
+    try:
+        import importlib_metadata
+    except ImportError:
+        importlib_metadata = None
+
+
+logger = logging.getLogger(__name__)
+ENTRY_POINT_GROUP = "aletheia.plugins"
+
+
+def plugin_entry_points():
+    """List the ``(name, module:attribute)`` plugins that installed packages register."""
+    if importlib_metadata:
+        entry_points = importlib_metadata.entry_points()
+        if hasattr(entry_points, "select"):
+            entry_points = entry_points.select(group=ENTRY_POINT_GROUP)
+        else:
+            entry_points = entry_points.get(ENTRY_POINT_GROUP, [])
+        return [(entry_point.name, entry_point.value) for entry_point in entry_points]
+    try:
+        import pkg_resources
+    except ImportError:
+        logger.warning(
+            f"Neither importlib_metadata nor setuptools is installed, so plugins in {ENTRY_POINT_GROUP} are ignored."
+        )
+        return []
+    return [
+        (entry_point.name, f"{entry_point.module_name}:{'.'.join(entry_point.attrs)}")
+        for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP)
+    ]
+
+
+def import_path(path):
+    """Import the object at a ``module:attribute`` path."""
+    module_name, _, attr_path = path.partition(":")
+    obj = importlib.import_module(module_name)
+    for attr in filter(None, attr_path.split(".")):
+        obj = getattr(obj, attr)
+    return obj
+
+
+class PluginRegistry(collections.abc.Mapping):
+    """Plugin classes by name, each imported the first time it's looked up.
+
+    Names map to ``module:attribute`` import paths: the built-in plugins, plus any that installed packages expose
+    in the ``aletheia.plugins`` entry point group. Built-in plugins can't be overridden.
+    """
+
+    def __init__(self, builtins):
+        self._builtins = dict(builtins)
+        self._paths = None
+        self._plugins = {}
+        self._lock = threading.Lock()
+
+    @property
+    def paths(self):
+        if self._paths is None:
+            paths = {}
+            for name, path in plugin_entry_points():
+                if name in self._builtins:
+                    logger.warning(f"Ignoring plugin {path} registered as built-in {name}.")
+                    continue
+                paths[name] = path
+            paths.update(self._builtins)
+            self._paths = paths
+        return self._paths
+
+    def __getitem__(self, name):
+        path = self.paths[name]
+        with self._lock:
+            if name not in self._plugins:
+                try:
+                    self._plugins[name] = import_path(path)
+                except (ImportError, AttributeError) as e:
+                    raise ConfigError(f"Could not load plugin {name} from {path}: {e}")
+            return self._plugins[name]
+
+    def __contains__(self, name):
+        # Checking for a name mustn't import the plugin
+        return name in self.paths
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
@@ -1,20 +1,27 @@
+import binascii
+import concurrent.futures
 import email.parser
 import email.policy
+import io
+import json
 import logging
 import os
 import re
 import shutil
 import tempfile
+import threading
 import unicodedata
 
 from atlassian.confluence import Confluence
 from bs4 import BeautifulSoup
 
 from .. import DEFAULTS
-from ..exceptions import AletheiaException
-from ..utils import devel_dir
+from ..exceptions import AletheiaException, ConfigError
+from ..transport import get_session
+from ..utils import copytree, devel_dir, locked
 
 logger = logging.getLogger(__name__)
+HTML_PARSER = "lxml"
 
 
 def __get_from_env__(key, default=None, coerce=None):
@@ -29,36 +36,162 @@ def __get_from_env__(key, default=None, coerce=None):
         ) from None
 
 
-def get_client_from_env():
-    client = Confluence(
-        url=__get_from_env__("URL"),
+class ConfluenceClient(Confluence):
+    def get_page_as_word_stream(self, page_id):
+        """Like get_page_as_word, but returns the streaming response rather than reading it into memory."""
+        response = self._session.get(
+            self.url_joiner(self.url, "exportword"),
+            params=dict(pageId=page_id),
+            headers=self.form_token_headers,
+            timeout=self.timeout,
+            verify=self.verify_ssl,
+            proxies=self.proxies,
+            stream=True,
+        )
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return response
+
+    def download(self, link, path):
+        """Stream a download link, relative to the Confluence base URL, into a file."""
+        response = self._session.get(
+            self.url_joiner(self.url, link),
+            timeout=self.timeout,
+            verify=self.verify_ssl,
+            proxies=self.proxies,
+            stream=True,
+        )
+        try:
+            response.raise_for_status()
+            with open(f"{path}.part", "wb") as ofs:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    ofs.write(chunk)
+        finally:
+            response.close()
+        os.replace(f"{path}.part", path)
+
+
+def get_client_from_env(session=None, url=None):
+    client = ConfluenceClient(
+        url=url or __get_from_env__("URL"),
         username=__get_from_env__("API_USERNAME"),
         password=__get_from_env__("API_KEY"),
         cloud=__get_from_env__("CLOUD", default=False, coerce=bool),
+        session=session,
     )
     return client
 
 
-def page_to_html_and_attachments(client, page_id, output_path):
-    rfc822_bytes = client.get_page_as_word(page_id)
-    parser = email.parser.BytesFeedParser(policy=email.policy.default)
-    parser.feed(rfc822_bytes)
-    msg = parser.close()
-    image_src_map = {}
-    html = ""
-    for part in msg.walk():
-        if part.is_multipart():
-            continue
-        if part.get_content_type() == "text/html":
-            html = part.get_content()
+def __parse_headers(header_lines):
+    return email.parser.BytesParser(policy=email.policy.default).parsebytes(b"".join(header_lines), headersonly=True)
+
+
+class _PartWriter:
+    """Decodes one MIME part's body line by line into a file-like sink."""
+
+    def __init__(self, headers, sink):
+        self.encoding = str(headers.get("Content-Transfer-Encoding", "")).lower()
+        self.sink = sink
+        self._base64_remainder = b""
+        self._pending_eol = b""
+
+    def write_line(self, line):
+        content = line.rstrip(b"\r\n")
+        size = len(content)
+        eol = line[size:]
+        if self.encoding == "base64":
+            data = self._base64_remainder + b"".join(content.split())
+            usable = len(data) - len(data) % 4
+            self.sink.write(binascii.a2b_base64(data[:usable]))
+            self._base64_remainder = data[usable:]
+        elif self.encoding == "quoted-printable":
+            # The line break before a boundary belongs to the boundary, so only emit it once more data follows
+            self.sink.write(self._pending_eol)
+            if content.endswith(b"="):
+                self.sink.write(binascii.a2b_qp(content[:-1]))
+                self._pending_eol = b""
+            else:
+                self.sink.write(binascii.a2b_qp(content))
+                self._pending_eol = eol
+        else:
+            self.sink.write(self._pending_eol + content)
+            self._pending_eol = eol
+
+
+def parse_word_export(lines, spill_dir):
+    """Incrementally parse a Confluence Word export, which is a multipart MIME document.
+
+    Every part other than the HTML body is written straight to a file in spill_dir. Returns the HTML and a dict
+    mapping each attachment's content id (the tail of its Content-Location) to the path it was written to.
+    """
+    lines = iter(lines)
+    header_lines = []
+    for line in lines:
+        header_lines.append(line)
+        if not line.strip():
+            break
+    boundary = __parse_headers(header_lines).get_boundary()
+    if not boundary:
+        raise AletheiaException("Confluence Word export is not a multipart document.")
+    delimiter = b"--" + boundary.encode("ascii")
+
+    html = None
+    attachments = {}
+    for line in lines:
+        if line.rstrip() == delimiter:
+            break
+    while True:
+        header_lines = []
+        for line in lines:
+            if not line.strip():
+                break
+            header_lines.append(line)
+        headers = __parse_headers(header_lines + [b"\r\n"])
+        if headers.get_content_type() == "text/html":
+            sink = io.BytesIO()
+        else:
+            content_id = str(headers.get("Content-Location", "")).rsplit("/", 1)[-1]
+            spill_path = os.path.join(spill_dir, str(len(attachments)))
+            sink = open(spill_path, "wb")
+            if content_id:
+                attachments[content_id] = spill_path
+        writer = _PartWriter(headers, sink)
+        last_part = True
+        for line in lines:
+            stripped = line.rstrip()
+            if stripped == delimiter:
+                last_part = False
+                break
+            if stripped == delimiter + b"--":
+                break
+            writer.write_line(line)
+        if isinstance(sink, io.BytesIO):
+            html = sink.getvalue().decode(headers.get_content_charset() or "utf-8", "replace")
         else:
-            content_location = part["Content-Location"]
-            content_id = content_location.rsplit("/", 1)[-1]
-            image_src_map[content_id] = part.get_content()
-    doc = BeautifulSoup(html)
-    # Fix up embedded images
-    for img_src, img_content in image_src_map.items():
-        for tag in doc.find_all(lambda tag: tag.name == "img" and tag.get("src") == img_src):
+            sink.close()
+        if last_part:
+            break
+    return html or "", attachments
+
+
+def page_to_html_and_attachments(client, page_id, output_path):
+    with tempfile.TemporaryDirectory() as spill_dir:
+        response = client.get_page_as_word_stream(page_id)
+        try:
+            html, attachments = parse_word_export(response.raw, spill_dir)
+        finally:
+            response.close()
+        doc = BeautifulSoup(html, HTML_PARSER)
+        # Fix up embedded images and, if this page has subpages, strip the TOC from the outputted HTML
+        written = {}
+        for tag in doc.find_all(["img", "ul"]):
+            if tag.name == "ul":
+                if "childpages-macro" in tag.get("class", []):
+                    tag.extract()
+                continue
+            spill_path = attachments.get(tag.get("src"))
+            if not spill_path:
+                continue
             if "data-linked-resource-default-alias" in tag.attrs:
                 img_filename = tag["data-linked-resource-default-alias"]
                 attrs_to_keep = ["width", "height"]
@@ -66,16 +199,42 @@ def page_to_html_and_attachments(client, page_id, output_path):
                 for attr in attrs:
                     del tag[attr]
                 tag["src"] = img_filename
-                open(os.path.join(output_path, img_filename), "wb").write(img_content)
+                img_path = os.path.join(output_path, img_filename)
+                if spill_path in written:
+                    shutil.copyfile(written[spill_path], img_path)
+                else:
+                    shutil.move(spill_path, img_path)
+                    written[spill_path] = img_path
             else:
                 # Remove media groups - the Word export doesn't have the data for them
                 tag.extract()
-    # If this page has subpages, strip the TOC from the outputted HTML
-    for tag in doc.find_all("ul", "childpages-macro"):
-        tag.extract()
     open(os.path.join(output_path, "index.html"), "w").write(str(doc))
 
 
+def get_child_pages(client, page_id, limit=100):
+    # The same listing as client.get_page_child_by_type, but including each page's version
+    start = 0
+    while True:
+        response = client.get(
+            f"rest/api/content/{page_id}/child/page", params=dict(start=start, limit=limit, expand="version")
+        )
+        child_pages = (response or {}).get("results", [])
+        yield from child_pages
+        if len(child_pages) < limit:
+            break
+        start += limit
+
+
+def get_attachments(client, page_id, limit=100):
+    start = 0
+    while True:
+        attachments = (client.get_attachments_from_content(page_id, start=start, limit=limit) or {}).get("results", [])
+        yield from attachments
+        if len(attachments) < limit:
+            break
+        start += limit
+
+
 def slugify(title):
     title = unicodedata.normalize("NFKD", title).encode("ascii", "ignore").decode("ascii")
     title = re.sub(r"[^\w\s-]", "", title.lower())
@@ -83,10 +242,25 @@ def slugify(title):
 
 
 class Source:
-    def __init__(self, config=DEFAULTS, page_id=""):
+    def __init__(
+        self, config=DEFAULTS, page_id="", max_depth=None, concurrency=4, fetch="word", url=None, **kwargs
+    ):
         self.config = config
         self.page_id = page_id
+        # Defaults to the ATLASSIAN_URL environment variable
+        self.url = url
+        self.max_depth = max_depth
+        self.concurrency = max(int(concurrency), 1)
+        if fetch not in ("word", "export_view"):
+            raise ConfigError(f"Unsupported Confluence fetch mode: {fetch}")
+        self.fetch = fetch
+        self._attachment_executor = None
         self._tempdir = None
+        self._local = threading.local()
+        self._store_dir = None
+        self._previous_pages = {}
+        self._pages = {}
+        self._downloaded = []
 
     @property
     def working_dir(self):
@@ -104,14 +278,156 @@ class Source:
         except:  # noqa: E722
             logger.warning(f"Cleanup failed removing Confluence tempdir {self._tempdir}")
 
+    @property
+    def client(self):
+        # Workers each get their own client, but they all share the pooled, rate limited transport session
+        if not hasattr(self._local, "client"):
+            self._local.client = get_client_from_env(session=get_session(self.config), url=self.url)
+        return self._local.client
+
+    def download_attachment(self, attachment, path):
+        size = attachment.get("extensions", {}).get("fileSize")
+        if os.path.exists(path) and os.path.getsize(path) == size:
+            logger.debug(f"Attachment {attachment['title']} is already downloaded")
+            return
+        self.client.download(attachment["_links"]["download"], path)
+
+    def export_view_to_html_and_attachments(self, page_id, output_path):
+        # A lighter alternative to the Word export: fetch the rendered HTML and only the attachments it uses
+        page = self.client.get_page_by_id(page_id, expand="body.export_view")
+        attachments = {attachment["title"]: attachment for attachment in get_attachments(self.client, page_id)}
+        doc = BeautifulSoup(page["body"]["export_view"]["value"], HTML_PARSER)
+        downloads = {}
+        for tag in doc.find_all(["img", "ul"]):
+            if tag.name == "ul":
+                # If this page has subpages, strip the TOC from the outputted HTML
+                if "childpages-macro" in tag.get("class", []):
+                    tag.extract()
+                continue
+            img_filename = tag.get("data-linked-resource-default-alias")
+            if img_filename not in attachments:
+                continue
+            attrs_to_keep = ["width", "height"]
+            attrs = [str(attr) for attr in tag.attrs if str(attr) not in attrs_to_keep]
+            for attr in attrs:
+                del tag[attr]
+            tag["src"] = img_filename
+            downloads[img_filename] = attachments[img_filename]
+        futures = [
+            self._attachment_executor.submit(self.download_attachment, attachment, os.path.join(output_path, filename))
+            for filename, attachment in downloads.items()
+        ]
+        for future in futures:
+            future.result()
+        open(os.path.join(output_path, "index.html"), "w").write(str(doc))
+        return set(downloads)
+
+    def export_page(self, page_id, output_path):
+        if self.fetch == "export_view":
+            return self.export_view_to_html_and_attachments(page_id, output_path)
+        else:
+            page_to_html_and_attachments(self.client, page_id, output_path)
+
+    @property
+    def store_dir(self):
+        if not self.config.cache:
+            return None
+        # Word and export_view exports of a page differ, so each fetch mode keeps its own store
+        name = re.sub(r"[^\w.-]+", "-", f'{self.url or __get_from_env__("URL")}--{self.page_id}--{self.fetch}')
+        return os.path.join(os.path.expanduser(self.config.cache_dir), "confluence", name)
+
+    def download_page(self, page, rel_dir, depth):
+        version = page["version"]["number"]
+        if self._store_dir:
+            # Pages are stored flat by id and only re-exported when their version changes
+            page_dir = os.path.join(self._store_dir, "pages", page["id"])
+            previous = self._previous_pages.get(page["id"])
+            if previous and previous["version"] == version and os.path.isdir(page_dir):
+                logger.debug(f"Page {page['title']} is unchanged since the last sync")
+            else:
+                logger.info(f"Downloading page {page['title']} from Confluence")
+                staging_dir = tempfile.mkdtemp(prefix=".staging-", dir=os.path.dirname(page_dir))
+                seeded = self.fetch == "export_view" and os.path.isdir(page_dir)
+                if seeded:
+                    # Start from the previous export so that attachments already on disk aren't downloaded again.
+                    # Attachments are replaced rather than written through, so the files can be linked.
+                    copytree(page_dir, staging_dir, nonempty_ok=True, link=True)
+                    os.remove(os.path.join(staging_dir, "index.html"))
+                try:
+                    attachments = self.export_page(page["id"], staging_dir)
+                    if seeded:
+                        # Drop attachments that the page no longer uses, as a fresh export wouldn't have them
+                        for filename in set(os.listdir(staging_dir)) - attachments - {"index.html"}:
+                            os.remove(os.path.join(staging_dir, filename))
+                except:  # noqa: E722
+                    shutil.rmtree(staging_dir, ignore_errors=True)
+                    raise
+                shutil.rmtree(page_dir, ignore_errors=True)
+                os.rename(staging_dir, page_dir)
+                self._downloaded.append(page["id"])
+        else:
+            logger.info(f"Downloading page {page['title']} from Confluence")
+            page_dir = os.path.join(self.working_dir, rel_dir)
+            os.makedirs(page_dir, exist_ok=True)
+            self.export_page(page["id"], page_dir)
+            self._downloaded.append(page["id"])
+        self._pages[page["id"]] = dict(version=version, path=rel_dir)
+        if self.max_depth is not None and depth >= self.max_depth:
+            return []
+        return [
+            (child_page, os.path.normpath(os.path.join(rel_dir, slugify(child_page["title"]))), depth + 1)
+            for child_page in get_child_pages(self.client, page["id"])
+        ]
+
+    def download_tree(self):
+        root_page = self.client.get_page_by_id(self.page_id, expand="version")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = {executor.submit(self.download_page, root_page, ".", 0)}
+            try:
+                while pending:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        for child_page in future.result():
+                            pending.add(executor.submit(self.download_page, *child_page))
+            except:  # noqa: E722
+                for future in pending:
+                    future.cancel()
+                raise
+        logger.info(f"Downloaded {len(self._downloaded)} of {len(self._pages)} pages from Confluence.")
+
+    def sync_store(self):
+        state_path = os.path.join(self._store_dir, "state.json")
+        try:
+            with open(state_path) as ifs:
+                self._previous_pages = json.load(ifs)["pages"]
+        except (OSError, ValueError, KeyError):
+            self._previous_pages = {}
+
+        self.download_tree()
+
+        # Prune pages that were deleted upstream or have moved out of this tree
+        for page_id in os.listdir(os.path.join(self._store_dir, "pages")):
+            if page_id not in self._pages:
+                shutil.rmtree(os.path.join(self._store_dir, "pages", page_id), ignore_errors=True)
+        with open(f"{state_path}.tmp", "w") as ofs:
+            json.dump(dict(pages=self._pages), ofs)
+        os.replace(f"{state_path}.tmp", state_path)
+
+        for page_id, page in sorted(self._pages.items(), key=lambda item: item[1]["path"]):
+            page_dir = os.path.join(self._store_dir, "pages", page_id)
+            copytree(page_dir, os.path.join(self.working_dir, page["path"]), nonempty_ok=True)
+
     def run(self):
-        client = get_client_from_env()
-        logger.info("Downloading main page from Confluence")
-        page_to_html_and_attachments(client, self.page_id, self.working_dir)
-        for child_page in client.get_page_child_by_type(self.page_id, type="page", start=None, limit=None):
-            logger.info(f"Downloading child page {child_page['title']} from Confluence")
-            child_page_dir = os.path.join(self.working_dir, slugify(child_page["title"]))
-            os.makedirs(child_page_dir, exist_ok=True)
-            page_to_html_and_attachments(client, child_page["id"], child_page_dir)
+        self._store_dir = self.store_dir
+        self._attachment_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            if self._store_dir:
+                os.makedirs(os.path.join(self._store_dir, "pages"), exist_ok=True)
+                with locked(f"{self._store_dir}.lock"):
+                    self.sync_store()
+            else:
+                self.download_tree()
+        finally:
+            self._attachment_executor.shutdown()
         logger.info("Confluence download complete.")
         return self.working_dir
@@ -1,17 +1,17 @@
 import logging
 import os
+import re
 import subprocess
 import shutil
 import tempfile
 
 from dateutil import parser
 
-from .. import DEFAULTS
-from ..utils import ensure_dependencies, devel_dir
+from .. import DEFAULTS, metrics
+from ..utils import ensure_dependencies, devel_dir, locked
 from ..exceptions import AletheiaException
 
 logger = logging.getLogger(__name__)
-ensure_dependencies(("git", "2.3.0"))
 
 
 class Source:
@@ -57,32 +57,70 @@ class Source:
             return f"{self.ssh_user}@{self.hostname}:{self.repo}"
         raise ValueError(f"Unsupported protocol: {self.protocol}")
 
+    @property
+    def mirror_path(self):
+        if self.config.git_mirror_dir:
+            mirror_dir = self.config.git_mirror_dir
+        elif self.config.cache:
+            mirror_dir = os.path.join(self.config.cache_dir, "git")
+        else:
+            return None
+        return os.path.join(os.path.expanduser(mirror_dir), re.sub(r"[^\w.-]+", "-", self.url) + ".git")
+
+    def clone_from_mirror(self):
+        # Keep one bare mirror per remote up to date and make cheap local clones from it, so that only new objects
+        # ever cross the network. Returns None if the mirror couldn't be used, so the caller can clone directly.
+        mirror_path = self.mirror_path
+        os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+        with locked(f"{mirror_path}.lock"):
+            if os.path.exists(mirror_path):
+                logger.info(f"Updating git mirror of {self.repo}.")
+                result = metrics.run(["git", "fetch", "--prune", "origin"], cwd=mirror_path)
+            else:
+                logger.info(f"Creating git mirror of {self.repo}.")
+                result = metrics.run(["git", "clone", "--mirror", self.url, mirror_path])
+                if result.returncode != 0:
+                    shutil.rmtree(mirror_path, ignore_errors=True)
+            if result.returncode != 0:
+                logger.warning(f"Could not update git mirror of {self.repo}, cloning it directly.")
+                return None
+            result = metrics.run(
+                ["git", "clone", "--shared", mirror_path, "-b", self.branch, "."], cwd=self.working_dir
+            )
+        if result.returncode == 0:
+            # Point the checkout at the real remote so that pulls and pushes (e.g. from export) go there
+            result = metrics.run(["git", "remote", "set-url", "origin", self.url], cwd=self.working_dir)
+        return result
+
     def run(self):
+        ensure_dependencies(("git", "2.3.0"), config=self.config)
         logger.info(f"Cloning git repo {self.repo}.")
         if self.config.devel and os.path.exists(os.path.join(self.working_dir, ".git")):
-            result = subprocess.run(
+            result = metrics.run(
                 ["git", "reset", "--hard"],
                 # env=dict(GIT_TERMINAL_PROMPT='0'),
                 cwd=self.working_dir,
             )
-            result = subprocess.run(
+            result = metrics.run(
                 ["git", "pull", "--rebase", "origin"],
                 # env=dict(GIT_TERMINAL_PROMPT='0'),
                 cwd=self.working_dir,
             )
         else:
-            result = subprocess.run(
-                ["git", "clone", self.url, "-b", self.branch, "."],
-                # env=dict(GIT_TERMINAL_PROMPT='0'),
-                cwd=self.working_dir,
-            )
+            result = self.mirror_path and self.clone_from_mirror()
+            if result is None:
+                result = metrics.run(
+                    ["git", "clone", self.url, "-b", self.branch, "."],
+                    # env=dict(GIT_TERMINAL_PROMPT='0'),
+                    cwd=self.working_dir,
+                )
         if not result.returncode == 0:
             logger.error(f"Failed to clone repository - git exited with {result.returncode}")
             raise AletheiaException("Error retrieving source.")
 
         # A git clone will set the modtime of every file to the time the clone was made. We need to set them
         # to the time that the last commit occurred.
-        result = subprocess.run(["git", "log", "-1", "--format=%cd"], cwd=self.working_dir, stdout=subprocess.PIPE)
+        result = metrics.run(["git", "log", "-1", "--format=%cd"], cwd=self.working_dir, stdout=subprocess.PIPE)
         if not result.returncode == 0:
             logger.error(f"Failed to obtain last commit timestamp - git exited with {result.returncode}")
         last_commit_timestring = result.stdout
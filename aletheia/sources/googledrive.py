@@ -1,19 +1,25 @@
+import concurrent.futures
+import json
 import logging
 import pickle
 import os
 import shutil
 import tempfile
+import threading
 
 from apiclient import errors
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
 from google_auth_oauthlib.flow import InstalledAppFlow
+from google.auth.credentials import AnonymousCredentials
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from dateutil import parser
 
 from .. import DEFAULTS
 from ..exceptions import ConfigError, AletheiaException
-from ..utils import devel_dir
+from ..transport import Httplib2Adapter, get_session
+from ..utils import copytree, devel_dir, locked
 
 MIME_TYPES = dict(
     epub="application/epub+zip",
@@ -22,6 +28,12 @@ MIME_TYPES = dict(
     html="text/html",
 )
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
+DOCUMENT_MIME_TYPE = "application/vnd.google-apps.document"
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+# The largest page size the Drive API allows for files.list
+PAGE_SIZE = 1000
+# Bumped when what's recorded about a sync changes, so that older state is synced from scratch
+STATE_VERSION = 2
 logger = logging.getLogger(__name__)
 
 
@@ -34,6 +46,11 @@ class Source:
         title=None,
         credentials="credentials.json",
         token="token.pickle",
+        concurrency=4,
+        recursive=False,
+        api_endpoint=None,
+        anonymous=False,
+        **kwargs,
     ):
         self.folder_id = folder_id
         self.format = format
@@ -41,7 +58,14 @@ class Source:
         self.config = config
         self.credentials = os.path.join(config.config_dir, credentials)
         self.token = os.path.join(config.config_dir, token)
+        self.concurrency = max(int(concurrency), 1)
+        self.recursive = recursive
+        # For pointing the source at something other than Google, such as a local stand-in when benchmarking
+        self.api_endpoint = api_endpoint
+        self.anonymous = anonymous
         self._tempdir = None
+        self._creds = None
+        self._local = threading.local()
 
     @property
     def working_dir(self):
@@ -68,7 +92,7 @@ class Source:
         # If there are no (valid) credentials available, let the user log in.
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
+                creds.refresh(Request(session=get_session(self.config)))
             elif interactive:
                 flow = InstalledAppFlow.from_client_secrets_file(self.credentials, SCOPES)
                 creds = flow.run_local_server(port=8888)
@@ -82,57 +106,268 @@ class Source:
                 logger.warning("Could not save updated token.")
         return creds
 
-    def run(self):
-        creds = self.get_google_creds()
-        service = build("drive", "v3", credentials=creds)
-
-        if not self.title:
-            response = service.files().get(fileId=self.folder_id).execute()
-            self.title = response["name"]
+    @property
+    def service(self):
+        # httplib2 isn't thread safe, so each worker builds its own service, but they all share the pooled, rate
+        # limited transport session through an httplib2-compatible adapter
+        if not hasattr(self._local, "service"):
+            http = AuthorizedHttp(self._creds, http=Httplib2Adapter(get_session(self.config)))
+            client_options = {"api_endpoint": self.api_endpoint} if self.api_endpoint else None
+            self._local.service = build("drive", "v3", http=http, cache_discovery=False, client_options=client_options)
+        return self._local.service
 
+    def list_folder(self, folder_id):
+        mime_types = [DOCUMENT_MIME_TYPE, FOLDER_MIME_TYPE] if self.recursive else [DOCUMENT_MIME_TYPE]
+        mime_type_query = " or ".join(f"mimeType = '{mime_type}'" for mime_type in mime_types)
         page_token = None
-        index_timestamp = 0.0
         while 1:
-            try:
-                param = {}
-                if page_token:
-                    logger.info("Getting next page of results.")
-                    param["pageToken"] = page_token
-                else:
-                    logger.info("Getting first page of results from Google Drive folder listing.")
-                response = (
-                    service.files()
-                    .list(
-                        q=f"'{self.folder_id}' in parents and mimeType = 'application/vnd.google-apps.document'",
-                        fields="files(id, name, modifiedTime)",
-                        **param,
-                    )
-                    .execute()
+            param = {}
+            if page_token:
+                logger.info("Getting next page of results.")
+                param["pageToken"] = page_token
+            else:
+                logger.info("Getting first page of results from Google Drive folder listing.")
+            response = (
+                self.service.files()
+                .list(
+                    q=f"'{folder_id}' in parents and ({mime_type_query})",
+                    fields="nextPageToken, files(id, name, mimeType, modifiedTime)",
+                    pageSize=PAGE_SIZE,
+                    **param,
                 )
-                for file_ in response.get("files", []):
-                    try:
-                        logger.info(f'Found file {file_["name"]}.')
-                        # get the file and save to disk
-                        export = service.files().export_media(fileId=file_["id"], mimeType=MIME_TYPES[self.format])
-                        filename = f'{file_["name"]}.{self.format}'.replace("/", "-")
-                        with open(os.path.join(self.working_dir, filename), "wb") as ofs:
-                            downloader = MediaIoBaseDownload(ofs, export, chunksize=1024 * 1024)
-                            done = False
-                            while not done:
-                                status, done = downloader.next_chunk()
-                        # Set proper file timestamps
-                        mtime = parser.parse(file_["modifiedTime"]).timestamp()
-                        index_timestamp = max(index_timestamp, mtime)
-                        os.utime(os.path.join(self.working_dir, filename), (mtime, mtime))
-                    except errors.HttpError as e:
-                        logger.warning(f'Error downloading file from Google "{file_["name"]}" - {file_["id"]} - {e}')
-                page_token = response.get("nextPageToken")
-                if not page_token:
-                    break
+                .execute()
+            )
+            yield from response.get("files", [])
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                break
+
+    @property
+    def state_dir(self):
+        if not self.config.cache:
+            return None
+        name = f"{self.folder_id}--{self.format}{'--recursive' if self.recursive else ''}"
+        return os.path.join(os.path.expanduser(self.config.cache_dir), "googledrive", name)
+
+    def walk_folder(self, folder_id, rel_dir, title, parent=None, skip=None):
+        # Yields each folder's documents before listing its subfolders, so exports can start while we're listing.
+        # Subfolders that skip() returns true for aren't descended into.
+        documents, subfolders = [], []
+        for file_ in self.list_folder(folder_id):
+            (subfolders if file_["mimeType"] == FOLDER_MIME_TYPE else documents).append(file_)
+        yield folder_id, parent, rel_dir, title, documents, [subfolder["id"] for subfolder in subfolders]
+        for subfolder in subfolders:
+            subfolder_dir = os.path.normpath(os.path.join(rel_dir, subfolder["name"].replace("/", "-")))
+            if skip and skip(subfolder["id"], subfolder_dir):
+                continue
+            yield from self.walk_folder(subfolder["id"], subfolder_dir, subfolder["name"], folder_id, skip)
+
+    def export_filename(self, file_):
+        return f'{file_["name"]}.{self.format}'.replace("/", "-")
+
+    def export_file(self, file_, output_dir):
+        filename = self.export_filename(file_)
+        try:
+            logger.info(f'Found file {file_["name"]}.')
+            # get the file and save to disk
+            export = self.service.files().export_media(fileId=file_["id"], mimeType=MIME_TYPES[self.format])
+            with open(os.path.join(output_dir, filename), "wb") as ofs:
+                downloader = MediaIoBaseDownload(ofs, export, chunksize=1024 * 1024)
+                done = False
+                while not done:
+                    status, done = downloader.next_chunk()
+            # Set proper file timestamps
+            mtime = parser.parse(file_["modifiedTime"]).timestamp()
+            os.utime(os.path.join(output_dir, filename), (mtime, mtime))
+            return True
+        except errors.HttpError as e:
+            logger.warning(f'Error downloading file from Google "{file_["name"]}" - {file_["id"]} - {e}')
+            if os.path.exists(os.path.join(output_dir, filename)):
+                os.remove(os.path.join(output_dir, filename))
+            return False
+
+    def sync(self, export_dir, state, folder_ids=None):
+        """Bring export_dir up to date with the Drive folder, returning the new sync state.
+
+        Without folder_ids, the whole folder tree is listed. Otherwise only the folders in folder_ids are listed
+        again, along with any subfolders of theirs that are new or have moved. Documents whose modifiedTime and path
+        match the previous state are left alone; everything else is exported, and exports of documents that have
+        gone away are deleted.
+        """
+        previous_files = state.get("files", {})
+        previous_folders = state.get("folders", {})
+        if folder_ids is None:
+            files, folders = {}, {}
+            roots = [(self.folder_id, ".", self.title, None)]
+            skip = None
+        else:
+            files, folders = dict(previous_files), dict(previous_folders)
+            # Parents first, so that a subfolder that moved is listed under its new path
+            folder_ids = sorted(folder_ids, key=lambda folder_id: previous_folders[folder_id]["path"].count(os.sep))
+            roots = [
+                (folder_id, previous_folders[folder_id]["path"], previous_folders[folder_id]["title"])
+                + (previous_folders[folder_id]["parent"],)
+                for folder_id in folder_ids
+            ]
+
+            relisted = set(folder_ids)
+
+            def skip(folder_id, rel_dir):
+                previous = previous_folders.get(folder_id)
+                return folder_id not in relisted and previous is not None and previous["path"] == rel_dir
+
+        documents_by_folder = {}
+        for file_id, record in files.items():
+            documents_by_folder.setdefault(record["folder"], []).append(file_id)
+        listed, exports = {}, {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            try:
+                for root_id, root_dir, root_title, root_parent in roots:
+                    if root_id in listed:
+                        continue
+                    for folder_id, parent, rel_dir, title, documents, subfolder_ids in self.walk_folder(
+                        root_id, root_dir, root_title, root_parent, skip
+                    ):
+                        listed[folder_id] = set(subfolder_ids)
+                        folders[folder_id] = dict(path=rel_dir, title=title, parent=parent)
+                        os.makedirs(os.path.join(export_dir, rel_dir), exist_ok=True)
+                        for file_id in documents_by_folder.pop(folder_id, []):
+                            files.pop(file_id, None)
+                        for file_ in documents:
+                            path = os.path.normpath(os.path.join(rel_dir, self.export_filename(file_)))
+                            record = dict(path=path, modifiedTime=file_["modifiedTime"], folder=folder_id)
+                            previous = previous_files.get(file_["id"], {})
+                            unchanged = previous.get("path") == path
+                            unchanged = unchanged and previous.get("modifiedTime") == file_["modifiedTime"]
+                            if unchanged and os.path.exists(os.path.join(export_dir, path)):
+                                files[file_["id"]] = record
+                            else:
+                                future = executor.submit(self.export_file, file_, os.path.join(export_dir, rel_dir))
+                                exports[file_["id"]] = (future, record)
             except errors.HttpError as e:
                 raise AletheiaException(f"Error retrieving from Google: {e}")
+        for file_id, (future, record) in exports.items():
+            if future.result():
+                files[file_id] = record
+            else:
+                files.pop(file_id, None)
+        logger.info(f"Exported {len(exports)} files, reused {len(files) - len(exports)}.")
+
+        # Forget folders that are no longer in the tree, along with their documents
+        def attached(folder_id):
+            while folder_id != self.folder_id:
+                parent = folders[folder_id]["parent"]
+                if parent not in folders or (parent in listed and folder_id not in listed[parent]):
+                    return False
+                folder_id = parent
+            return True
+
+        folders = {folder_id: folder for folder_id, folder in folders.items() if attached(folder_id)}
+        files = {file_id: record for file_id, record in files.items() if record["folder"] in folders}
+
+        # Remove exports for documents and folders that were deleted, moved or renamed
+        current_paths = {record["path"] for record in files.values()}
+        for record in previous_files.values():
+            if record["path"] not in current_paths and os.path.exists(os.path.join(export_dir, record["path"])):
+                os.remove(os.path.join(export_dir, record["path"]))
+        current_dirs = {folder["path"] for folder in folders.values()}
+        for folder in previous_folders.values():
+            if folder["path"] not in current_dirs:
+                shutil.rmtree(os.path.join(export_dir, folder["path"]), ignore_errors=True)
+        return dict(version=STATE_VERSION, files=files, folders=folders)
+
+    def changed_folders(self, page_token, state):
+        """Read the Changes API from page_token, returning the synced folders to list again and the next page token.
+
+        A document or folder that changed means listing the folder it was in, and any synced folder it's in now.
+        Changes to anything else in the Drive are ignored.
+        """
+        files, folders = state["files"], state["folders"]
+        affected = set()
+        while 1:
+            response = (
+                self.service.changes()
+                .list(
+                    pageToken=page_token,
+                    pageSize=PAGE_SIZE,
+                    fields="nextPageToken, newStartPageToken, changes(fileId, removed, file(parents))",
+                )
+                .execute()
+            )
+            for change in response.get("changes", []):
+                file_id = change["fileId"]
+                if file_id in files:
+                    affected.add(files[file_id]["folder"])
+                elif file_id in folders:
+                    # Changes to the synced folder itself don't change its contents
+                    if folders[file_id]["parent"]:
+                        affected.add(folders[file_id]["parent"])
+                parents = [] if change.get("removed") else (change.get("file") or {}).get("parents", [])
+                affected.update(parent for parent in parents if parent in folders)
+            if "newStartPageToken" in response:
+                return affected, response["newStartPageToken"]
+            page_token = response["nextPageToken"]
+
+    def delta_sync(self, state_dir):
+        state_path = os.path.join(state_dir, "state.json")
+        export_dir = os.path.join(state_dir, "exports")
+        try:
+            with open(state_path) as ifs:
+                state = json.load(ifs)
+        except (OSError, ValueError):
+            state = {}
+
+        folder_ids, page_token = None, None
+        if state.get("version") == STATE_VERSION and state.get("page_token") and os.path.isdir(export_dir):
+            try:
+                folder_ids, page_token = self.changed_folders(state["page_token"], state)
+            except errors.HttpError as e:
+                logger.warning(f"Could not list changes from Google, syncing the whole folder - {e}")
+        if folder_ids is None or folder_ids:
+            # Take the token before listing, so anything that changes while we're syncing is seen next time
+            page_token = self.service.changes().getStartPageToken().execute()["startPageToken"]
+            if folder_ids:
+                logger.info(f"Syncing {len(folder_ids)} changed Google Drive folders.")
+            state = self.sync(export_dir, state, folder_ids)
+        else:
+            logger.info("No changes in Google Drive folder since the last sync.")
+        state["page_token"] = page_token
+
+        with open(f"{state_path}.tmp", "w") as ofs:
+            json.dump(state, ofs)
+        os.replace(f"{state_path}.tmp", state_path)
+        copytree(export_dir, self.working_dir, nonempty_ok=True)
+        return state
+
+    def run(self):
+        self._creds = AnonymousCredentials() if self.anonymous else self.get_google_creds()
+
+        if not self.title:
+            response = self.service.files().get(fileId=self.folder_id).execute()
+            self.title = response["name"]
+
+        state_dir = self.state_dir
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+            with locked(f"{state_dir}.lock"):
+                state = self.delta_sync(state_dir)
+        else:
+            state = self.sync(self.working_dir, {})
         logger.info("All files retrieved.")
-        with open(os.path.join(self.working_dir, "_index.md"), "w") as ofs:
-            ofs.write(f"# {self.title}\n")
-        os.utime(os.path.join(self.working_dir, "_index.md"), (index_timestamp, index_timestamp))
+
+        for folder in state["folders"].values():
+            prefix = "" if folder["path"] == "." else folder["path"] + os.sep
+            index_timestamp = max(
+                [0.0]
+                + [
+                    parser.parse(record["modifiedTime"]).timestamp()
+                    for record in state["files"].values()
+                    if record["path"].startswith(prefix)
+                ]
+            )
+            title = self.title if folder["path"] == "." else folder["title"]
+            index_path = os.path.join(self.working_dir, folder["path"], "_index.md")
+            with open(index_path, "w") as ofs:
+                ofs.write(f"# {title}\n")
+            os.utime(index_path, (index_timestamp, index_timestamp))
         return self.working_dir
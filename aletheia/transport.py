@@ -0,0 +1,191 @@
+import email.utils
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger(__name__)
+# Hosts we keep a connection pool for at once
+POOL_CONNECTIONS = 10
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout)
+# Methods that are safe to resend after a failure the server may already have acted on, as in urllib3's Retry
+IDEMPOTENT_METHODS = {"DELETE", "GET", "HEAD", "OPTIONS", "PUT", "TRACE"}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def parse_retry_after(value):
+    """Return the number of seconds a Retry-After header asks us to wait, or None."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+class HostLimiter:
+    """Caps the requests in flight to one host, adapting the cap AIMD-style.
+
+    Every successful response raises the cap by 1/cap, so about one per round of requests, up to max_concurrency.
+    A 429 halves it. A Retry-After holds back every new request to the host until it has passed.
+    """
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.resume_at = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                delay = self.resume_at - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                elif self.in_flight < int(self.limit):
+                    break
+                else:
+                    self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False, retry_after=None):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.limit / 2, 1.0)
+                logger.debug(f"Throttled, lowering concurrency limit to {int(self.limit)}.")
+            else:
+                self.limit = min(self.limit + 1 / self.limit, self.max_concurrency)
+            if retry_after:
+                self.resume_at = max(self.resume_at, time.monotonic() + retry_after)
+            self._cond.notify_all()
+
+
+class Pool:
+    """Keep-alive connections and per-host limiters, shared between sessions."""
+
+    def __init__(self, max_per_host=8):
+        self.max_per_host = max_per_host
+        self.adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=max_per_host)
+        self._limiters = {}
+        self._limiters_lock = threading.Lock()
+
+    def limiter(self, url):
+        host = urlsplit(url).netloc
+        with self._limiters_lock:
+            if host not in self._limiters:
+                self._limiters[host] = HostLimiter(self.max_per_host)
+            return self._limiters[host]
+
+
+class Session(requests.Session):
+    """A requests session with pooled keep-alive connections, per-host rate limiting and retries with jitter.
+
+    Sessions made with the same pool share its connections and limiters, but nothing else, so that a client which
+    sets auth or headers on its session doesn't affect any other.
+    """
+
+    def __init__(self, max_per_host=8, retries=5, backoff=0.5, max_backoff=60, pool=None):
+        super().__init__()
+        self._own_pool = pool is None
+        self.pool = pool or Pool(max_per_host)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.mount("https://", self.pool.adapter)
+        self.mount("http://", self.pool.adapter)
+
+    def close(self):
+        # A shared pool's connections may still be in use by other sessions
+        if self._own_pool:
+            super().close()
+
+    def request(self, method, url, *args, **kwargs):
+        limiter = self.pool.limiter(url)
+        attempt = 0
+        while True:
+            response = None
+            throttled = False
+            retry_after = None
+            limiter.acquire()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+                throttled = response.status_code == 429
+                if response.status_code in RETRY_STATUSES:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            except RETRY_EXCEPTIONS as e:
+                if attempt >= self.retries or method.upper() not in IDEMPOTENT_METHODS:
+                    raise
+                logger.debug(f"{method} {url} failed, retrying - {e}")
+            finally:
+                # Whatever went wrong, the request isn't in flight any more
+                limiter.release(throttled, retry_after)
+            if response is not None:
+                retriable = throttled or method.upper() in IDEMPOTENT_METHODS
+                if response.status_code not in RETRY_STATUSES or not retriable or attempt >= self.retries:
+                    return response
+                logger.debug(f"{method} {url} returned {response.status_code}, retrying.")
+                response.close()
+            if retry_after is None:
+                # Full jitter, so that workers which failed together don't retry together
+                time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+            attempt += 1
+
+
+class Httplib2Adapter:
+    """Presents a Session through the httplib2.Http interface, for Google's API client."""
+
+    def __init__(self, session, timeout=None):
+        self.session = session
+        self.timeout = timeout
+        self.redirect_codes = httplib2.REDIRECT_CODES
+        self.follow_redirects = True
+
+    def request(
+        self, uri, method="GET", body=None, headers=None, redirections=httplib2.DEFAULT_MAX_REDIRECTS, **kwargs
+    ):
+        response = self.session.request(
+            method,
+            uri,
+            data=body,
+            headers=headers,
+            timeout=self.timeout,
+            allow_redirects=self.follow_redirects and redirections > 0,
+        )
+        content = response.content
+        info = {key.lower(): value for key, value in response.headers.items()}
+        if "content-encoding" in info:
+            # requests already decoded the body, so describe what we're actually handing back like httplib2 does
+            info["-content-encoding"] = info.pop("content-encoding")
+            info["content-length"] = str(len(content))
+        info["status"] = str(response.status_code)
+        result = httplib2.Response(info)
+        result.reason = response.reason
+        return result, content
+
+    def close(self):
+        pass
+
+
+def get_session(config):
+    """Return a new session sharing its connections and limiters with every other one with the same settings."""
+    with _pools_lock:
+        if config.http_max_per_host not in _pools:
+            _pools[config.http_max_per_host] = Pool(config.http_max_per_host)
+        pool = _pools[config.http_max_per_host]
+    return Session(config.http_max_per_host, config.http_retries, config.http_backoff, pool=pool)
@@ -1,39 +1,155 @@
-from distutils.spawn import find_executable
+import concurrent.futures
+import contextlib
+import errno
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
 import pathlib
 import shutil
 import subprocess
 import re
+import sys
+import threading
 
 import semver
 
 from .exceptions import ConfigError
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 logger = logging.getLogger(__name__)
 VERSION_STRING_RE = re.compile(
     r"([1-9][0-9]*!)?(0|[1-9][0-9]*)(\.(0|[1-9][0-9]*))*((a|b|rc)(0|[1-9][0-9]*))?(\.post(0|[1-9][0-9]*))?(\.dev(0|[1-9][0-9]*))?"  # noqa: E501
 )
+PROBES_FILENAME = "probes.json"
+VCS_DIRS = {".git", ".hg", ".svn"}
+_probes = {}
+_probes_lock = threading.Lock()
+
+
+def __load_probes(probes_path):
+    try:
+        with open(probes_path) as ifs:
+            return json.load(ifs)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_version(dep, config=None):
+    """Return the version an executable reports with --version.
+
+    Results are remembered for the life of the process and, given a config with caching enabled, on disk in
+    ``probes.json`` under the cache directory, keyed on the executable's path and mtime.
+    """
+    executable = shutil.which(dep)
+    if not executable:
+        raise ConfigError(f"Could not find executable for {dep}")
+    executable = os.path.realpath(executable)
+    probe_key = f"{executable}:{os.stat(executable).st_mtime_ns}"
+    with _probes_lock:
+        if probe_key in _probes:
+            return _probes[probe_key]
+    probes_path = config and config.cache and os.path.join(os.path.expanduser(config.cache_dir), PROBES_FILENAME)
+    probes = __load_probes(probes_path) if probes_path else {}
+    if probe_key in probes:
+        version = probes[probe_key]
+    else:
+        result = subprocess.run([executable, "--version"], stdout=subprocess.PIPE)
+        if result.returncode != 0:
+            raise ConfigError(f"Error confirming {dep} version: {result.stderr}")
+        match_obj = VERSION_STRING_RE.search(result.stdout.decode("utf8"))
+        version = match_obj.group(0) if match_obj else None
+        if probes_path:
+            try:
+                os.makedirs(os.path.dirname(probes_path), exist_ok=True)
+                with locked(f"{probes_path}.lock"):
+                    probes = __load_probes(probes_path)
+                    probes[probe_key] = version
+                    with open(f"{probes_path}.tmp", "w") as ofs:
+                        json.dump(probes, ofs)
+                    os.replace(f"{probes_path}.tmp", probes_path)
+            except OSError:
+                logger.warning(f"Could not save {dep} version to {probes_path}.", exc_info=True)
+    with _probes_lock:
+        _probes[probe_key] = version
+    return version
 
 
-def ensure_dependencies(*deps):
+def ensure_dependencies(*deps, config=None):
     for dep, version in deps:
-        executable = find_executable(dep)
+        executable = shutil.which(dep)
         if not executable:
             raise ConfigError(f"Could not find executable for {dep}")
         if version:
-            result = subprocess.run([executable, "--version"], stdout=subprocess.PIPE)
-            if result.returncode == 0:
-                match_obj = VERSION_STRING_RE.search(result.stdout.decode("utf8"))
-                if not match_obj:
-                    raise ConfigError(f"Could not confirm {dep} is at least version {version}")
-                matched_version = match_obj.group(0)
-                if semver.compare(matched_version, version) == -1:
-                    raise ConfigError(
-                        f"Installed {dep} is version {matched_version}, but at least {version} required."
-                    )
-            else:
-                raise ConfigError(f"Error confirming {dep} version: {result.stderr}")
+            matched_version = get_version(dep, config)
+            if not matched_version:
+                raise ConfigError(f"Could not confirm {dep} is at least version {version}")
+            if semver.compare(matched_version, version) == -1:
+                raise ConfigError(f"Installed {dep} is version {matched_version}, but at least {version} required.")
+
+
+@contextlib.contextmanager
+def locked(lock_path):
+    """Hold an exclusive lock on lock_path, shared with other threads and other aletheia processes."""
+    with open(lock_path, "a") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def try_locked(lock_path):
+    """Like locked(), but yields whether the lock was taken rather than waiting for whoever holds it."""
+    with open(lock_path, "a") as lock_file:
+        if not fcntl:
+            yield True
+            return
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+# Below this many items, starting worker processes costs more than it saves
+PARALLEL_THRESHOLD = 64
+
+
+def process_pool(max_workers):
+    """Return a process pool that's safe to start while other pipelines run on threads, which forking isn't."""
+    if sys.version_info < (3, 7):
+        # Process pools can only be given a start method from Python 3.7, so fall back to threads
+        return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    methods = multiprocessing.get_all_start_methods()
+    mp_context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context)
+
+
+def map_in_batches(fn, items, max_workers):
+    """Return fn's results over items in order, calling it on batches of them in a process pool.
+
+    fn takes a list of items and returns a list of results. Each worker is handed a few large batches rather than an
+    item at a time, to keep pickling overhead down, and short lists are handled in this process.
+    """
+    if len(items) < PARALLEL_THRESHOLD or max_workers == 1:
+        return fn(items)
+    batch_size = -(-len(items) // (max_workers * 4))
+    batches = [items[i : i + batch_size] for i in range(0, len(items), batch_size)]  # noqa: E203
+    with process_pool(max_workers) as executor:
+        return [result for results in executor.map(fn, batches) for result in results]
 
 
 def devel_dir(path_component):
@@ -44,7 +160,78 @@ def devel_dir(path_component):
     return to_return
 
 
-def copytree(src, dest, nonempty_ok=False):
+# ioctl request number for FICLONE from linux/fs.h
+FICLONE = 0x40049409
+COPY_IN_PARALLEL_THRESHOLD = 256
+CLONE_FALLBACK_ERRNOS = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.EBADF, errno.ENOSYS}
+# (source device, destination device) pairs a strategy has already failed on, so we don't keep retrying it
+_no_reflink = set()
+_no_copy_file_range = set()
+
+
+def __reflink(src, dest):
+    with open(src, "rb") as ifs, open(dest, "wb") as ofs:
+        fcntl.ioctl(ofs.fileno(), FICLONE, ifs.fileno())
+
+
+def __copy_file_range(src, dest):
+    copied = 0
+    with open(src, "rb") as ifs, open(dest, "wb") as ofs:
+        while True:
+            count = os.copy_file_range(ifs.fileno(), ofs.fileno(), 1024 * 1024 * 1024)
+            if not count:
+                break
+            copied += count
+    return copied
+
+
+def copy_file(src, dest, link=False):
+    """Copy a file with its metadata, returning the number of bytes physically copied.
+
+    Strategies are tried cheapest first: a hardlink (only if ``link`` is set), a copy-on-write reflink, an in-kernel
+    ``copy_file_range`` and finally ``shutil.copy2``. Anything already at ``dest`` is unlinked rather than written
+    through, so a file that's hardlinked elsewhere is never modified.
+    """
+    if os.path.lexists(dest) and not os.path.isdir(dest):
+        os.remove(dest)
+    if link:
+        try:
+            os.link(src, dest)
+            return 0
+        except OSError:
+            pass
+    devices = (os.stat(src).st_dev, os.stat(os.path.dirname(os.path.abspath(dest))).st_dev)
+    if fcntl and devices not in _no_reflink:
+        try:
+            __reflink(src, dest)
+            shutil.copystat(src, dest)
+            return 0
+        except OSError as e:
+            if e.errno not in CLONE_FALLBACK_ERRNOS:
+                raise
+            _no_reflink.add(devices)
+    if hasattr(os, "copy_file_range") and devices not in _no_copy_file_range:
+        try:
+            copied = __copy_file_range(src, dest)
+            shutil.copystat(src, dest)
+            return copied
+        except OSError as e:
+            if e.errno not in CLONE_FALLBACK_ERRNOS:
+                raise
+            _no_copy_file_range.add(devices)
+    shutil.copy2(src, dest)
+    return os.path.getsize(dest)
+
+
+def copytree(src, dest, nonempty_ok=False, link=False):
+    """Copy the contents of src into dest, returning the number of bytes physically copied.
+
+    Set ``link`` only for read-only handoffs, where nothing will modify either tree in place afterwards.
+    """
+    # os.walk quietly yields nothing for a missing directory, which would make a mistyped path look like an empty tree
+    if not os.path.isdir(src):
+        error = errno.ENOTDIR if os.path.exists(src) else errno.ENOENT
+        raise OSError(error, os.strerror(error), src)
     # It's annoying that shutil.copytree doesn't work on an empty, already-existing directory. Let's fix that.
     if os.path.exists(dest):
         if os.path.isdir(dest):
@@ -54,10 +241,65 @@ def copytree(src, dest, nonempty_ok=False):
             raise OSError(f"Destination {dest} is not a directory.")
     else:
         os.makedirs(dest)
-    for filename in os.listdir(src):
-        file_path = os.path.join(src, filename)
-        dest_file_path = os.path.join(dest, filename)
-        if os.path.isdir(file_path):
-            copytree(file_path, dest_file_path, nonempty_ok=nonempty_ok)
-        else:
-            shutil.copy2(file_path, dest_file_path)
+    copies = []
+    for root, dirs, files in os.walk(src, followlinks=True):
+        dest_root = os.path.normpath(os.path.join(dest, os.path.relpath(root, src)))
+        if not os.path.isdir(dest_root):
+            os.mkdir(dest_root)
+        copies.extend((os.path.join(root, filename), os.path.join(dest_root, filename)) for filename in files)
+    if len(copies) >= COPY_IN_PARALLEL_THRESHOLD:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) + 4)) as executor:
+            copied = sum(executor.map(lambda paths: copy_file(*paths, link=link), copies))
+    else:
+        copied = sum(copy_file(*paths, link=link) for paths in copies)
+    logger.debug(f"Copied {len(copies)} files from {src} to {dest}, {copied} bytes physically copied.")
+    return copied
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as ifs:
+        for chunk in iter(lambda: ifs.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def __git_revision(path):
+    if not os.path.exists(os.path.join(path, ".git")):
+        return None
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=path, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+    except OSError:
+        return None
+    return result.stdout.decode("utf8").strip() if result.returncode == 0 else None
+
+
+def fingerprint_tree(path):
+    # Plugins propagate mtimes into their output (e.g. Hugo front matter dates), so they're part of the fingerprint
+    digest = hashlib.sha256()
+    # Version control metadata records clone times and stat data, so it differs between checkouts of the same
+    # commit. It's left out, and a checkout's commit stands in for it in case a stage asks git about the tree.
+    revision = __git_revision(path)
+    if revision:
+        digest.update(f"r {revision}\n".encode("utf8"))
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(dirname for dirname in dirs if dirname not in VCS_DIRS)
+        rel_root = os.path.relpath(root, path)
+        digest.update(f"d {rel_root}\n".encode("utf8", "surrogateescape"))
+        for filename in sorted(files):
+            if filename in VCS_DIRS:
+                # A gitfile, pointing at the repository of a worktree or submodule
+                continue
+            file_path = os.path.join(root, filename)
+            file_stat = os.stat(file_path)
+            entry = f"f {os.path.join(rel_root, filename)} {file_stat.st_mtime_ns} {file_digest(file_path)}\n"
+            digest.update(entry.encode("utf8", "surrogateescape"))
+    return digest.hexdigest()
+
+
+def tree_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, filename)) for root, dirs, files in os.walk(path) for filename in files
+    )
@@ -0,0 +1,4 @@
+"""Benchmarks for Aletheia's file handling, converters and builders, run against synthetic documentation trees.
+
+Run ``python -m benchmarks run`` to time them and ``python -m benchmarks compare`` to compare two runs.
+"""
@@ -0,0 +1,116 @@
+import argparse
+import logging
+import sys
+import time
+
+from . import fakes, runner
+from .suite import BENCHMARKS
+
+
+logger = logging.getLogger("benchmarks")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmark Aletheia on synthetic trees.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    run_parser = subparsers.add_parser("run", help="Run benchmarks and save the results as JSON")
+    run_parser.add_argument("names", nargs="*", metavar="name", help=f"Benchmarks to run: {', '.join(BENCHMARKS)}")
+    run_parser.add_argument("--output", "-o", default="benchmark-results.json", help="Where to save the results")
+    run_parser.add_argument("--files", type=int, default=500, help="Files in each synthetic tree")
+    run_parser.add_argument("--size", type=int, default=4096, help="Approximate size of each file in bytes")
+    run_parser.add_argument("--depth", type=int, default=3, help="Levels of directories below the root")
+    run_parser.add_argument("--fanout", type=int, default=3, help="Subdirectories in each directory")
+    run_parser.add_argument("--image-ratio", type=float, default=0.1, help="Fraction of files that are images")
+    run_parser.add_argument("--seed", type=int, default=0, help="Seed for generating the trees")
+    run_parser.add_argument("--pipelines", type=int, default=4, help="Pipelines in the end-to-end build")
+    run_parser.add_argument("--jobs", "-j", type=int, default=1, help="Pipelines to run concurrently in the build")
+    run_parser.add_argument("--concurrency", type=int, default=4, help="Concurrency of the network sources")
+    run_parser.add_argument("--latency", type=float, default=0.01, help="Seconds the stand-in servers take to respond")
+    run_parser.add_argument("--throughput", type=int, help="Bytes a second the stand-in servers send a response at")
+    run_parser.add_argument(
+        "--throttle-rate", type=float, default=0.0, help="Fraction of requests the stand-in servers answer with 429"
+    )
+    run_parser.add_argument("--repeat", "-r", type=int, default=5, help="Timed runs of each benchmark")
+    run_parser.add_argument("--warmup", type=int, default=1, help="Untimed runs of each benchmark beforehand")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two sets of results")
+    compare_parser.add_argument("baseline", help="Results to compare against")
+    compare_parser.add_argument("current", help="Results to check for regressions")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.1, help="Slowdown in median time counted as a regression (default 0.1)"
+    )
+
+    serve_parser = subparsers.add_parser("serve", help="Run a stand-in Confluence or Google Drive server")
+    serve_parser.add_argument("service", choices=["confluence", "googledrive"])
+    serve_parser.add_argument("--port", type=int, default=0, help="Port to listen on (default any free port)")
+    serve_parser.add_argument("--fixture", help="Serve a saved fixture rather than generating one")
+    serve_parser.add_argument("--save", help="Save the generated fixture to this path")
+    serve_parser.add_argument("--files", type=int, default=50, help="Pages or documents to generate")
+    serve_parser.add_argument("--size", type=int, default=4096, help="Approximate size of each page or document")
+    serve_parser.add_argument("--seed", type=int, default=0, help="Seed for generating the fixture")
+    serve_parser.add_argument("--latency", type=float, default=0.0, help="Seconds to take to respond")
+    serve_parser.add_argument("--throughput", type=int, help="Bytes a second to send responses at")
+    serve_parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests to throttle")
+    serve_parser.add_argument("--max-concurrency", type=int, help="Throttle requests beyond this many in flight")
+    serve_parser.add_argument("--retry-after", type=float, help="Retry-After to send with 429 responses")
+
+    params = parser.parse_args(args if args is not None else sys.argv[1:])
+    logging.basicConfig(format="{levelname}:{name}:{message}", style="{", level=logging.INFO)
+    logging.getLogger("aletheia").setLevel(logging.WARNING)
+
+    if params.command == "run":
+        unknown = [name for name in params.names if name not in BENCHMARKS]
+        if unknown:
+            parser.error(f"Unknown benchmarks: {', '.join(unknown)}")
+        runner.save(runner.run_benchmarks(params, params.names), params.output)
+        logger.info(f"Saved results to {params.output}.")
+    elif params.command == "compare":
+        rows = runner.compare(runner.load(params.baseline), runner.load(params.current), params.threshold)
+        print(f"{'benchmark':<20} {'baseline':>10} {'current':>10} {'change':>8}")
+        for name, base, current, ratio, regressed in rows:
+            flag = "  REGRESSION" if regressed else ""
+            print(f"{name:<20} {base:>9.3f}s {current:>9.3f}s {ratio - 1:>+8.1%}{flag}")
+        if any(regressed for *_, regressed in rows):
+            return 1
+    elif params.command == "serve":
+        serve(params)
+    else:
+        parser.print_help()
+    return 0
+
+
+def serve(params):
+    fake_cls = fakes.FakeConfluence if params.service == "confluence" else fakes.FakeDrive
+    options = dict(
+        latency=params.latency,
+        throughput=params.throughput,
+        throttle_rate=params.throttle_rate,
+        max_concurrency=params.max_concurrency,
+        retry_after=params.retry_after,
+    )
+    if params.fixture:
+        fake = fake_cls.load(params.fixture, seed=params.seed, **options)
+    elif params.service == "confluence":
+        fake = fake_cls.generate(pages=params.files, size=params.size, seed=params.seed, **options)
+    else:
+        fake = fake_cls.generate(documents=params.files, size=params.size, seed=params.seed, **options)
+    if params.save:
+        fake.save(params.save)
+    with fake.start(port=params.port):
+        if params.service == "confluence":
+            logger.info(f"Serving Confluence at {fake.url}: use url: {fake.url} and page_id: {fake.root_id}.")
+        else:
+            logger.info(
+                f"Serving Google Drive at {fake.url}: use api_endpoint: {fake.api_endpoint}, anonymous: true and "
+                f"folder_id: {fake.root_id}."
+            )
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
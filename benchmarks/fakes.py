@@ -0,0 +1,432 @@
+"""Local stand-ins for the Confluence REST API and the Google Drive v3 API.
+
+They serve generated or saved fixtures over HTTP, with configurable latency, throughput and throttling, so that the
+network sources can be exercised and timed without the real services. Point the ``confluence`` source at one with
+its ``url`` option, and the ``googledrive`` source with ``api_endpoint`` (ending ``/drive/v3/``) and
+``anonymous: true``.
+"""
+import base64
+import datetime
+import email.mime.image
+import email.mime.multipart
+import email.mime.text
+import http.server
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from . import synthetic
+
+
+# Bodies are sent in chunks of this size, so that throughput limits apply smoothly
+CHUNK_SIZE = 64 * 1024
+DRIVE_DOCUMENT_MIME_TYPE = "application/vnd.google-apps.document"
+DRIVE_FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+
+def drive_timestamp(seconds):
+    return datetime.datetime.utcfromtimestamp(seconds).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def json_response(data, status=200):
+    return status, {"Content-Type": "application/json"}, json.dumps(data).encode("utf8")
+
+
+def not_found():
+    return json_response({"message": "Not found"}, 404)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Keep connections alive, as the real services do
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.fake.handle(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer:
+    """An HTTP server on a background thread that injects latency, bandwidth limits and 429 responses.
+
+    ``latency`` is added to every response, in seconds. ``throughput`` caps each response's transfer rate, in bytes
+    a second. A request is answered with 429 Too Many Requests when more than ``max_concurrency`` are in flight, or
+    at random with probability ``throttle_rate``; the response carries a Retry-After of ``retry_after`` seconds if
+    that's set. Subclasses answer requests in ``route``.
+    """
+
+    def __init__(
+        self, latency=0.0, throughput=None, throttle_rate=0.0, max_concurrency=None, retry_after=None, seed=0
+    ):
+        self.latency = latency
+        self.throughput = throughput
+        self.throttle_rate = throttle_rate
+        self.max_concurrency = max_concurrency
+        self.retry_after = retry_after
+        self.stats = dict(requests=0, throttled=0, bytes_sent=0, peak_concurrency=0)
+        self.url = None
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._server = None
+        self._thread = None
+
+    def start(self, host="127.0.0.1", port=0):
+        self._server = http.server.ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        host, port = self._server.server_address[:2]
+        self.url = f"http://{host}:{port}/"
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        # ``with fake.start(port=...):`` has already started the server
+        return self if self._server else self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def route(self, path, query, headers):
+        """Answer a GET request with ``(status, headers, body)``."""
+        raise NotImplementedError()
+
+    def handle(self, handler):
+        with self._lock:
+            self._in_flight += 1
+            self.stats["requests"] += 1
+            self.stats["peak_concurrency"] = max(self.stats["peak_concurrency"], self._in_flight)
+            over_limit = self.max_concurrency and self._in_flight > self.max_concurrency
+            throttled = over_limit or self._rng.random() < self.throttle_rate
+            if throttled:
+                self.stats["throttled"] += 1
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            if throttled:
+                status, headers, body = json_response({"message": "Rate limit exceeded"}, 429)
+                if self.retry_after is not None:
+                    headers["Retry-After"] = str(self.retry_after)
+            else:
+                url = urlsplit(handler.path)
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                try:
+                    status, headers, body = self.route(url.path, query, handler.headers)
+                except Exception as e:
+                    status, headers, body = json_response({"message": str(e)}, 500)
+            handler.send_response(status)
+            for key, value in headers.items():
+                handler.send_header(key, value)
+            handler.send_header("Content-Length", str(len(body)))
+            handler.end_headers()
+            self.send_body(handler, body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def send_body(self, handler, body):
+        for start in range(0, len(body), CHUNK_SIZE):
+            chunk = body[start : start + CHUNK_SIZE]  # noqa: E203
+            handler.wfile.write(chunk)
+            if self.throughput:
+                time.sleep(len(chunk) / self.throughput)
+        with self._lock:
+            self.stats["bytes_sent"] += len(body)
+
+    def fixture(self):
+        """Return everything this server serves, as JSON-serializable data."""
+        raise NotImplementedError()
+
+    def save(self, path):
+        with open(path, "w") as ofs:
+            json.dump(self.fixture(), ofs)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with open(path) as ifs:
+            return cls(json.load(ifs), **kwargs)
+
+
+class FakeConfluence(FakeServer):
+    """Serves a tree of Confluence pages and their attachments.
+
+    The fixture maps each page id to its ``title``, ``version``, ``parent`` id, ``body`` HTML (as in the
+    ``export_view`` representation) and ``attachments``, a mapping of filename to base64-encoded content. Images in
+    the body refer to attachments by ``data-linked-resource-default-alias``, as Confluence's do.
+    """
+
+    def __init__(self, fixture, **kwargs):
+        super().__init__(**kwargs)
+        self.root_id = fixture["root_id"]
+        self.pages = fixture["pages"]
+        self._attachments = {
+            page_id: {title: base64.b64decode(content) for title, content in page["attachments"].items()}
+            for page_id, page in self.pages.items()
+        }
+
+    @classmethod
+    def generate(cls, pages=50, fanout=5, attachments=2, attachment_size=50000, size=4096, seed=0, **kwargs):
+        """Generate a tree of pages, each with a few image attachments that its body displays."""
+        rng = random.Random(seed)
+        fixture_pages = {}
+        for i in range(pages):
+            page_id = str(1000 + i)
+            parent = str(1000 + (i - 1) // fanout) if i else None
+            images = {}
+            for j in range(attachments):
+                content = synthetic.PNG_HEADER + synthetic.random_bytes(rng, attachment_size)
+                images[f"image{j}.png"] = base64.b64encode(content).decode("ascii")
+            paragraphs = [f"<p>{paragraph}</p>" for paragraph in synthetic.paragraphs(rng, size)]
+            img_tags = [
+                f'<p><img class="confluence-embedded-image" width="400" data-linked-resource-default-alias="{title}"'
+                f' src="{{base}}download/attachments/{page_id}/{title}?version=1"></p>'
+                for title in images
+            ]
+            fixture_pages[page_id] = dict(
+                title=f"Page {i} {synthetic.text(rng, 20)}",
+                version=1,
+                parent=parent,
+                body="\n".join(paragraphs + img_tags),
+                attachments=images,
+            )
+        return cls(dict(root_id="1000", pages=fixture_pages), seed=seed, **kwargs)
+
+    def fixture(self):
+        return dict(root_id=self.root_id, pages=self.pages)
+
+    def touch(self, page_id):
+        """Publish a new version of a page."""
+        page = self.pages[page_id]
+        page["version"] += 1
+        page["body"] += f"\n<p>Revision {page['version']}</p>"
+
+    def children(self, page_id):
+        return [child_id for child_id, page in self.pages.items() if page["parent"] == page_id]
+
+    def body(self, page_id):
+        page = self.pages[page_id]
+        body = page["body"].replace("{base}", self.url)
+        if self.children(page_id):
+            body += '\n<ul class="childpages-macro"><li>Child pages</li></ul>'
+        return body
+
+    def summary(self, page_id):
+        page = self.pages[page_id]
+        return dict(id=page_id, type="page", title=page["title"], version=dict(number=page["version"]))
+
+    def attachment(self, page_id, title):
+        return dict(
+            id=f"att{page_id}-{title}",
+            type="attachment",
+            title=title,
+            extensions=dict(mediaType="image/png", fileSize=len(self._attachments[page_id][title])),
+            _links=dict(download=f"/download/attachments/{page_id}/{title}?version=1"),
+        )
+
+    def word_export(self, page_id):
+        # Word exports are MIME documents with images referred to by the tail of their Content-Location
+        message = email.mime.multipart.MIMEMultipart("related")
+        body = self.body(page_id)
+        for title, content in self._attachments[page_id].items():
+            content_id = f"{page_id}-{title}.tmp"
+            image = email.mime.image.MIMEImage(content, "png")
+            image["Content-Location"] = f"file:///C:/{content_id}"
+            message.attach(image)
+            body = re.sub(
+                f'src="[^"]*/{re.escape(page_id)}/{re.escape(title)}\\?version=1"', f'src="{content_id}"', body
+            )
+        html = email.mime.text.MIMEText(f"<html><body>{body}</body></html>", "html", "utf-8")
+        html["Content-Location"] = "file:///C:/exported.html"
+        message.attach(html)
+        return message.as_bytes()
+
+    def paginate(self, items, query):
+        start, limit = int(query.get("start", 0)), int(query.get("limit", 25))
+        end = start + limit
+        results = items[start:end]
+        return json_response(dict(results=results, start=start, limit=limit, size=len(results)))
+
+    def route(self, path, query, headers):
+        parts = path.strip("/").split("/")
+        if parts[:3] == ["rest", "api", "content"] and len(parts) >= 4:
+            page_id = parts[3]
+            if page_id not in self.pages:
+                return not_found()
+            if len(parts) == 4:
+                page = self.summary(page_id)
+                if "body.export_view" in query.get("expand", ""):
+                    page["body"] = dict(export_view=dict(value=self.body(page_id), representation="export_view"))
+                return json_response(page)
+            if parts[4:] == ["child", "page"]:
+                return self.paginate([self.summary(child_id) for child_id in self.children(page_id)], query)
+            if parts[4:] == ["child", "attachment"]:
+                return self.paginate([self.attachment(page_id, title) for title in self._attachments[page_id]], query)
+        elif parts[:2] == ["download", "attachments"] and len(parts) == 4:
+            content = self._attachments.get(parts[2], {}).get(parts[3])
+            if content is not None:
+                return 200, {"Content-Type": "image/png"}, content
+        elif parts == ["exportword"] and query.get("pageId") in self.pages:
+            # The whole MIME document, headers and all, is the body of the response
+            return 200, {"Content-Type": "application/vnd.ms-word"}, self.word_export(query["pageId"])
+        return not_found()
+
+
+class FakeDrive(FakeServer):
+    """Serves a Google Drive folder tree, its documents' exports and the Changes API.
+
+    The fixture maps each folder id to its ``name`` and ``parent`` id, and each document id to its ``name``,
+    ``parent``, ``modifiedTime`` and base64-encoded ``content``, which is served whatever export format is asked for.
+    Listings return at most ``page_size`` files a page, to exercise pagination.
+    """
+
+    def __init__(self, fixture, page_size=None, **kwargs):
+        super().__init__(**kwargs)
+        self.root_id = fixture["root_id"]
+        self.folders = fixture["folders"]
+        self.documents = fixture["documents"]
+        self.page_size = page_size
+        self.changes = []
+        # The parent of each files.list call, to show which folders a sync listed
+        self.listed = []
+        self._content = {doc_id: base64.b64decode(doc["content"]) for doc_id, doc in self.documents.items()}
+
+    @classmethod
+    def generate(cls, documents=50, depth=2, fanout=3, size=4096, seed=0, **kwargs):
+        """Generate a folder tree of HTML documents, spread evenly across the folders."""
+        rng = random.Random(seed)
+        folders = {"root": dict(name="Root", parent=None)}
+        frontier = ["root"]
+        for level in range(depth):
+            next_frontier = []
+            for parent in frontier:
+                for i in range(fanout):
+                    folder_id = f"{parent}-{i}"
+                    folders[folder_id] = dict(name=f"Folder {level}.{i}", parent=parent)
+                    next_frontier.append(folder_id)
+            frontier = next_frontier
+        folder_ids = list(folders)
+        fixture_documents = {}
+        for i in range(documents):
+            html = "".join(f"<p>{paragraph}</p>" for paragraph in synthetic.paragraphs(rng, size))
+            fixture_documents[f"doc{i}"] = dict(
+                name=f"Document {i}",
+                parent=folder_ids[i % len(folder_ids)],
+                modifiedTime=drive_timestamp(1600000000 + i),
+                content=base64.b64encode(f"<html><body>{html}</body></html>".encode("utf8")).decode("ascii"),
+            )
+        return cls(dict(root_id="root", folders=folders, documents=fixture_documents), seed=seed, **kwargs)
+
+    @property
+    def api_endpoint(self):
+        """What to set the googledrive source's ``api_endpoint`` to."""
+        return f"{self.url}drive/v3/"
+
+    def fixture(self):
+        return dict(root_id=self.root_id, folders=self.folders, documents=self.documents)
+
+    def touch(self, doc_id):
+        """Edit a document, recording the change for the Changes API."""
+        document = self.documents[doc_id]
+        document["modifiedTime"] = drive_timestamp(time.time())
+        self._content[doc_id] += b"\n"
+        self.changes.append(doc_id)
+
+    def rename(self, file_id, name):
+        """Rename a document or folder, recording the change."""
+        (self.folders.get(file_id) or self.documents[file_id])["name"] = name
+        self.changes.append(file_id)
+
+    def remove(self, file_id):
+        """Delete a document or an empty folder, recording the change."""
+        self.folders.pop(file_id, None) or self.documents.pop(file_id)
+        self.changes.append(file_id)
+
+    def file(self, file_id):
+        if file_id in self.folders:
+            return dict(id=file_id, name=self.folders[file_id]["name"], mimeType=DRIVE_FOLDER_MIME_TYPE)
+        document = self.documents[file_id]
+        return dict(
+            id=file_id, name=document["name"], mimeType=DRIVE_DOCUMENT_MIME_TYPE, modifiedTime=document["modifiedTime"]
+        )
+
+    def parent(self, file_id):
+        return (self.folders.get(file_id) or self.documents.get(file_id))["parent"]
+
+    def list_files(self, query):
+        # Understands the queries the googledrive source makes: "'<id>' in parents and (mimeType = '<type>' or ...)"
+        parent = re.search(r"'([^']+)' in parents", query.get("q", ""))
+        if parent and not query.get("pageToken"):
+            self.listed.append(parent.group(1))
+        mime_types = set(re.findall(r"mimeType = '([^']+)'", query.get("q", "")))
+        files = [
+            self.file(file_id)
+            for file_id in list(self.folders) + list(self.documents)
+            if parent and self.parent(file_id) == parent.group(1)
+        ]
+        files = [file_ for file_ in files if not mime_types or file_["mimeType"] in mime_types]
+        start = int(query.get("pageToken", 0))
+        end = start + min(int(query.get("pageSize", 100)), self.page_size or 1000)
+        response = dict(files=files[start:end])
+        if end < len(files):
+            response["nextPageToken"] = str(end)
+        return json_response(response)
+
+    def list_changes(self, query):
+        start = int(query["pageToken"])
+        end = start + int(query.get("pageSize", 100))
+        changes = [
+            dict(fileId=file_id, removed=False, file=dict(parents=[self.parent(file_id)]))
+            if file_id in self.folders or file_id in self.documents
+            else dict(fileId=file_id, removed=True)
+            for file_id in self.changes[start:end]
+        ]
+        response = dict(changes=changes)
+        if end < len(self.changes):
+            response["nextPageToken"] = str(end)
+        else:
+            response["newStartPageToken"] = str(len(self.changes))
+        return json_response(response)
+
+    def export(self, doc_id, headers):
+        content = self._content[doc_id]
+        byte_range = re.match(r"bytes=(\d+)-(\d*)", headers.get("Range", ""))
+        if not byte_range:
+            return 200, {"Content-Type": "application/octet-stream"}, content
+        start = int(byte_range.group(1))
+        end = min(int(byte_range.group(2) or len(content) - 1), len(content) - 1)
+        if start >= len(content):
+            return 416, {"Content-Range": f"bytes */{len(content)}"}, b""
+        after = end + 1
+        return 206, {"Content-Range": f"bytes {start}-{end}/{len(content)}"}, content[start:after]
+
+    def route(self, path, query, headers):
+        parts = path.strip("/").split("/")
+        if parts[:2] != ["drive", "v3"]:
+            return not_found()
+        parts = parts[2:]
+        if parts == ["files"]:
+            return self.list_files(query)
+        if parts[0] == "files" and len(parts) >= 2 and (parts[1] in self.folders or parts[1] in self.documents):
+            if len(parts) == 2:
+                return json_response(self.file(parts[1]))
+            if parts[2:] == ["export"] and parts[1] in self.documents:
+                return self.export(parts[1], headers)
+        if parts == ["changes", "startPageToken"]:
+            return json_response(dict(startPageToken=str(len(self.changes))))
+        if parts == ["changes"]:
+            return self.list_changes(query)
+        return not_found()
@@ -0,0 +1,129 @@
+import atexit
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+
+from aletheia import DEFAULTS, __version__
+from aletheia.metrics import cpu_time, tree_stats
+
+from .suite import BENCHMARKS, Fixtures
+
+
+logger = logging.getLogger(__name__)
+RESULTS_VERSION = 1
+# Everything that shapes a run, and so has to match for two runs to be comparable
+PARAMS = (
+    "files",
+    "size",
+    "depth",
+    "fanout",
+    "image_ratio",
+    "seed",
+    "pipelines",
+    "jobs",
+    "concurrency",
+    "latency",
+    "throughput",
+    "throttle_rate",
+    "repeat",
+    "warmup",
+)
+
+
+def summarize(wall_times, cpu_times):
+    return dict(
+        wall=wall_times,
+        cpu=cpu_times,
+        min=min(wall_times),
+        median=statistics.median(wall_times),
+        mean=statistics.mean(wall_times),
+        stdev=statistics.stdev(wall_times) if len(wall_times) > 1 else 0.0,
+        cpu_median=statistics.median(cpu_times),
+    )
+
+
+def run_benchmarks(params, names=None):
+    """Run the named benchmarks, or all of them, and return the results as a dict ready to be saved."""
+    scratch = tempfile.mkdtemp(prefix="aletheia-bench-")
+    # Registered before any plugin's cleanup, so it runs after all of them
+    atexit.register(shutil.rmtree, scratch, ignore_errors=True)
+    config = DEFAULTS.copy()
+    # Measure cold builds, and keep the cache out of the user's home directory
+    config.update(cache=False, cache_dir=os.path.join(scratch, "cache"), jobs=params.jobs)
+    fixtures = Fixtures(os.path.join(scratch, "fixtures"), params)
+
+    results = {}
+    saved_tempdir = tempfile.tempdir
+    tempfile.tempdir = scratch
+    try:
+        for name in names or BENCHMARKS:
+            bench = BENCHMARKS[name]
+            missing = [tool for tool in bench.requires if not shutil.which(tool)]
+            if missing:
+                logger.info(f"Skipping {name}: {', '.join(missing)} not found.")
+                results[name] = dict(skipped=f"{', '.join(missing)} not found")
+                continue
+            logger.info(f"Running {name}.")
+            wall_times, cpu_times = [], []
+            for i in range(params.warmup + params.repeat):
+                func = bench.func(fixtures, tempfile.mkdtemp(prefix=f"{name}-"), config)
+                start_wall, start_cpu = time.perf_counter(), cpu_time()
+                output = func()
+                wall, cpu = time.perf_counter() - start_wall, cpu_time() - start_cpu
+                if i >= params.warmup:
+                    wall_times.append(wall)
+                    cpu_times.append(cpu)
+            results[name] = summarize(wall_times, cpu_times)
+            if isinstance(output, str) and os.path.isdir(output):
+                results[name]["files"], results[name]["bytes"] = tree_stats(output)
+            logger.info(f"{name}: median {results[name]['median']:.3f}s over {params.repeat} runs.")
+    finally:
+        tempfile.tempdir = saved_tempdir
+        fixtures.close()
+
+    return dict(
+        version=RESULTS_VERSION,
+        created=datetime.datetime.utcnow().isoformat() + "Z",
+        aletheia_version=__version__,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpu_count=os.cpu_count(),
+        params={key: getattr(params, key) for key in PARAMS},
+        results=results,
+    )
+
+
+def save(results, path):
+    with open(path, "w") as ofs:
+        json.dump(results, ofs, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as ifs:
+        results = json.load(ifs)
+    if results.get("version") != RESULTS_VERSION:
+        raise ValueError(f"{path} holds results in an unsupported format.")
+    return results
+
+
+def compare(baseline, current, threshold=0.1):
+    """Compare the median time of each benchmark run in both result sets.
+
+    Returns ``(name, baseline_median, current_median, ratio, regressed)`` for each, in the current run's order.
+    """
+    if baseline["params"] != current["params"]:
+        logger.warning("The runs were made with different parameters, so their timings aren't comparable.")
+    rows = []
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if not base or "skipped" in base or "skipped" in result:
+            continue
+        ratio = result["median"] / base["median"] if base["median"] else float("inf")
+        rows.append((name, base["median"], result["median"], ratio, ratio > 1 + threshold))
+    return rows
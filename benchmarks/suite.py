@@ -0,0 +1,257 @@
+"""The benchmarks themselves.
+
+A benchmark does its setup in a fresh working directory and returns the callable to be timed.
+"""
+import collections
+import os
+
+import yaml
+
+from aletheia import command, pipeline
+from aletheia.builders import sphinx
+from aletheia.utils import copytree
+
+from . import fakes, synthetic
+
+
+Benchmark = collections.namedtuple("Benchmark", "name func requires description")
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name, requires=()):
+    def decorator(func):
+        BENCHMARKS[name] = Benchmark(name, func, tuple(requires), (func.__doc__ or "").strip())
+        return func
+
+    return decorator
+
+
+class Fixtures:
+    """Input trees and stand-in servers, set up when a benchmark first asks for them and shared by the rest."""
+
+    def __init__(self, path, params):
+        self.path = path
+        self.params = params
+        self._generated = {}
+        self._servers = {}
+
+    def __tree(self, name, generator, **kwargs):
+        if name not in self._generated:
+            self._generated[name] = generator(os.path.join(self.path, name), seed=self.params.seed, **kwargs)
+        return self._generated[name]
+
+    @property
+    def tree_params(self):
+        params = self.params
+        return dict(
+            files=params.files,
+            size=params.size,
+            depth=params.depth,
+            fanout=params.fanout,
+            image_ratio=params.image_ratio,
+        )
+
+    @property
+    def markdown(self):
+        return self.__tree("markdown", synthetic.generate_markdown_tree, **self.tree_params)
+
+    @property
+    def html(self):
+        return self.__tree("html", synthetic.generate_html_tree, **self.tree_params)
+
+    @property
+    def sphinx_project(self):
+        # Sphinx takes orders of magnitude longer per page than anything else here
+        files = max(self.params.files // 10, 1)
+        return self.__tree("sphinx", synthetic.generate_sphinx_project, files=files, size=self.params.size)
+
+    @property
+    def plantuml(self):
+        return self.__tree("plantuml", synthetic.generate_plantuml_tree, files=max(self.params.files // 20, 1))
+
+    def __server(self, name, fake_cls, **kwargs):
+        if name not in self._servers:
+            params = self.params
+            self._servers[name] = fake_cls.generate(
+                size=params.size,
+                seed=params.seed,
+                latency=params.latency,
+                throughput=params.throughput,
+                throttle_rate=params.throttle_rate,
+                **kwargs,
+            ).start()
+        return self._servers[name]
+
+    @property
+    def confluence(self):
+        # Pages come with a couple of attachments each, so there are fewer of them than files in the other trees
+        return self.__server(
+            "confluence", fakes.FakeConfluence, pages=max(self.params.files // 5, 1), attachment_size=self.params.size
+        )
+
+    @property
+    def googledrive(self):
+        return self.__server("googledrive", fakes.FakeDrive, documents=self.params.files, depth=self.params.depth)
+
+    def close(self):
+        for server in self._servers.values():
+            server.stop()
+
+
+def write_pipeline(path, stages):
+    os.makedirs(path, exist_ok=True)
+    pipeline_file = os.path.join(path, "aletheia.yml")
+    with open(pipeline_file, "w") as ofs:
+        yaml.safe_dump({"pipeline": stages}, ofs)
+    return pipeline_file
+
+
+@benchmark("copytree")
+def bench_copytree(fixtures, workdir, config):
+    """Copy the Markdown tree, as the local source and build do."""
+    return lambda: copytree(fixtures.markdown, os.path.join(workdir, "copy"))
+
+
+@benchmark("copytree_link")
+def bench_copytree_link(fixtures, workdir, config):
+    """Link the Markdown tree into place, as merging does."""
+    return lambda: copytree(fixtures.markdown, os.path.join(workdir, "copy"), link=True)
+
+
+@benchmark("pipeline_run")
+def bench_pipeline_run(fixtures, workdir, config):
+    """Run a local source and hugoify pipeline without merging its output."""
+    pipeline_file = write_pipeline(workdir, [{"local": {"path": fixtures.markdown}}, {"hugoify": {}}])
+    pipeline_obj = pipeline.Pipeline(pipeline_file, config=config)
+    pipeline_obj.load()
+    return lambda: pipeline_obj.run(merge=False)
+
+
+@benchmark("pipeline_merge")
+def bench_pipeline_merge(fixtures, workdir, config):
+    """Merge a finished pipeline's output into its directory."""
+    output_dir = os.path.join(workdir, "output")
+    copytree(fixtures.markdown, output_dir)
+    pipeline_obj = pipeline.Pipeline(write_pipeline(os.path.join(workdir, "target"), []), config=config)
+    return lambda: pipeline_obj.merge(output_dir)
+
+
+@benchmark("hugoify")
+def bench_hugoify(fixtures, workdir, config):
+    """Add Hugo front matter to every page of the Markdown tree."""
+    plugin = pipeline.PLUGINS["hugoify"](fixtures.markdown, config=config)
+    return plugin.run
+
+
+@benchmark("sphinx_postprocess")
+def bench_sphinx_postprocess(fixtures, workdir, config):
+    """Rewrite links and strip permalinks from Sphinx's HTML output."""
+    html_dir = os.path.join(workdir, "docs", "_build", "html")
+    copytree(fixtures.html, html_dir)
+    return lambda: sphinx.clean_html_dir(html_dir, 0)
+
+
+@benchmark("sphinx_build", requires=["sphinx-build"])
+def bench_sphinx_build(fixtures, workdir, config):
+    """Build a Sphinx project from scratch and post-process it."""
+    project_dir = os.path.join(workdir, "project")
+    copytree(fixtures.sphinx_project, project_dir)
+    return pipeline.PLUGINS["sphinx"](project_dir, config=config).run
+
+
+@benchmark("pandoc", requires=["pandoc"])
+def bench_pandoc(fixtures, workdir, config):
+    """Convert the HTML tree to Markdown with a pandoc process per page."""
+    return pipeline.PLUGINS["pandoc"](fixtures.html, config=config, format="html").run
+
+
+@benchmark("pandoc_server", requires=["pandoc"])
+def bench_pandoc_server(fixtures, workdir, config):
+    """Convert the HTML tree to Markdown through pandoc server."""
+    return pipeline.PLUGINS["pandoc"](fixtures.html, config=config, format="html", mode="server").run
+
+
+@benchmark("plantuml", requires=["plantuml"])
+def bench_plantuml(fixtures, workdir, config):
+    """Render a directory of PlantUML diagrams."""
+    return pipeline.PLUGINS["plantuml"](fixtures.plantuml, config=config).run
+
+
+@benchmark("build")
+def bench_build(fixtures, workdir, config):
+    """Build a tree of several local source and hugoify pipelines end to end."""
+    src = os.path.join(workdir, "src")
+    for i in range(fixtures.params.pipelines):
+        write_pipeline(
+            os.path.join(src, f"source{i}"),
+            [{"local": {"path": fixtures.markdown}}, {"hugoify": {"weight": i}}],
+        )
+    return lambda: command.build(os.path.join(workdir, "site"), path=src, config=config)
+
+
+def confluence_source(fixtures, config, fetch):
+    # Credentials still come from the environment, but the stand-in doesn't check them
+    os.environ.setdefault("ATLASSIAN_API_USERNAME", "benchmark")
+    os.environ.setdefault("ATLASSIAN_API_KEY", "benchmark")
+    fake = fixtures.confluence
+    source_cls = pipeline.PLUGINS["confluence"]
+    return source_cls(
+        config=config, page_id=fake.root_id, url=fake.url, fetch=fetch, concurrency=fixtures.params.concurrency
+    )
+
+
+def googledrive_source(fixtures, config):
+    fake = fixtures.googledrive
+    return pipeline.PLUGINS["googledrive"](
+        config=config,
+        folder_id=fake.root_id,
+        format="html",
+        recursive=True,
+        api_endpoint=fake.api_endpoint,
+        anonymous=True,
+        concurrency=fixtures.params.concurrency,
+    )
+
+
+def touch_some(fake, ids, fraction=0.1):
+    ids = sorted(ids)
+    for file_id in ids[:: max(int(1 / fraction), 1)]:
+        fake.touch(file_id)
+
+
+@benchmark("confluence")
+def bench_confluence(fixtures, workdir, config):
+    """Download a Confluence page tree from a local stand-in, as Word exports."""
+    return confluence_source(fixtures, config, "word").run
+
+
+@benchmark("confluence_export_view")
+def bench_confluence_export_view(fixtures, workdir, config):
+    """Download a Confluence page tree from a local stand-in, as rendered HTML and attachments."""
+    return confluence_source(fixtures, config, "export_view").run
+
+
+@benchmark("confluence_resync")
+def bench_confluence_resync(fixtures, workdir, config):
+    """Bring a stored Confluence page tree up to date after a tenth of its pages changed."""
+    config = config.copy()
+    config.cache = True
+    confluence_source(fixtures, config, "export_view").run()
+    touch_some(fixtures.confluence, fixtures.confluence.pages)
+    return confluence_source(fixtures, config, "export_view").run
+
+
+@benchmark("googledrive")
+def bench_googledrive(fixtures, workdir, config):
+    """Export a Google Drive folder tree from a local stand-in."""
+    return googledrive_source(fixtures, config).run
+
+
+@benchmark("googledrive_resync")
+def bench_googledrive_resync(fixtures, workdir, config):
+    """Bring a Google Drive folder tree's exports up to date after a tenth of its documents changed."""
+    config = config.copy()
+    config.cache = True
+    googledrive_source(fixtures, config).run()
+    touch_some(fixtures.googledrive, fixtures.googledrive.documents)
+    return googledrive_source(fixtures, config).run
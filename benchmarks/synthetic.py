@@ -0,0 +1,145 @@
+"""Generators for synthetic documentation trees.
+
+Every generator is deterministic for a given seed, so that runs on different machines or releases measure the
+same input.
+"""
+import os
+import random
+
+
+WORDS = (
+    "aletheia documentation pipeline source builder converter merge tree page section cluster deploy operator "
+    "install configure upgrade network storage cache release service monitor alert metric console account "
+    "project namespace route secret volume image registry token"
+).split()
+# Enough of a PNG header that anything sniffing file types treats the image as one
+PNG_HEADER = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR"
+
+
+def __directories(depth, fanout):
+    dirs = [""]
+    frontier = [""]
+    for _ in range(depth):
+        frontier = [os.path.join(parent, f"section{i}") for parent in frontier for i in range(fanout)]
+        dirs.extend(frontier)
+    return dirs
+
+
+def text(rng, size):
+    words, length = [], 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def paragraphs(rng, size, paragraph_size=400):
+    paragraphs = []
+    while size > 0:
+        paragraphs.append(text(rng, min(size, paragraph_size)))
+        size -= paragraph_size
+    return paragraphs
+
+
+def plan_tree(files=200, depth=3, fanout=3, image_ratio=0.1, seed=0):
+    """Return ``(rel_dir, name, is_image)`` for every file in a tree, spread evenly across its directories."""
+    rng = random.Random(seed)
+    dirs = __directories(depth, fanout)
+    return [
+        (dirs[i % len(dirs)], f"image{i}" if is_image else f"page{i}", is_image)
+        for i, is_image in ((i, rng.random() < image_ratio) for i in range(files))
+    ]
+
+
+def random_bytes(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, "little") if size > 0 else b""
+
+
+def write_image(path, rng, size):
+    with open(path, "wb") as ofs:
+        ofs.write(PNG_HEADER + random_bytes(rng, size - len(PNG_HEADER)))
+
+
+def generate_markdown_tree(path, files=200, size=4096, depth=3, fanout=3, image_ratio=0.1, seed=0):
+    """Write a tree of Markdown pages and PNG images, with an index page in every directory."""
+    rng = random.Random(seed)
+    plan = plan_tree(files, depth, fanout, image_ratio, seed)
+    pages = [os.path.join(rel_dir, f"{name}.md") for rel_dir, name, is_image in plan if not is_image]
+    for rel_dir in sorted({rel_dir for rel_dir, _, _ in plan}):
+        os.makedirs(os.path.join(path, rel_dir), exist_ok=True)
+        with open(os.path.join(path, rel_dir, "index.md"), "w") as ofs:
+            ofs.write(f"# {os.path.basename(rel_dir) or 'Home'}\n\n{text(rng, 200)}\n")
+    for rel_dir, name, is_image in plan:
+        if is_image:
+            write_image(os.path.join(path, rel_dir, f"{name}.png"), rng, size)
+            continue
+        lines = [f"# {name.title()} {text(rng, 30)}", ""]
+        for paragraph in paragraphs(rng, size):
+            link = os.path.relpath(rng.choice(pages), rel_dir or ".")
+            lines.extend([f"{paragraph} [see also]({link})", ""])
+        with open(os.path.join(path, rel_dir, f"{name}.md"), "w") as ofs:
+            ofs.write("\n".join(lines))
+    return path
+
+
+def generate_html_tree(path, files=200, size=4096, depth=3, fanout=3, image_ratio=0.1, seed=0):
+    """Write a tree shaped like Sphinx's HTML output, with permalink anchors and relative links between pages."""
+    rng = random.Random(seed)
+    plan = plan_tree(files, depth, fanout, image_ratio, seed)
+    pages = [os.path.join(rel_dir, f"{name}.html") for rel_dir, name, is_image in plan if not is_image]
+    for rel_dir in sorted({rel_dir for rel_dir, _, _ in plan}):
+        os.makedirs(os.path.join(path, rel_dir, "_images"), exist_ok=True)
+    for rel_dir, name, is_image in plan:
+        if is_image:
+            write_image(os.path.join(path, rel_dir, "_images", f"{name}.png"), rng, size)
+            continue
+        body = []
+        for i, paragraph in enumerate(paragraphs(rng, size)):
+            link = os.path.relpath(rng.choice(pages), rel_dir or ".")
+            body.append(
+                f'<div class="section" id="s{i}"><h2>Section {i}<a class="headerlink" href="#s{i}" title="Permalink">'
+                f'¶</a></h2>\n<p>{paragraph} <a class="reference internal" href="{link}#s0">see also</a> '
+                f'<a class="reference external" href="https://example.com/{name}.html">upstream</a></p></div>'
+            )
+        with open(os.path.join(path, rel_dir, f"{name}.html"), "w") as ofs:
+            ofs.write(
+                f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{name}</title></head>\n'
+                f'<body><div class="document"><h1>{name}<a class="headerlink" href="#">¶</a></h1>\n'
+                + "\n".join(body)
+                + "</div></body></html>\n"
+            )
+    return path
+
+
+def generate_sphinx_project(path, files=50, size=2048, depth=1, fanout=3, seed=0, dir="docs"):
+    """Write a minimal Sphinx project whose master document globs in every page."""
+    rng = random.Random(seed)
+    docs_dir = os.path.join(path, dir)
+    os.makedirs(docs_dir, exist_ok=True)
+    with open(os.path.join(docs_dir, "conf.py"), "w") as ofs:
+        ofs.write('project = "Benchmark"\nmaster_doc = "index"\nexclude_patterns = ["_build"]\n')
+    with open(os.path.join(docs_dir, "index.rst"), "w") as ofs:
+        ofs.write("Benchmark\n=========\n\n.. toctree::\n   :glob:\n\n   **\n")
+    for rel_dir, name, _ in plan_tree(files, depth, fanout, 0, seed):
+        os.makedirs(os.path.join(docs_dir, rel_dir), exist_ok=True)
+        title = f"{name.title()} {text(rng, 20)}"
+        lines = [title, "=" * len(title), ""]
+        for i, paragraph in enumerate(paragraphs(rng, size)):
+            heading = f"Section {i}"
+            lines.extend([heading, "-" * len(heading), "", paragraph, ""])
+        with open(os.path.join(docs_dir, rel_dir, f"{name}.rst"), "w") as ofs:
+            ofs.write("\n".join(lines))
+    return path
+
+
+def generate_plantuml_tree(path, files=10, seed=0):
+    """Write a directory of small PlantUML sequence diagrams."""
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    for i in range(files):
+        actors = rng.sample(WORDS, 4)
+        messages = [f"{rng.choice(actors)} -> {rng.choice(actors)}: {rng.choice(WORDS)}" for _ in range(10)]
+        with open(os.path.join(path, f"diagram{i}.puml"), "w") as ofs:
+            ofs.write("@startuml\n" + "\n".join(messages) + "\n@enduml\n")
+    return path
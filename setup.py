@@ -11,7 +11,7 @@ setup(
     author='Joshua "jag" Ginsberg',
     url="https://github.com/j00bar/aletheia",
     license="GPLv3",
-    packages=find_packages(exclude="tests"),
+    packages=find_packages(exclude=("tests", "benchmarks", "benchmarks.*")),
     include_package_data=True,
     long_description=long_description,
     long_description_content_type="text/markdown",
@@ -19,11 +19,15 @@ setup(
     install_requires=[
         "semver>=2.10.0",
         "beautifulsoup4>=4.9.0",
+        "lxml>=4.5",
         "pyyaml~=5.3",
         "atlassian-python-api@https://github.com/atlassian-api/atlassian-python-api/archive/e8142c60ddbb1678e4b031a3abb64375cfe4df67.zip",  # noqa: E501
         "google-api-python-client>=1.8.3",
         "google-auth-httplib2>=0.0.3",
         "google-auth-oauthlib>=0.4.1",
+        "httplib2>=0.15.0",
+        "requests>=2.20",
+        'importlib_metadata; python_version < "3.8"',
         "python-dateutil>=2.8.1",
         "sphinxcontrib-applehelp",
         "sphinxcontrib-htmlhelp",
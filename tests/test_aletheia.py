@@ -1,5 +1,1128 @@
+import os
+
+import pytest
+
 from aletheia import __version__
 
 
+@pytest.fixture
+def config(tmp_path):
+    """Settings that keep every cache under the test's own directory and retry requests quickly."""
+    from aletheia import DEFAULTS
+
+    config = DEFAULTS.copy()
+    config.update(cache_dir=str(tmp_path / "cache"), http_backoff=0.01)
+    return config
+
+
+@pytest.fixture
+def atlassian_env(monkeypatch):
+    monkeypatch.setenv("ATLASSIAN_API_USERNAME", "user")
+    monkeypatch.setenv("ATLASSIAN_API_KEY", "key")
+
+
+@pytest.fixture
+def git_remote(tmp_path, monkeypatch):
+    """Send https://example.test/docs to a local repository, returning a function that commits a file to it."""
+    import subprocess
+
+    remote = tmp_path / "remote"
+    (remote / "docs").mkdir(parents=True)
+    (tmp_path / "home").mkdir()
+    (tmp_path / "home" / ".gitconfig").write_text(
+        f'[user]\nname = Test\nemail = test@example.com\n[url "{remote}/"]\ninsteadOf = https://example.test/\n'
+    )
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    monkeypatch.setenv("GIT_CONFIG_NOSYSTEM", "1")
+    subprocess.run(["git", "init", "-q"], cwd=str(remote / "docs"), check=True)
+
+    def commit(filename):
+        (remote / "docs" / filename).write_text(filename)
+        for args in (["add", "."], ["commit", "-q", "-m", filename], ["branch", "-M", "master"]):
+            subprocess.run(["git"] + args, cwd=str(remote / "docs"), check=True)
+
+    return commit
+
+
+def contents(path, mtimes=False):
+    """Map each file under path to its content, and its mtime too if asked."""
+    tree = {}
+    for root, dirs, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(root, filename)
+            with open(file_path, "rb") as ifs:
+                data = ifs.read()
+            tree[os.path.relpath(file_path, path)] = (data, os.stat(file_path).st_mtime) if mtimes else data
+    return tree
+
+
+def install_tool(bin_dir, name, source):
+    """Write a Python script to bin_dir that stands in for the named executable."""
+    import sys
+
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    (bin_dir / name).write_text(f"#!{sys.executable}\n{source}")
+    (bin_dir / name).chmod(0o755)
+    return str(bin_dir / name)
+
+
+FAKE_PANDOC = """
+import http.server, json, os, sys
+
+VERSION = "%s"
+args = sys.argv[1:]
+
+
+def log(mode):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "calls.log"), "a") as ofs:
+        ofs.write(mode + "\\n")
+
+
+if args == ["--version"]:
+    print("pandoc " + VERSION)
+elif args[0] == "server":
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def respond(self, data):
+            body = json.dumps(data).encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.respond(VERSION)
+
+        def do_POST(self):
+            params = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            log("server")
+            self.respond(dict(output="converted " + params["text"]))
+
+        def log_message(self, *args):
+            pass
+
+    http.server.ThreadingHTTPServer(("127.0.0.1", int(args[2])), Handler).serve_forever()
+else:
+    log("process")
+    with open(args[-3]) as ifs, open(args[-1], "w") as ofs:
+        ofs.write("converted " + ifs.read())
+"""
+
+
 def test_version():
     assert __version__ == "0.1.0"
+
+
+def test_concurrent_pipelines_match_serial_and_merge_despite_failures(tmp_path):
+    from aletheia import DEFAULTS, command
+    from aletheia.exceptions import ConfigError
+
+    for name in ("a", "c"):
+        (tmp_path / "sources" / name).mkdir(parents=True)
+        (tmp_path / "sources" / name / "page.md").write_text(f"# {name}\n")
+    trees = {}
+    for jobs in (1, 4):
+        tree = tmp_path / f"tree-{jobs}"
+        for name in ("a", "b", "c", "a/nested"):
+            (tree / name).mkdir(parents=True)
+        for name in ("a", "c", "a/nested"):
+            source = tmp_path / "sources" / name.split("/")[0]
+            (tree / name / "aletheia.yml").write_text(f"pipeline:\n- local:\n    path: {source}\n- hugoify: {{}}\n")
+        (tree / "b" / "aletheia.yml").write_text("pipeline:\n- nonexistent: {}\n")
+        config = DEFAULTS.copy()
+        config.update(cache=False, jobs=jobs)
+        try:
+            command.assemble(str(tree), config=config)
+        except ConfigError:
+            pass
+        else:
+            raise AssertionError("Expected ConfigError")
+        trees[jobs] = contents(str(tree))
+
+    assert trees[1] == trees[4]
+    # The failure is raised once the rest of its wave has merged, before any nested pipeline runs
+    assert "a/page.md" in trees[1] and "c/page.md" in trees[1] and "a/nested/page.md" not in trees[1]
+
+
+def test_cache_put_get_and_evict(tmp_path):
+    from aletheia.cache import Cache, make_key
+
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "page.md").write_text("x" * 100)
+    cache = Cache(str(tmp_path / "cache"), size_limit=150)
+
+    first, second = make_key("hugoify", {}, "a"), make_key("hugoify", {}, "b")
+    assert cache.get(first) is None
+    entry_path = cache.put(first, str(src))
+    assert cache.get(first) == entry_path
+    assert open(os.path.join(entry_path, "page.md")).read() == "x" * 100
+
+    # Storing a second 100-byte entry goes over the limit and evicts the least recently used one
+    cache.put(second, str(src))
+    assert cache.get(first) is None
+    assert cache.get(second)
+
+    # Entries are only all read again once the running total goes over the limit
+    evictions = []
+    cache = Cache(str(tmp_path / "cache"), size_limit=350)
+    evict = cache.evict
+    cache.evict = lambda **kwargs: evictions.append(None) or evict(**kwargs)
+    for i in range(3):
+        cache.put(make_key("hugoify", {}, i), str(src))
+    assert len(evictions) == 1
+    assert cache.get(second) is None
+    assert all(cache.get(make_key("hugoify", {}, i)) for i in range(3))
+
+
+def test_cache_keeps_entries_being_committed_or_used(tmp_path):
+    from aletheia.cache import Cache, make_key
+    from aletheia.utils import locked
+
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "page.md").write_text("x" * 5000)
+    cache = Cache(str(tmp_path / "cache"), size_limit=1000)
+    in_use, large = make_key("in use"), make_key("large")
+
+    # An entry on its own over the limit is still there once it's committed
+    cache.put(in_use, str(tmp_path / "src"))
+    assert cache.get(in_use)
+    # While its lock is held, nothing else evicts it either
+    with locked(cache.lock_path(in_use)):
+        cache.put(large, str(tmp_path / "src"))
+        assert cache.get(in_use) and os.path.isfile(os.path.join(cache.entry_path(in_use), "page.md"))
+        assert cache.get(large)
+    # Until it's no longer in use
+    cache.put(make_key("next"), str(tmp_path / "src"))
+    assert not cache.get(in_use) and not cache.get(large)
+
+
+def test_pipeline_stage_cache_hits_and_misses(tmp_path, monkeypatch, config):
+    import tempfile
+
+    from aletheia.pipeline import Pipeline
+    from aletheia.sources.local import Source
+    from aletheia.utils import copytree
+
+    runs = []
+
+    class Counting:
+        TOOLS = ("fake-tool",)
+
+        def __init__(self, working_dir, config, **kwargs):
+            self.working_dir = working_dir
+
+        def run(self):
+            runs.append(self.working_dir)
+            output_dir = tempfile.mkdtemp(dir=str(tmp_path))
+            copytree(self.working_dir, output_dir, nonempty_ok=True)
+            return output_dir
+
+        def cleanup(self):
+            pass
+
+    def set_tool_version(version, mtime):
+        (tmp_path / "bin" / "fake-tool").write_text(f"#!/bin/sh\necho fake-tool {version}\n")
+        (tmp_path / "bin" / "fake-tool").chmod(0o755)
+        os.utime(str(tmp_path / "bin" / "fake-tool"), (mtime, mtime))
+
+    (tmp_path / "bin").mkdir()
+    set_tool_version("1.0", 1000000000)
+    monkeypatch.setenv("PATH", f"{tmp_path / 'bin'}{os.pathsep}{os.environ['PATH']}")
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "page.md").write_text("First")
+    (tmp_path / "aletheia.yml").write_text("pipeline: []\n")
+
+    def run():
+        pipeline_obj = Pipeline(str(tmp_path / "aletheia.yml"), config=config)
+        pipeline_obj.pipeline = [
+            ("local", Source, dict(path=str(tmp_path / "src")), False),
+            ("counting", Counting, {}, False),
+        ]
+        with open(os.path.join(pipeline_obj.run(merge=False), "page.md")) as ifs:
+            return ifs.read()
+
+    assert run() == "First" and len(runs) == 1
+    assert run() == "First" and len(runs) == 1
+    (tmp_path / "src" / "page.md").write_text("Second")
+    assert run() == "Second" and len(runs) == 2
+    set_tool_version("2.0", 1000000001)
+    assert run() == "Second" and len(runs) == 3
+
+
+def test_pipeline_stage_cache_hits_after_a_fresh_git_clone(tmp_path, config, git_remote):
+    import tempfile
+    import time
+
+    from aletheia.pipeline import Pipeline
+    from aletheia.sources.git import Source
+    from aletheia.utils import copytree
+
+    runs = []
+
+    class Counting:
+        def __init__(self, working_dir, config, **kwargs):
+            self.working_dir = working_dir
+
+        def run(self):
+            runs.append(self.working_dir)
+            output_dir = tempfile.mkdtemp(dir=str(tmp_path))
+            copytree(self.working_dir, output_dir, nonempty_ok=True)
+            return output_dir
+
+        def cleanup(self):
+            pass
+
+    (tmp_path / "aletheia.yml").write_text("pipeline: []\n")
+
+    def run():
+        pipeline_obj = Pipeline(str(tmp_path / "aletheia.yml"), config=config)
+        pipeline_obj.pipeline = [
+            ("git", Source, dict(hostname="example.test", repo="docs"), False),
+            ("counting", Counting, {}, False),
+        ]
+        return sorted(os.listdir(pipeline_obj.run(merge=False)))
+
+    git_remote("page.md")
+    assert run() == [".git", "page.md"] and len(runs) == 1
+    # Each clone's .git records when it was made, but the same commit is still a cache hit
+    time.sleep(1)
+    assert run() == [".git", "page.md"] and len(runs) == 1
+    git_remote("other.md")
+    assert run() == [".git", "other.md", "page.md"] and len(runs) == 2
+
+
+def test_pandoc_reuses_cached_conversions(tmp_path, monkeypatch, config):
+    from aletheia.converters.pandoc import Plugin
+
+    install_tool(tmp_path / "bin", "pandoc", FAKE_PANDOC % "3.1")
+    monkeypatch.setenv("PATH", f"{tmp_path / 'bin'}{os.pathsep}{os.environ['PATH']}")
+    for name in ("one", "two"):
+        (tmp_path / "src" / "sub").mkdir(parents=True, exist_ok=True)
+        (tmp_path / "src" / "sub" / f"{name}.html").write_text(f"<p>{name}</p>")
+
+    def run():
+        plugin = Plugin(str(tmp_path / "src"), config=config, format="html")
+        output_dir = plugin.run()
+        with open(os.path.join(output_dir, "sub", "one.md")) as ifs:
+            return ifs.read()
+
+    assert run() == "converted <p>one</p>"
+    assert (tmp_path / "bin" / "calls.log").read_text() == "process\n" * 2
+    assert run() == "converted <p>one</p>"
+    assert (tmp_path / "bin" / "calls.log").read_text() == "process\n" * 2
+    (tmp_path / "src" / "sub" / "one.html").write_text("<p>changed</p>")
+    assert run() == "converted <p>changed</p>"
+    assert (tmp_path / "bin" / "calls.log").read_text() == "process\n" * 3
+
+
+def test_pandoc_server_mode_matches_process_mode_and_falls_back(tmp_path, monkeypatch, config):
+    from aletheia.converters.pandoc import Plugin
+
+    (tmp_path / "src").mkdir()
+    for i in range(5):
+        (tmp_path / "src" / f"page{i}.html").write_text(f"<p>{i}</p>")
+        os.utime(str(tmp_path / "src" / f"page{i}.html"), (1000000000 + i, 1000000000 + i))
+    (tmp_path / "src" / "image.png").write_bytes(b"\x89PNG")
+    config.update(cache=False)
+
+    def run(version, mode):
+        bin_dir = tmp_path / f"bin-{version}"
+        if not bin_dir.exists():
+            install_tool(bin_dir, "pandoc", FAKE_PANDOC % version)
+        monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+        output_dir = Plugin(str(tmp_path / "src"), config=config, format="html", mode=mode).run()
+        calls = (bin_dir / "calls.log").read_text().split()
+        (bin_dir / "calls.log").unlink()
+        tree = {
+            filename: (
+                open(os.path.join(output_dir, filename), "rb").read(),
+                os.stat(os.path.join(output_dir, filename)).st_mtime,
+            )
+            for filename in os.listdir(output_dir)
+        }
+        return tree, calls
+
+    expected, calls = run("3.1", "process")
+    assert calls == ["process"] * 5
+    assert expected["page3.md"] == (b"converted <p>3</p>", 1000000003)
+    assert expected["image.png"][0] == b"\x89PNG"
+    # Every document is streamed through the one server process
+    assert run("3.1", "server") == (expected, ["server"] * 5)
+    # pandoc 2 has no server, so each document gets its own process
+    assert run("2.19", "server") == (expected, ["process"] * 5)
+
+
+def test_plantuml_attributes_batch_errors_to_the_broken_diagram(tmp_path, monkeypatch, config):
+    from aletheia.builders.plantuml import Plugin
+    from aletheia.exceptions import AletheiaException
+
+    install_tool(
+        tmp_path / "bin",
+        "plantuml",
+        """
+import os, sys
+
+if sys.argv[1:] == ["--version"]:
+    print("PlantUML version 1.2023.1")
+    sys.exit()
+file_paths = sys.argv[sys.argv.index("-nbthread") + 2:]
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "calls.log"), "a") as ofs:
+    ofs.write(" ".join(os.path.basename(path) for path in file_paths) + "\\n")
+status = 0
+for path in file_paths:
+    if "broken" in open(path).read():
+        status = 1
+        if os.environ.get("FAKE_PLANTUML_NAMES_FILE"):
+            print(f"Error line 1 in file: {path}", file=sys.stderr)
+    else:
+        open(os.path.splitext(path)[0] + ".png", "w").write("png")
+if status:
+    print("Some diagram description contains errors", file=sys.stderr)
+sys.exit(status)
+""",
+    )
+    monkeypatch.setenv("PATH", f"{tmp_path / 'bin'}{os.pathsep}{os.environ['PATH']}")
+    (tmp_path / "src").mkdir()
+    for name in ("a", "b", "c"):
+        (tmp_path / "src" / f"{name}.puml").write_text("@startuml\nA -> B\n@enduml\n")
+    config.update(cache=False)
+
+    output_dir = Plugin(str(tmp_path / "src"), config=config).run()
+    assert sorted(os.listdir(output_dir)) == ["a.png", "b.png", "c.png"]
+
+    (tmp_path / "src" / "b.puml").write_text("@startuml\nbroken\n@enduml\n")
+    for names_file in ("1", ""):
+        monkeypatch.setenv("FAKE_PLANTUML_NAMES_FILE", names_file)
+        (tmp_path / "bin" / "calls.log").write_text("")
+        try:
+            Plugin(str(tmp_path / "src"), config=config).run()
+        except AletheiaException as e:
+            message = str(e)
+        else:
+            raise AssertionError("Expected AletheiaException")
+        assert "b.puml" in message and "a.puml" not in message and "c.puml" not in message
+        calls = (tmp_path / "bin" / "calls.log").read_text().splitlines()
+        assert sorted(calls[0].split()) == ["a.puml", "b.puml", "c.puml"]
+        if names_file:
+            # PlantUML named the broken diagram, so the batch isn't rendered again
+            assert len(calls) == 1
+        else:
+            # Otherwise each diagram is rendered on its own until the broken one is found
+            assert calls[-1] == "b.puml" and all(len(call.split()) == 1 for call in calls[1:])
+
+
+def test_git_source_clones_through_a_shared_mirror(tmp_path, monkeypatch, config, git_remote):
+    import subprocess
+
+    from aletheia import metrics
+    from aletheia.sources.git import Source
+
+    commit = git_remote
+    commit("first.md")
+    commands = []
+    run = metrics.run
+    monkeypatch.setattr(metrics, "run", lambda args, **kwargs: commands.append(args[:2]) or run(args, **kwargs))
+    config.update(git_mirror_dir=str(tmp_path / "mirrors"))
+
+    def checkout():
+        source = Source(config=config, hostname="example.test", repo="docs")
+        working_dir = source.run()
+        alternates = open(os.path.join(working_dir, ".git", "objects", "info", "alternates")).read().strip()
+        assert alternates == os.path.join(source.mirror_path, "objects")
+        origin = subprocess.run(
+            ["git", "config", "remote.origin.url"], cwd=working_dir, stdout=subprocess.PIPE, check=True
+        )
+        assert origin.stdout.decode().strip() == "https://example.test/docs"
+        return sorted(os.listdir(working_dir))
+
+    assert checkout() == [".git", "first.md"]
+    commit("second.md")
+    # The second build fetches the new commit into the existing mirror rather than cloning the remote again
+    assert checkout() == [".git", "first.md", "second.md"]
+    assert commands.count(["git", "clone"]) == 3 and commands.count(["git", "fetch"]) == 1
+    assert sorted(os.listdir(str(tmp_path / "mirrors"))) == [
+        "https-example.test-docs.git",
+        "https-example.test-docs.git.lock",
+    ]
+
+
+def test_copytree_preserves_content_and_mtime(tmp_path):
+    from aletheia.utils import copytree
+
+    src = tmp_path / "src"
+    for i in range(300):
+        path = src / f"dir{i % 3}" / f"file{i}.md"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f"content {i}")
+        os.utime(path, (1000000000 + i, 1000000000 + i))
+
+    for link in (False, True):
+        dest = tmp_path / f"dest-{link}"
+        copytree(str(src), str(dest), link=link)
+        for i in range(300):
+            path = dest / f"dir{i % 3}" / f"file{i}.md"
+            assert path.read_text() == f"content {i}"
+            assert path.stat().st_mtime == 1000000000 + i
+
+    # Copying over a hardlinked file replaces it rather than writing through to the original
+    (tmp_path / "other").mkdir()
+    (tmp_path / "other" / "dir0").mkdir()
+    (tmp_path / "other" / "dir0" / "file0.md").write_text("replaced")
+    copytree(str(tmp_path / "other"), str(tmp_path / "dest-True"), nonempty_ok=True)
+    assert (src / "dir0" / "file0.md").read_text() == "content 0"
+
+    for missing in ("does-not-exist", "other/dir0/file0.md"):
+        try:
+            copytree(str(tmp_path / missing), str(tmp_path / "dest-missing"))
+        except OSError:
+            pass
+        else:
+            raise AssertionError("Expected OSError")
+    assert not (tmp_path / "dest-missing").exists()
+
+
+def test_local_source_with_a_missing_path_renders_an_error_page(tmp_path, config):
+    from aletheia.pipeline import Pipeline
+
+    (tmp_path / "aletheia.yml").write_text(f"pipeline:\n- local:\n    path: {tmp_path / 'missing'}\n- hugoify: {{}}\n")
+    config.update(cache=False)
+    pipeline_obj = Pipeline(str(tmp_path / "aletheia.yml"), config=config)
+    pipeline_obj.load()
+    output_dir = pipeline_obj.run(merge=False)
+    assert os.listdir(output_dir) == [config.error_result_filename]
+    with open(os.path.join(output_dir, config.error_result_filename)) as ifs:
+        assert "FileNotFoundError" in ifs.read()
+
+
+def test_tool_versions_are_remembered_until_the_executable_changes(tmp_path, monkeypatch, config):
+    import json
+
+    from aletheia import utils
+
+    def install(bin_dir, version, mtime):
+        path = install_tool(
+            bin_dir,
+            "probe-tool",
+            f"""
+import os
+with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "calls.log"), "a") as ofs:
+    ofs.write("called\\n")
+print("probe-tool {version}")
+""",
+        )
+        os.utime(path, (mtime, mtime))
+        monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    def get_version():
+        # As a new process would, starting without the versions probed so far
+        monkeypatch.setattr(utils, "_probes", {})
+        version = utils.get_version("probe-tool", config)
+        calls = len((tmp_path / "calls.log").read_text().splitlines())
+        (tmp_path / "calls.log").write_text("")
+        return version, calls
+
+    install(tmp_path / "bin", "1.0", 1000000000)
+    assert get_version() == ("1.0", 1)
+    assert list(json.load(open(str(tmp_path / "cache" / utils.PROBES_FILENAME))).values()) == ["1.0"]
+    assert get_version() == ("1.0", 0)
+    # Upgraded in place
+    install(tmp_path / "bin", "2.0", 1000000001)
+    assert get_version() == ("2.0", 1)
+    assert get_version() == ("2.0", 0)
+    # A different executable earlier on the PATH, even with the same mtime
+    install(tmp_path / "other-bin", "3.0", 1000000001)
+    assert get_version() == ("3.0", 1)
+
+
+def test_host_limiter_backs_off_and_recovers():
+    from aletheia.transport import HostLimiter
+
+    limiter = HostLimiter(max_concurrency=8)
+    for _ in range(2):
+        limiter.acquire()
+        limiter.release(throttled=True)
+    assert limiter.limit == 2.0
+    while limiter.limit < 8:
+        limiter.acquire()
+        limiter.release()
+    assert limiter.limit == 8
+
+
+def test_session_frees_its_slot_when_a_request_fails():
+    import requests
+
+    from aletheia.transport import Session
+    from benchmarks.fakes import FakeServer, json_response
+
+    class Ok(FakeServer):
+        def route(self, path, query, headers):
+            return json_response({})
+
+    session = Session(max_per_host=2, retries=0)
+    with Ok() as server:
+        for _ in range(2):
+            try:
+                session.get(server.url, headers={"X-Broken": "line\nbreak"})
+            except requests.exceptions.InvalidHeader:
+                pass
+            else:
+                raise AssertionError("Expected InvalidHeader")
+        # Otherwise both of the host's slots would be taken, and this would wait forever
+        assert session.pool.limiter(server.url).in_flight == 0
+        assert session.get(server.url, timeout=5).status_code == 200
+
+
+def test_fake_server_started_explicitly_is_not_started_again():
+    import threading
+
+    from benchmarks.fakes import FakeServer
+
+    threads = threading.active_count()
+    server = FakeServer()
+    with server.start() as entered:
+        # As in ``serve --port``, the server keeps the address it was started on
+        url = server.url
+        assert entered is server and threading.active_count() == threads + 1
+    assert server.url == url and threading.active_count() == threads
+
+
+def test_sources_do_not_share_auth_through_the_transport(atlassian_env):
+    from google.oauth2.credentials import Credentials
+    from google_auth_httplib2 import AuthorizedHttp
+
+    from aletheia import DEFAULTS
+    from aletheia.sources import confluence
+    from aletheia.transport import Httplib2Adapter, get_session
+    from benchmarks.fakes import FakeServer, json_response
+
+    class Echo(FakeServer):
+        def route(self, path, query, headers):
+            seen.append((path, headers.get("Authorization")))
+            return json_response({})
+
+    seen = []
+    with Echo() as server:
+        client = confluence.get_client_from_env(session=get_session(DEFAULTS), url=server.url)
+        drive = AuthorizedHttp(Credentials(token="drive-token"), http=Httplib2Adapter(get_session(DEFAULTS)))
+        client.get("confluence")
+        drive.request(f"{server.url}drive")
+    assert seen[0][0] == "/confluence" and seen[0][1].startswith("Basic ")
+    assert seen[1] == ("/drive", "Bearer drive-token")
+    assert get_session(DEFAULTS).pool is get_session(DEFAULTS).pool
+
+
+def test_hugoify_extract_title():
+    import io
+
+    from aletheia.converters.hugoify import extract_title
+
+    assert extract_title("page", io.StringIO("Intro\n# Fish &amp; chips\nBody\n")) == ("Fish & chips", "Intro\nBody")
+    assert extract_title("page", io.StringIO("Setext & co\n====\nBody")) == ("Setext & co", "Body")
+    assert extract_title("page", io.StringIO("No heading\n")) == ("page", "No heading")
+    assert extract_title("page", io.StringIO("# Kept\n"), filename_as_title=True) == ("page", "# Kept\n")
+
+
+def test_html_and_markdown_rewrites_match_in_a_process_pool(tmp_path):
+    from aletheia.builders import sphinx
+    from aletheia.converters.hugoify import Plugin
+    from aletheia.utils import PARALLEL_THRESHOLD, copytree
+
+    count = PARALLEL_THRESHOLD * 2
+    for i in range(count):
+        (tmp_path / "md" / f"dir{i % 4}").mkdir(parents=True, exist_ok=True)
+        (tmp_path / "md" / f"dir{i % 4}" / f"page{i}.md").write_text(f"# Page {i}\n\nText\n")
+        os.utime(str(tmp_path / "md" / f"dir{i % 4}" / f"page{i}.md"), (1000000000 + i, 1000000000 + i))
+        (tmp_path / "html" / f"dir{i % 4}").mkdir(parents=True, exist_ok=True)
+        (tmp_path / "html" / f"dir{i % 4}" / f"page{i}.html").write_text(
+            f'<html><body><h1>Page {i}<a class="headerlink" href="#">#</a></h1>'
+            '<a href="other.html">x</a></body></html>'
+        )
+    (tmp_path / "html" / "dir0.html").write_text("<html><body>Moved</body></html>")
+
+    trees = []
+    for concurrency in (1, 4):
+        output_dir = Plugin(str(tmp_path / "md"), concurrency=concurrency, add_index=True, index_title="Index").run()
+        html_dir = str(tmp_path / f"html-{concurrency}")
+        copytree(str(tmp_path / "html"), html_dir)
+        sphinx.clean_html_dir(html_dir, 1000000000, concurrency=concurrency)
+        trees.append((contents(output_dir), contents(html_dir)))
+    assert trees[0] == trees[1]
+    markdown, html = trees[0]
+    assert len(markdown) == count + 1 and b"title: Index" in markdown["_index.md"]
+    assert "dir0/index.html" in html and b"headerlink" not in html["dir1/page1.html"]
+    assert b'href="../other/"' in html["dir1/page1.html"]
+
+
+def test_plugin_registry_imports_lazily():
+    import sys
+
+    from aletheia.exceptions import ConfigError
+    from aletheia.registry import PluginRegistry
+
+    registry = PluginRegistry({"convert": "colorsys:rgb_to_hsv", "missing": "aletheia.nonexistent:Plugin"})
+    sys.modules.pop("colorsys", None)
+    assert "convert" in registry and "other" not in registry
+    assert "colorsys" not in sys.modules
+    assert registry["convert"] is sys.modules["colorsys"].rgb_to_hsv
+    try:
+        registry["missing"]
+    except ConfigError:
+        pass
+    else:
+        raise AssertionError("Expected ConfigError")
+
+
+def test_plugin_entry_points_fall_back_to_pkg_resources(monkeypatch, caplog):
+    import logging
+    import sys
+    import types
+
+    from aletheia import registry
+
+    entry_point = types.SimpleNamespace(name="extra", module_name="colorsys", attrs=("rgb_to_hsv",))
+    pkg_resources = types.SimpleNamespace(
+        iter_entry_points=lambda group: [entry_point] if group == "aletheia.plugins" else []
+    )
+    # As on Python < 3.8 without the importlib_metadata backport
+    monkeypatch.setattr(registry, "importlib_metadata", None)
+    monkeypatch.setitem(sys.modules, "pkg_resources", pkg_resources)
+    assert registry.plugin_entry_points() == [("extra", "colorsys:rgb_to_hsv")]
+    assert registry.PluginRegistry({})["extra"] is sys.modules["colorsys"].rgb_to_hsv
+
+    monkeypatch.setitem(sys.modules, "pkg_resources", None)
+    with caplog.at_level(logging.WARNING, logger="aletheia.registry"):
+        assert registry.plugin_entry_points() == []
+    assert "plugins in aletheia.plugins are ignored" in caplog.text
+
+
+def test_benchmark_trees_are_deterministic_and_compared_by_median(tmp_path):
+    from benchmarks import runner, synthetic
+
+    first = synthetic.generate_markdown_tree(str(tmp_path / "first"), files=50, size=500, image_ratio=0.2, seed=1)
+    second = synthetic.generate_markdown_tree(str(tmp_path / "second"), files=50, size=500, image_ratio=0.2, seed=1)
+    assert contents(first) == contents(second)
+    assert runner.tree_stats(first)[0] == 50 + len({rel_dir for rel_dir, _, _ in synthetic.plan_tree(50)})
+
+    def results(**medians):
+        return dict(params={}, results={name: dict(median=median) for name, median in medians.items()})
+
+    rows = runner.compare(results(hugoify=1.0, build=2.0), results(hugoify=1.05, build=3.0, sphinx_build=1.0))
+    assert [(name, regressed) for name, _, _, _, regressed in rows] == [("hugoify", False), ("build", True)]
+
+
+def test_confluence_word_export_parse_matches_email_module(tmp_path):
+    import email.parser
+    import email.policy
+    import io
+    from email.message import EmailMessage
+
+    from aletheia.sources.confluence import parse_word_export
+
+    def reference_parse(data):
+        # How Word exports were parsed before they were streamed
+        html, attachments = "", {}
+        for part in email.parser.BytesParser(policy=email.policy.default).parsebytes(data).walk():
+            if part.is_multipart():
+                continue
+            if part.get_content_type() == "text/html":
+                html = part.get_content()
+            else:
+                attachments[part["Content-Location"].rsplit("/", 1)[-1]] = part.get_content()
+        return html, attachments
+
+    html = (
+        "<html><body><h1>Caf\u00e9 \u2603</h1><p>" + "A long line with = signs and trailing spaces   " * 8 + "</p>\n"
+        '<p><img src="1234-image.png.tmp"></p>\n\n<p>Last line</p></body></html>'
+    )
+    message = EmailMessage()
+    message.set_content(html, subtype="html", cte="quoted-printable")
+    message.add_related(
+        bytes(range(256)) * 40,
+        "image",
+        "png",
+        cte="base64",
+        headers=["Content-Location: file:///C:/1234-image.png.tmp"],
+    )
+    message.add_related(
+        b"\x89PNG\r\n", "image", "png", cte="base64", headers=["Content-Location: file:///C:/empty.tmp"]
+    )
+
+    # Laid out as Confluence lays out its exports
+    confluence_export = (
+        b"Date: Mon, 1 Jun 2020 12:00:00 +0000 (UTC)\r\n"
+        b"Message-ID: <1@confluence>\r\n"
+        b"Subject: Exported From Confluence\r\n"
+        b"MIME-Version: 1.0\r\n"
+        b'Content-Type: multipart/related; boundary="----=_Part_0_1.2"\r\n'
+        b"\r\n"
+        b"------=_Part_0_1.2\r\n"
+        b"Content-Type: text/html; charset=UTF-8\r\n"
+        b"Content-Transfer-Encoding: quoted-printable\r\n"
+        b"Content-Location: file:///C:/exported.html\r\n"
+        b"\r\n"
+        b"<html><body><p>Caf=C3=A9 soft=\r\n"
+        b'ly broken</p><p><img src=3D"42-diagram.png.tmp"></p></body></html>\r\n'
+        b"------=_Part_0_1.2\r\n"
+        b"Content-Type: image/png\r\n"
+        b"Content-Transfer-Encoding: base64\r\n"
+        b"Content-Location: file:///C:/42-diagram.png.tmp\r\n"
+        b"\r\n"
+        b"iVBORw0KGgo=\r\n"
+        b"------=_Part_0_1.2--\r\n"
+    )
+    exports = [message.as_bytes(policy=policy) for policy in (email.policy.default, email.policy.SMTP)]
+    for index, data in enumerate(exports + [confluence_export]):
+        spill_dir = tmp_path / str(index)
+        spill_dir.mkdir()
+        parsed_html, spilled = parse_word_export(io.BytesIO(data), str(spill_dir))
+        expected_html, expected_attachments = reference_parse(data)
+        assert parsed_html == expected_html
+        assert {content_id: open(path, "rb").read() for content_id, path in spilled.items()} == expected_attachments
+    assert parsed_html == (
+        '<html><body><p>Caf\u00e9 softly broken</p><p><img src="42-diagram.png.tmp"></p></body></html>'
+    )
+    assert open(spilled["42-diagram.png.tmp"], "rb").read() == b"\x89PNG\r\n\x1a\n"
+
+
+def test_confluence_source_against_stand_in(tmp_path, config, atlassian_env):
+    import re
+
+    from aletheia.sources import confluence
+    from benchmarks.fakes import FakeConfluence
+
+    uncached_config = config.copy()
+    uncached_config.update(cache=False)
+    with FakeConfluence.generate(pages=6, fanout=2, attachment_size=1000, throttle_rate=0.2) as fake:
+        source = confluence.Source(config=config, page_id=fake.root_id, url=fake.url, fetch="export_view")
+        output_dir = source.run()
+        assert fake.stats["throttled"]
+        assert sorted(os.listdir(output_dir))[:3] == ["image0.png", "image1.png", "index.html"]
+        assert len([name for name in os.listdir(output_dir) if name.startswith("page-")]) == 2
+
+        # Only the page that changed is downloaded again
+        fake.touch("1004")
+        source = confluence.Source(config=config, page_id=fake.root_id, url=fake.url, fetch="export_view")
+        output_dir = source.run()
+        assert source._downloaded == ["1004"]
+        uncached = confluence.Source(config=uncached_config, page_id=fake.root_id, url=fake.url, fetch="export_view")
+        assert contents(output_dir) == contents(uncached.run())
+
+        # An attachment the page stops displaying goes from the store too
+        root = fake.pages[fake.root_id]
+        root["body"] = re.sub(r"<p><img [^>]*image1\.png[^>]*></p>", "", root["body"])
+        fake.touch(fake.root_id)
+        source = confluence.Source(config=config, page_id=fake.root_id, url=fake.url, fetch="export_view")
+        output_dir = source.run()
+        assert "image1.png" not in os.listdir(output_dir)
+        uncached = confluence.Source(config=uncached_config, page_id=fake.root_id, url=fake.url, fetch="export_view")
+        assert contents(output_dir) == contents(uncached.run())
+
+        # Word exports are stored apart from export_view ones, rather than being mistaken for them
+        source = confluence.Source(config=config, page_id=fake.root_id, url=fake.url, fetch="word")
+        output_dir = source.run()
+        assert sorted(source._downloaded) == sorted(fake.pages)
+        uncached = confluence.Source(config=uncached_config, page_id=fake.root_id, url=fake.url, fetch="word")
+        assert contents(output_dir) == contents(uncached.run())
+
+
+def test_confluence_export_view_downloads_only_displayed_attachments(tmp_path, config, atlassian_env):
+    import re
+
+    from bs4 import BeautifulSoup
+
+    from aletheia.sources import confluence
+    from benchmarks.fakes import FakeConfluence
+
+    config.update(cache=False)
+    with FakeConfluence.generate(pages=2, fanout=1, attachment_size=100, size=200) as fake:
+        root = fake.pages[fake.root_id]
+        root["body"] = re.sub(r"<p><img [^>]*image1\.png[^>]*></p>", "", root["body"])
+        source = confluence.Source(config=config, page_id=fake.root_id, url=fake.url, fetch="export_view", max_depth=0)
+        output_dir = source.run()
+
+        assert sorted(os.listdir(output_dir)) == ["image0.png", "index.html"]
+        with open(os.path.join(output_dir, "image0.png"), "rb") as ifs:
+            assert ifs.read() == fake._attachments[fake.root_id]["image0.png"]
+        with open(os.path.join(output_dir, "index.html")) as ifs:
+            doc = BeautifulSoup(ifs.read(), "html.parser")
+        # Images refer to their attachment by filename and keep only their dimensions
+        assert [img.attrs for img in doc.find_all("img")] == [{"width": "400", "src": "image0.png"}]
+        # The list of child pages is left out, as they're exported alongside
+        assert not doc.find_all("ul", class_="childpages-macro")
+
+
+def test_confluence_concurrent_download_matches_serial(tmp_path, config, atlassian_env):
+    from aletheia.sources import confluence
+    from benchmarks.fakes import FakeConfluence
+
+    config.update(cache=False)
+    with FakeConfluence.generate(pages=13, fanout=3, attachment_size=100, size=200) as fake:
+        trees = {}
+        for concurrency in (1, 8):
+            for max_depth in (None, 1):
+                source = confluence.Source(
+                    config=config, page_id=fake.root_id, url=fake.url, concurrency=concurrency, max_depth=max_depth
+                )
+                trees[concurrency, max_depth] = contents(source.run())
+        assert trees[1, None] == trees[8, None] and trees[1, 1] == trees[8, 1]
+
+        # Each page is nested under its parent's directory, down to max_depth
+        grandchild = fake.pages["1004"]
+        child = fake.pages[grandchild["parent"]]
+        index_path = os.path.join(
+            confluence.slugify(child["title"]), confluence.slugify(grandchild["title"]), "index.html"
+        )
+        assert index_path in trees[1, None] and index_path not in trees[1, 1]
+        assert len([path for path in trees[1, None] if path.endswith("index.html")]) == 13
+        assert len([path for path in trees[1, 1] if path.endswith("index.html")]) == 4
+
+
+def test_googledrive_source_against_stand_in(tmp_path, config):
+    from aletheia.sources import googledrive
+    from benchmarks.fakes import FakeDrive
+
+    with FakeDrive.generate(documents=8, depth=1, fanout=2, page_size=2, throttle_rate=0.2) as fake:
+        source = googledrive.Source(
+            config=config,
+            folder_id=fake.root_id,
+            format="html",
+            recursive=True,
+            api_endpoint=fake.api_endpoint,
+            anonymous=True,
+        )
+        output_dir = source.run()
+        exported = [os.path.join(root, name) for root, dirs, names in os.walk(output_dir) for name in names]
+        assert len([path for path in exported if path.endswith(".html")]) == 8
+        assert open(os.path.join(output_dir, "Document 0.html"), "rb").read() == fake._content["doc0"]
+
+        # Exporting with one worker gives the same tree, down to the mtimes, as exporting with several
+        config.update(cache=False)
+        kwargs = dict(format="html", recursive=True, api_endpoint=fake.api_endpoint, anonymous=True)
+        trees = [
+            contents(
+                googledrive.Source(config=config, folder_id=fake.root_id, concurrency=concurrency, **kwargs).run(),
+                mtimes=True,
+            )
+            for concurrency in (1, 8)
+        ]
+        assert trees[0] == trees[1] == contents(output_dir, mtimes=True)
+
+
+def test_googledrive_resync_lists_only_changed_folders(config):
+    from aletheia.sources import googledrive
+    from benchmarks.fakes import FakeDrive
+
+    def run(fake, **settings):
+        run_config = config.copy()
+        run_config.update(**settings)
+        kwargs = dict(format="html", recursive=True, api_endpoint=fake.api_endpoint, anonymous=True)
+        fake.listed.clear()
+        return googledrive.Source(config=run_config, folder_id=fake.root_id, **kwargs).run()
+
+    with FakeDrive.generate(documents=14, depth=2, fanout=2) as fake:
+        run(fake)
+        fake.touch("doc3")
+        output_dir = run(fake)
+        assert fake.listed == ["root-0-0"]
+        with open(os.path.join(output_dir, "Folder 0.0", "Folder 1.0", "Document 3.html"), "rb") as ifs:
+            assert ifs.read() == fake._content["doc3"]
+
+        fake.rename("root-1", "Renamed")
+        fake.remove("doc6")
+        output_dir = run(fake)
+        assert sorted(fake.listed) == ["root", "root-1", "root-1-0", "root-1-1"]
+        assert contents(output_dir) == contents(run(fake, cache=False))
+        assert "Renamed" in os.listdir(output_dir) and "Folder 0.1" not in os.listdir(output_dir)
+
+
+def test_metrics_report_stages_of_a_recorded_build(tmp_path, config):
+    import json
+
+    from aletheia import metrics
+    from aletheia.pipeline import Pipeline
+
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "page.md").write_text("# Page\n")
+    (tmp_path / "aletheia.yml").write_text(f"pipeline:\n- local:\n    path: {tmp_path / 'src'}\n- hugoify: {{}}\n")
+    config.update(
+        cache=False,
+        report=str(tmp_path / "report.json"),
+        prometheus_textfile=str(tmp_path / "metrics.prom"),
+        trace=str(tmp_path / "trace.json"),
+    )
+
+    class Broken:
+        def __init__(self, config, **kwargs):
+            pass
+
+        def run(self):
+            raise RuntimeError("Broken")
+
+        def cleanup(self):
+            pass
+
+    recorder = metrics.start_recording()
+    try:
+        with metrics.span("docs", "pipeline"):
+            pipeline_obj = Pipeline(str(tmp_path / "aletheia.yml"), config=config)
+            pipeline_obj.load()
+            pipeline_obj.run(merge=False)
+        with metrics.span("broken", "pipeline"):
+            pipeline_obj = Pipeline(str(tmp_path / "aletheia.yml"), config=config)
+            pipeline_obj.pipeline = [("broken", Broken, {}, False)]
+            pipeline_obj.run(merge=False)
+    finally:
+        metrics.stop_recording()
+    recorder.save(config)
+
+    report = json.loads((tmp_path / "report.json").read_text())
+    [pipeline] = [pipeline for pipeline in report["pipelines"] if pipeline["name"] == "docs"]
+    assert [(stage["name"], stage["index"]) for stage in pipeline["stages"]] == [("local", 0), ("hugoify", 1)]
+    assert pipeline["stages"][1]["files_in"] == 1
+    prometheus = (tmp_path / "metrics.prom").read_text()
+    assert 'aletheia_stage_duration_seconds{pipeline="docs",plugin="hugoify",stage="1"}' in prometheus
+    assert 'aletheia_pipeline_failed{pipeline="docs"} 0.0' in prometheus
+    assert 'aletheia_pipeline_failed{pipeline="broken"} 1.0' in prometheus
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert {event["name"] for event in events if event["ph"] == "X"} == {"docs", "broken", "local", "hugoify"}
+    assert not metrics.recording()
+
+
+def test_profiled_stage_writes_profile_and_summary(tmp_path, caplog, config):
+    import logging
+    import pstats
+    import tracemalloc
+
+    from aletheia import profiling
+    from aletheia.pipeline import Pipeline
+
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "page.md").write_text("# Page\n")
+    (tmp_path / "aletheia.yml").write_text(
+        f"pipeline:\n- local:\n    path: {tmp_path / 'src'}\n- hugoify: {{}}\n  profile: true\n"
+    )
+    config.update(cache=False, profile_dir=str(tmp_path / "profiles"))
+    pipeline_obj = Pipeline(str(tmp_path / "aletheia.yml"), config=config, name="docs")
+    pipeline_obj.load()
+    pipeline_obj.run(merge=False)
+
+    assert sorted(os.listdir(tmp_path / "profiles")) == ["docs--1--hugoify.pstats", "docs--1--hugoify.tracemalloc"]
+    assert pstats.Stats(str(tmp_path / "profiles" / "docs--1--hugoify.pstats")).total_calls
+    assert tracemalloc.Snapshot.load(str(tmp_path / "profiles" / "docs--1--hugoify.tracemalloc")).traces
+    assert not tracemalloc.is_tracing()
+    with caplog.at_level(logging.INFO, logger="aletheia.profiling"):
+        profiling.log_summary(top=5)
+    assert "hugoify stage of docs" in caplog.text and "Hottest functions across 1 profiled stages" in caplog.text
+
+
+def test_sphinx_rebuild_reuses_workspace_and_sees_git(tmp_path, caplog, config):
+    import logging
+    import subprocess
+
+    from aletheia.builders import sphinx
+    from aletheia.utils import copytree
+
+    project = tmp_path / "project"
+    (project / "docs").mkdir(parents=True)
+    (project / "docs" / "conf.py").write_text(
+        "import os, subprocess\n"
+        "project = 'Test'\n"
+        "release = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], "
+        "cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()\n"
+    )
+    (project / "docs" / "index.rst").write_text("Index\n=====\n\n.. toctree::\n\n   page\n")
+    (project / "docs" / "page.rst").write_text("Page\n====\n\nFirst version.\n")
+    git = ["git", "-c", "user.name=Test", "-c", "user.email=test@example.com"]
+    subprocess.run(["git", "init", "-q", "-b", "main", str(project)], check=True)
+    subprocess.run(git + ["-C", str(project), "add", "."], check=True)
+    subprocess.run(git + ["-C", str(project), "commit", "-q", "-m", "Docs"], check=True)
+
+    def build(name):
+        working_dir = str(tmp_path / name)
+        copytree(str(project), working_dir)
+        html_dir = sphinx.Plugin(working_dir, config=config).run()
+        with open(os.path.join(html_dir, "page.html")) as ifs:
+            return ifs.read()
+
+    revision = subprocess.run(
+        ["git", "-C", str(project), "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE, check=True
+    ).stdout.decode()
+    html = build("first")
+    assert "First version." in html and revision.strip() in html
+    (project / "docs" / "page.rst").write_text("Page\n====\n\nSecond version.\n")
+    with caplog.at_level(logging.INFO, logger="aletheia.builders.sphinx"):
+        assert "Second version." in build("second")
+    assert "Reusing previous Sphinx build." in caplog.text
+
+    # A workspace bigger than the whole cache still outlives the build that made it
+    config.update(cache_size_limit=1000)
+    assert "Second version." in build("third")
+
+
+def test_sphinx_in_process_builds_import_each_projects_own_modules(tmp_path, config):
+    import sys
+
+    from aletheia.builders import sphinx
+
+    def build(name, docstring):
+        working_dir = tmp_path / name
+        (working_dir / "docs").mkdir(parents=True)
+        (working_dir / "sharedmod.py").write_text(f'"""{docstring}"""\n')
+        (working_dir / "docs" / "conf.py").write_text(
+            "import os, sys\n"
+            "sys.path.insert(0, os.path.abspath('..'))\n"
+            "project = 'Test'\n"
+            "extensions = ['sphinx.ext.autodoc']\n"
+        )
+        (working_dir / "docs" / "index.rst").write_text("Index\n=====\n\n.. automodule:: sharedmod\n")
+        html_dir = sphinx.Plugin(str(working_dir), config=config).run()
+        with open(os.path.join(html_dir, "index.html")) as ifs:
+            return ifs.read()
+
+    config.update(cache=False)
+    assert "First branch." in build("first", "First branch.")
+    assert "Second branch." in build("second", "Second branch.")
+    assert "sharedmod" not in sys.modules
+
+
+def test_sphinx_reuses_virtualenv_until_lockfile_changes(tmp_path, monkeypatch, config):
+    from aletheia.builders import sphinx
+    from aletheia.utils import copytree
+
+    install_tool(
+        tmp_path / "bin",
+        "poetry",
+        """
+import os, sys
+
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "calls.log"), "a") as ofs:
+    ofs.write(" ".join(sys.argv[1:]) + " " + os.environ["VIRTUAL_ENV"] + "\\n")
+""",
+    )
+    monkeypatch.setenv("PATH", f"{tmp_path / 'bin'}{os.pathsep}{os.environ['PATH']}")
+    project = tmp_path / "project"
+    (project / "docs").mkdir(parents=True)
+    (project / "docs" / "conf.py").write_text("project = 'Test'\n")
+    (project / "docs" / "index.rst").write_text("Index\n=====\n")
+    (project / "poetry.lock").write_text("# First\n")
+    # Every virtualenv is over the limit on its own
+    config.update(cache_size_limit=1000)
+
+    def build(name):
+        working_dir = str(tmp_path / name)
+        copytree(str(project), working_dir)
+        sphinx.Plugin(working_dir, config=config, install_deps=True).run()
+        calls = (tmp_path / "bin" / "calls.log").read_text().splitlines()
+        (tmp_path / "bin" / "calls.log").unlink()
+        return [call.split() for call in calls]
+
+    [[install, venv_dir]] = build("first")
+    assert install == "install" and os.path.isfile(os.path.join(venv_dir, "bin", "python"))
+    # Only the project itself is installed into the cached virtualenv
+    assert build("second") == [["install", "--only-root", venv_dir]]
+    (project / "poetry.lock").write_text("# Second\n")
+    [[install, other_venv_dir]] = build("third")
+    assert install == "install" and other_venv_dir != venv_dir
+    # Once no build is using it, the old virtualenv makes way for the new one
+    assert os.path.isfile(os.path.join(other_venv_dir, "bin", "python")) and not os.path.exists(venv_dir)